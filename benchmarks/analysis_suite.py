@@ -0,0 +1,224 @@
+"""
+Times the battle analysis hot path in isolation on seeded synthetic battles, records the results in a JSON file, and
+optionally compares them against a saved baseline, failing if anything got slower by more than a threshold.
+
+Each scenario is one battle from benchmarks.synthetic, and is timed on:
+
+- modify_data_with_history: analyzing every (already decoded) segment of the battle, per segment
+- identify_creep_hit and identify_creep_miss: classifying every creep in the battle, per creep, with every body
+  already in identify_creep's cache, and with the cache cleared before each creep
+- storage_encode_decode: encoding the battle's ongoing data into the writes storage.set_ongoing_data would make, and
+  decoding those back the way get_ongoing_data does, per round trip. Redis isn't involved: the writes are applied to
+  plain dicts, so this only measures the encoding and decoding
+- should_report and format_message: on the finished battle, per call
+
+Every timing is the best of --repeat runs, each long enough to take at least --min-time seconds.
+
+Run from the project directory with `python -m benchmarks.analysis_suite`. Results are written to
+benchmarks/results/analysis_suite.json (ignored by git) unless --output says otherwise. To catch regressions, save a
+run's results with `--output baseline.json` before a change and compare after it with `--baseline baseline.json`.
+Timings are only comparable on the same machine and python.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import sys
+import timeit
+
+from benchmarks.synthetic import generate_segments
+from warreport import battle_reporting, history_parser, screeps_info, storage
+
+# name -> generate_segments arguments
+SCENARIOS = {
+    'skirmish': dict(creep_count=12, ticks=200, players=2, structures=100),
+    'siege': dict(creep_count=300, ticks=1000, players=2, structures=1500),
+    'war': dict(creep_count=1000, ticks=600, players=10, structures=500),
+}
+
+
+def _bytes(value):
+    return value if isinstance(value, bytes) else str(value).encode()
+
+
+def _storage_encode_decode(data_map):
+    """
+    Encodes data_map into the writes storage.set_ongoing_data would make, applies them to plain dicts and sets standing
+    in for its redis keys, holding bytes as redis returns, then decodes it back as get_ongoing_data would.
+    """
+    changed_fields, removed_fields, new_creeps, count_increases, new_usernames = storage._ongoing_changes(data_map, {})
+    state = {_bytes(field): _bytes(value) for field, value in changed_fields.items()}
+    for field in removed_fields:
+        state.pop(_bytes(field), None)
+    creeps = set(new_creeps)
+    counts = {_bytes(field): _bytes(increase) for field, increase in count_increases.items()}
+    usernames = {_bytes(user_id): _bytes(username) for user_id, username in new_usernames.items()}
+    return storage._decode_ongoing_data(state, creeps, counts, usernames)
+
+
+def _identify_uncached(creeps):
+    for creep in creeps:
+        screeps_info._classify_body.cache_clear()
+        screeps_info.identify_creep(creep)
+
+
+def _analyze(segments, first_tick):
+    battle_data = {
+        'player_creep_counts': {},
+        'creeps_found': set(),
+        'owner': None,
+        'rcl': 0,
+        'earliest_hostilities_detected': first_tick,
+        'latest_hostilities_detected': first_tick,
+        'earliest_hostilities_collided': False,
+    }
+    for segment in segments:
+        screeps_info.modify_data_with_history(battle_data, segment, checking='latest')
+    return battle_data
+
+
+def _finish(room, battle_data):
+    """
+    Turns analyzed battle data into a finished battle, as work_on_room_data does.
+    """
+    finished = dict(battle_data)
+    del finished['creeps_found']
+    finished.pop('usernames', None)
+    finished['duration'] = finished['latest_hostilities_detected'] - finished['earliest_hostilities_detected'] + 1
+    finished['battle_still_ongoing'] = False
+    finished['alliances'] = {username: "Alliance {}".format(index % 3) if index % 2 else None
+                             for index, username in enumerate(sorted(finished['player_creep_counts']))}
+    finished['room'] = room
+    return finished
+
+
+def _time(function, min_time, repeat):
+    """
+    :return: A tuple of (best seconds per call, calls per run)
+    """
+    timer = timeit.Timer(function)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-9) * 1.1))
+    best = min([elapsed] + timer.repeat(repeat - 1, number))
+    return best / number, number
+
+
+def run_scenario(name, seed, min_time, repeat):
+    """
+    :return: {benchmark name: result} for the named scenario
+    """
+    full_segments = generate_segments(seed=seed, **SCENARIOS[name])
+    # Round trip through JSON so that the segments are shaped exactly like freshly decoded ones.
+    full_segments = json.loads(json.dumps(full_segments))
+    segments = [history_parser.compact_segment(segment['ticks']) for segment in full_segments]
+    first_tick = full_segments[0]['base']
+    creeps = {obj_id: obj for segment in full_segments for obj_id, obj in segment['ticks'][str(segment['base'])].items()
+              if obj.get('type') == 'creep'}
+    creeps = list(creeps.values())
+    room = full_segments[0]['room']
+
+    battle_data = _analyze(segments, first_tick)
+    ongoing = dict(battle_data, max_tick_checked=full_segments[-1]['base'],
+                   stop_checking_at=full_segments[-1]['base'] + 120)
+    assert _storage_encode_decode(ongoing) == ongoing, "storage encoding changed the battle data"
+    finished = _finish(room, battle_data)
+
+    benchmarks = [
+        ('modify_data_with_history', 'segment', len(segments), lambda: _analyze(segments, first_tick)),
+        ('identify_creep_hit', 'creep', len(creeps), lambda: [screeps_info.identify_creep(creep) for creep in creeps]),
+        ('identify_creep_miss', 'creep', len(creeps), lambda: _identify_uncached(creeps)),
+        ('storage_encode_decode', 'round trip', 1, lambda: _storage_encode_decode(ongoing)),
+        ('should_report', 'call', 1, lambda: battle_reporting.should_report(finished)),
+        ('format_message', 'call', 1, lambda: battle_reporting.format_message(finished)),
+    ]
+    results = {}
+    for benchmark, per, count, function in benchmarks:
+        seconds, number = _time(function, min_time, repeat)
+        results["{}.{}".format(name, benchmark)] = {
+            'seconds': seconds / count,
+            'per': per,
+            'calls': number,
+        }
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints each result next to its baseline.
+    :return: The names of results more than `threshold` (a fraction) slower than their baseline
+    """
+    regressions = []
+    print("{:<36} {:>12} {:>12} {:>8}".format("benchmark", "baseline", "current", "change"))
+    for name, result in sorted(results.items()):
+        before = baseline.get(name)
+        if before is None:
+            print("{:<36} {:>12} {:>12.3f}us {:>8}".format(name, "-", result['seconds'] * 1e6, "new"))
+            continue
+        change = result['seconds'] / before['seconds'] - 1
+        regressed = change > threshold
+        if regressed:
+            regressions.append(name)
+        print("{:<36} {:>10.3f}us {:>10.3f}us {:>+7.1%}{}".format(name, before['seconds'] * 1e6,
+                                                                 result['seconds'] * 1e6, change,
+                                                                 " REGRESSION" if regressed else ""))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times the battle analysis hot path on synthetic battles, and "
+                                                 "compares the timings against a saved baseline.")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="scenario to run, can be given more than once (default: all)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each benchmark to take the best of")
+    parser.add_argument("--min-time", type=float, default=0.2, help="minimum seconds each run takes")
+    parser.add_argument("--output", default=os.path.join("benchmarks", "results", "analysis_suite.json"),
+                        help="file to write results to")
+    parser.add_argument("--baseline", help="results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.15,
+                        help="fraction slower than the baseline which counts as a regression")
+    args = parser.parse_args()
+    # The benchmarks shouldn't touch the network or redis.
+    screeps_info.usernames_from_ids = lambda user_ids: {user_id: "player-" + user_id[:6] for user_id in user_ids}
+    logging.getLogger("warreport").setLevel(logging.WARNING)
+
+    results = {}
+    for name in args.scenario or sorted(SCENARIOS):
+        scenario_results = run_scenario(name, args.seed, args.min_time, args.repeat)
+        for benchmark, result in sorted(scenario_results.items()):
+            print("{:<36} {:>12.3f}us/{}".format(benchmark, result['seconds'] * 1e6, result['per']))
+        results.update(scenario_results)
+
+    if os.path.dirname(args.output):
+        os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, "w") as file:
+        json.dump({
+            'created': datetime.datetime.utcnow().isoformat() + "Z",
+            'python': "{} {}".format(platform.python_implementation(), platform.python_version()),
+            'machine': platform.platform(),
+            'seed': args.seed,
+            'benchmarks': results,
+        }, file, indent=4, sort_keys=True)
+    print("Results written to {}".format(args.output))
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline.get('seed') != args.seed:
+            print("Warning: the baseline was run with seed {}, not {}.".format(baseline.get('seed'), args.seed))
+        print()
+        regressions = compare(results, baseline['benchmarks'], args.threshold)
+        if regressions:
+            print("{} benchmarks regressed by more than {:.0%}: {}".format(len(regressions), args.threshold,
+                                                                          ", ".join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+"""
+Times screeps_info.identify_creep against the original multi-pass classifier (which tests/test_creep_classifier.py
+checks it against) on a realistic mix of bodies where most creeps share a spawn template.
+
+Run from the project directory with `python -m benchmarks.creep_classifier`.
+"""
+import argparse
+import random
+import time
+
+from benchmarks.synthetic import BODY_TEMPLATES
+from tests.test_creep_classifier import reference_identify_creep
+from warreport import screeps_info
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times screeps_info.identify_creep against the original "
+                                                 "multi-pass classifier.")
+    parser.add_argument("--creeps", type=int, default=100000, help="creeps timed")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    creeps = [{'body': [{'type': part, 'hits': 100} for part in rng.choice(BODY_TEMPLATES)]}
+              for _ in range(args.creeps)]
+    screeps_info._classify_body.cache_clear()
+    for name, classify in (("reference", reference_identify_creep), ("identify_creep", screeps_info.identify_creep)):
+        start = time.perf_counter()
+        for creep in creeps:
+            classify(creep)
+        elapsed = time.perf_counter() - start
+        print("{:<16} {:>8.3f} us/creep".format(name, elapsed / len(creeps) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
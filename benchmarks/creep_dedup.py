@@ -0,0 +1,68 @@
+"""
+Compares modify_data_with_history with the seen-creep set against the list it used to use, on a synthetic 500-creep,
+2000-tick battle.
+
+Segments are decoded into compact form up front, so that only the analysis is timed, and usernames are resolved by a
+stand-in, so no redis or API access is needed. The stored size compares the JSON list creeps_found used to be stored as
+with the packed object IDs storage.set_ongoing_data now adds to the room's creep set.
+
+Run from the project directory with `python -m benchmarks.creep_dedup`.
+"""
+import argparse
+import json
+import time
+
+from benchmarks.synthetic import generate_segments
+from warreport import screeps_info, history_parser
+from warreport.encoding import pack_object_id
+
+
+class _SeenList(list):
+    """
+    The old creeps_found: a list, with a linear-time membership test.
+    """
+    add = list.append
+
+
+def _run(segments, creeps_found):
+    battle_data = {
+        'player_creep_counts': {},
+        'creeps_found': creeps_found,
+        'owner': None,
+        'rcl': 0,
+        'earliest_hostilities_detected': segments[0]['first_tick'],
+        'latest_hostilities_detected': segments[0]['first_tick'],
+    }
+    start = time.perf_counter()
+    for segment in segments:
+        screeps_info.modify_data_with_history(battle_data, segment, checking='latest')
+    return time.perf_counter() - start, battle_data
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares tracking seen creeps in a set against the list "
+                                                 "modify_data_with_history used to use.")
+    parser.add_argument("--creeps", type=int, default=500)
+    parser.add_argument("--ticks", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    screeps_info.usernames_from_ids = lambda user_ids: {user_id: user_id for user_id in user_ids}
+    segments = [history_parser.compact_segment(segment['ticks'])
+                for segment in generate_segments(creep_count=args.creeps, ticks=args.ticks, seed=args.seed)]
+
+    list_time, list_data = _run(segments, _SeenList())
+    set_time, set_data = _run(segments, set())
+    assert list_data['player_creep_counts'] == set_data['player_creep_counts']
+    assert set(list_data['creeps_found']) == set_data['creeps_found']
+
+    print("{} creeps, {} ticks".format(args.creeps, args.ticks))
+    print("list: {:.3f}s".format(list_time))
+    print("set:  {:.3f}s ({:.1f}x faster)".format(set_time, list_time / set_time))
+    print("stored size: {} bytes as a JSON list, {} bytes of packed set members".format(
+        len(json.dumps(list(list_data['creeps_found']))),
+        sum(len(pack_object_id(creep_id)) for creep_id in set_data['creeps_found'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Simulates polling the pvp API for new battles at a fixed 15 minute interval against battle_monitor.next_poll_interval,
+comparing how long battles wait to be discovered and how many API calls each makes, in quiet and busy periods.
+
+Battles start at random, at a different rate in each period. Room workers are modelled as processing a fixed number of
+rooms per minute, so rooms are left due when a poll finds more than they've kept up with.
+
+Run from the project directory with `python -m benchmarks.discovery_polling`.
+"""
+import argparse
+import random
+import statistics
+
+from warreport import battle_monitor
+
+# (name, minutes, battles started per minute)
+_PERIODS = [
+    ("quiet", 6 * 60, 0.0),
+    ("trickle", 6 * 60, 0.05),
+    ("busy", 3 * 60, 2.0),
+    ("war", 60, 10.0),
+    ("quiet again", 6 * 60, 0.0),
+]
+
+
+def _battle_times(rng):
+    times = []
+    start = 0.0
+    for name, minutes, rate in _PERIODS:
+        end = start + minutes * 60
+        if rate:
+            time = start + rng.expovariate(rate / 60)
+            while time < end:
+                times.append((time, name))
+                time += rng.expovariate(rate / 60)
+        start = end
+    return times, start
+
+
+def simulate(battles, duration, next_interval, rooms_per_minute):
+    """
+    :return: A tuple of ({period: [discovery delays]}, {period: api calls})
+    """
+    delays = {name: [] for name, _, _ in _PERIODS}
+    calls = {name: 0 for name, _, _ in _PERIODS}
+    period_ends = []
+    end = 0
+    for name, minutes, _ in _PERIODS:
+        end += minutes * 60
+        period_ends.append((end, name))
+
+    now = 0.0
+    interval = battle_monitor.DISCOVERY_MAX_INTERVAL
+    last_poll = 0.0
+    index = 0
+    backlog = 0.0
+    while now < duration:
+        calls[next(name for period_end, name in period_ends if now < period_end)] += 1
+        found = 0
+        while index < len(battles) and battles[index][0] <= now:
+            time, name = battles[index]
+            delays[name].append(now - time)
+            found += 1
+            index += 1
+        backlog = max(0.0, backlog - (now - last_poll) / 60 * rooms_per_minute)
+        interval = next_interval(interval, found, False, int(backlog))
+        backlog += found
+        last_poll = now
+        now += interval
+    return delays, calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulates polling the pvp API at a fixed interval against "
+                                                 "battle_monitor.next_poll_interval.")
+    parser.add_argument("--rooms-per-minute", type=float, default=20, help="rooms the workers process a minute")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    battles, duration = _battle_times(random.Random(args.seed))
+    methods = [
+        ("fixed", lambda interval, found, failed, rooms_due: battle_monitor.DISCOVERY_MAX_INTERVAL),
+        ("adaptive", battle_monitor.next_poll_interval),
+    ]
+    print("{:>12} {:>10} {:>8} {:>12} {:>12}".format("period", "method", "calls", "median wait", "p90 wait"))
+    results = [(method, simulate(battles, duration, function, args.rooms_per_minute)) for method, function in methods]
+    for name, _, _ in _PERIODS:
+        for method, (delays, calls) in results:
+            waits = sorted(delays[name])
+            if waits:
+                median = "{:.0f}s".format(statistics.median(waits))
+                p90 = "{:.0f}s".format(waits[int(len(waits) * 0.9)])
+            else:
+                median = p90 = "-"
+            print("{:>12} {:>10} {:>8} {:>12} {:>12}".format(name, method, calls[name], median, p90))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""
+Runs `python -m warreport` end to end against a local stand-in for screeps.com (benchmarks/fake_screeps.py) and a local
+redis, and measures how it keeps up: rooms reported and history segments fetched a second, how long after discovery
+and after each battle ends it's reported, and peak memory.
+
+warreport is run from a temporary directory, with a config.json pointing it at the stand-in and at the given redis
+database (which must be empty, and is flushed afterwards), reporting to a jsonl sink which is watched for battles. The
+run ends once every battle has been reported, or nothing new has been reported for --idle-timeout seconds after the
+last battle ended.
+
+Run from the project directory with `python -m benchmarks.end_to_end`. The world can be shaped with the same options
+as fake_screeps, for example `--rooms 500 --spread 120 --latency 0.1 --missing-rate 0.02`.
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import redis
+
+from benchmarks import fake_screeps
+
+_PROJECT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _percentiles(values):
+    values = sorted(values)
+    if not values:
+        return "-"
+    return "p50 {:.1f}s, p90 {:.1f}s, p99 {:.1f}s, max {:.1f}s".format(
+        values[len(values) // 2], values[int(len(values) * 0.9)], values[int(len(values) * 0.99)], values[-1])
+
+
+def _write_config(directory, args, url):
+    config = {
+        "database": {
+            "host": args.redis_host,
+            "port": args.redis_port,
+            "database": args.redis_db,
+            "prefix": "benchmark:warreport:",
+        },
+        "logging": {"directory": "logs", "file_debug": args.debug_log},
+        "history_cache": {"directory": "cache/history"},
+        "processes": {"processors": args.processors, "reporters": 1},
+        "processing_workers": args.workers,
+        # Ticks are much faster than the real server's, so look for new battles much more often too.
+        "discovery": {"min_interval": 1, "max_interval": 10},
+        "sinks": [{"type": "jsonl", "path": "reports.jsonl"}],
+        "screeps_url": url,
+        "alliances_url": url + "alliances.js",
+    }
+    with open(os.path.join(directory, "config.json"), "w") as file:
+        json.dump(config, file, indent=4)
+
+
+def _read_reports(file, reported):
+    """
+    Records when each room was first and last reported, from new lines of the jsonl sink. Battles still going on when
+    first reported are reported again once they've been followed to the end.
+    """
+    now = time.time()
+    for line in file.readlines():
+        if not line.endswith("\n"):
+            # Half written: read it again next time.
+            file.seek(file.tell() - len(line))
+            break
+        room = json.loads(line)['room']
+        reported.setdefault(room, [now, now])[1] = now
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs warreport end to end against a local stand-in for screeps.com, "
+                                                 "and measures how it keeps up.")
+    fake_screeps.add_world_arguments(parser)
+    parser.add_argument("--processors", type=int, default=0, help="processes.processors to run warreport with")
+    parser.add_argument("--workers", type=int, default=4, help="processing_workers to run warreport with")
+    parser.add_argument("--redis-host", default="localhost")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    parser.add_argument("--redis-db", type=int, default=15, help="redis database to use, which must be empty")
+    parser.add_argument("--idle-timeout", type=float, default=60)
+    parser.add_argument("--keep", action="store_true", help="keep warreport's directory, with its logs")
+    parser.add_argument("--debug-log", action="store_true", help="have warreport log debug messages to its log file")
+    args = parser.parse_args()
+
+    redis_conn = redis.StrictRedis(host=args.redis_host, port=args.redis_port, db=args.redis_db)
+    if redis_conn.dbsize():
+        sys.exit("Redis database {} isn't empty: refusing to use it.".format(args.redis_db))
+
+    world = fake_screeps.world_from_arguments(args)
+    server, url = fake_screeps.serve(world)
+    directory = tempfile.mkdtemp(prefix="warreport-benchmark-")
+    _write_config(directory, args, url)
+    reports_path = os.path.join(directory, "reports.jsonl")
+    open(reports_path, "w").close()
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [_PROJECT_DIRECTORY, env.get('PYTHONPATH')]))
+    last_battle_end = max(world.time_of_tick(battle.end) for battle in world.battles.values())
+    print("Serving {} battles on {}, the last ending in {:.0f}s. Running warreport in {}."
+          .format(len(world.battles), url, last_battle_end - time.time(), directory))
+
+    started = time.time()
+    with open(os.path.join(directory, "output.log"), "w") as output:
+        process = subprocess.Popen([sys.executable, "-m", "warreport"], cwd=directory, env=env, stdout=output,
+                                   stderr=subprocess.STDOUT)
+    reported = {}
+    last_progress = started
+    try:
+        with open(reports_path) as reports_file:
+            while len(reported) < len(world.battles) and process.poll() is None:
+                time.sleep(0.1)
+                count = len(reported)
+                _read_reports(reports_file, reported)
+                now = time.time()
+                if len(reported) > count:
+                    last_progress = now
+                elif now - max(last_progress, last_battle_end) > args.idle_timeout:
+                    print("Nothing reported for {:.0f}s, giving up.".format(args.idle_timeout))
+                    break
+    finally:
+        finished = time.time()
+        if process.poll() is None:
+            process.send_signal(signal.SIGTERM)
+            try:
+                process.wait(30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        server.shutdown()
+        redis_conn.flushdb()
+    # The largest resident set of warreport or any of its processes, in kilobytes on linux.
+    peak_memory = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    elapsed = (max(last for first, last in reported.values()) if reported else finished) - started
+    stats = world.stats()
+    print("warreport exited with {}".format(process.returncode))
+    print("Reported {} of {} battles ({} discovered, {} reported again after ending) in {:.1f}s"
+          .format(len(reported), len(world.battles), stats['discovered'],
+                  sum(1 for first, last in reported.values() if last > first), elapsed))
+    print("Rooms reported: {:.2f}/s".format(len(reported) / elapsed))
+    print("History segments fetched: {:.2f}/s ({} found, {} not found)"
+          .format(stats['segments'] / elapsed, stats['segments'], stats['segments_not_found']))
+    print("Other requests: {} pvp, {} usernames, {} alliances".format(stats['pvp'], stats['usernames'],
+                                                                      stats['alliances']))
+    print("Discovery to report: {}".format(_percentiles(
+        [first - world.discovered_at[room] for room, (first, last) in reported.items()
+         if room in world.discovered_at])))
+    print("Battle end to final report: {}".format(_percentiles(
+        [last - world.time_of_tick(world.battles[room].end) for room, (first, last) in reported.items()])))
+    print("Peak memory: {:.1f} MiB".format(peak_memory / 1024))
+    if args.keep:
+        print("Logs kept in {}".format(directory))
+    else:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
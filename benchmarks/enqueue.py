@@ -0,0 +1,133 @@
+"""
+Compares enqueuing newly found battles in batches with queuing.push_battles_for_processing against the previous
+one-script-call-per-room approach, and checks both leave redis in the same state.
+
+This needs a real redis server, and uses a whole database of it: by default database 15 on localhost, which must be
+empty. Run from the project directory with `python -m benchmarks.enqueue`.
+"""
+import argparse
+import random
+import sys
+import time
+
+import redis
+
+from warreport import queuing, storage
+from warreport.key_constants import PROCESSING_QUEUE_SET, BATTLE_DATA_KEY, BATTLE_DATA_EXPIRE, \
+    KEEP_IN_QUEUE_FOR_MAX_TICKS, PROCESSING_SCHEDULE_KEY
+
+try:
+    import rapidjson as json
+except ImportError:
+    import json
+
+# The insert script as it was before batching: one call per room, with the battle data built client side.
+_reference_insert_script = redis.client.Script(None, """
+local added = redis.call('sismember', KEYS[1], ARGV[1])
+if added == 0 then
+    redis.call('sadd', KEYS[1], ARGV[1])
+    redis.call('zadd', KEYS[2], ARGV[4], ARGV[1])
+    redis.call('set', KEYS[3], ARGV[2], 'ex', ARGV[3])
+end
+""")
+
+
+def reference_push_battles_for_processing(battles_array):
+    """
+    push_battles_for_processing as it was before batching.
+    """
+    conn = queuing.redis_conn
+    if not _reference_insert_script.sha or not conn.script_exists(_reference_insert_script.sha)[0]:
+        _reference_insert_script.sha = conn.script_load(_reference_insert_script.script)
+    pipe = conn.pipeline()
+    now = time.time()
+    for room_name, hostilities_tick in battles_array:
+        _reference_insert_script(
+            keys=[PROCESSING_QUEUE_SET, queuing._schedule_key(room_name), BATTLE_DATA_KEY.format(room_name)],
+            args=[room_name, json.dumps({
+                'tick_to_check': hostilities_tick,
+                'stop_checking_at': (hostilities_tick - hostilities_tick % 20) + KEEP_IN_QUEUE_FOR_MAX_TICKS,
+            }), BATTLE_DATA_EXPIRE, now],
+            client=pipe,
+        )
+    pipe.execute()
+
+
+def _generate_battles(count, seed):
+    rng = random.Random(seed)
+    battles = []
+    for i in range(count):
+        room_name = "{}{}{}{}".format(rng.choice("EW"), i // 200, rng.choice("NS"), i % 200)
+        battles.append((room_name, rng.randrange(10000000, 20000000)))
+    return battles
+
+
+def _snapshot(conn, battles):
+    """
+    Gets everything the enqueue is meant to have written, with due times left out since they depend on the clock.
+    Reading the per-room data through storage means data in its old single-string format compares equal.
+    """
+    state = {'set': conn.smembers(PROCESSING_QUEUE_SET), 'schedule': set()}
+    for partition in range(queuing.PROCESSING_PARTITIONS):
+        state['schedule'].update(conn.zrange(PROCESSING_SCHEDULE_KEY.format(partition), 0, -1))
+    state['data'] = [storage.get_ongoing_data(room_name) for room_name, _ in battles]
+    return state
+
+
+def _time(conn, function, battles, repeat):
+    best = None
+    snapshot = None
+    for _ in range(repeat):
+        conn.flushdb()
+        start = time.perf_counter()
+        function(battles)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        snapshot = _snapshot(conn, battles)
+    conn.flushdb()
+    return best, snapshot
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares enqueuing newly found battles in batches against "
+                                                 "one script call per room.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--redis-db", type=int, default=15, help="redis database to use: must be empty")
+    parser.add_argument("--rooms", type=int, default=10000)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 50, 500, 2000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    conn = redis.StrictRedis(host=args.host, port=args.port, db=args.redis_db)
+    if conn.dbsize():
+        sys.exit("Redis database {} isn't empty: refusing to run in it.".format(args.redis_db))
+    queuing.redis_conn = conn
+    storage.cache_connection = conn
+    # Make sure both get the scripts loaded before timing.
+    queuing._battle_insert_script.sha = ''
+    _reference_insert_script.sha = ''
+
+    battles = _generate_battles(args.rooms, args.seed)
+    # Every battle is found again a second time, as happens when the pvp API is asked about an overlapping interval.
+    battles += battles[:len(battles) // 10]
+
+    reference_time, reference_state = _time(conn, reference_push_battles_for_processing, battles, args.repeat)
+    print("{:>16} {:>10} {:>12} {:>8}".format("method", "seconds", "rooms/sec", "speedup"))
+    print("{:>16} {:>10.3f} {:>12.0f} {:>7.1f}x".format("per-room", reference_time, len(battles) / reference_time,
+                                                         1.0))
+    mismatched = False
+    for batch_size in args.batch_sizes:
+        elapsed, state = _time(conn, lambda b: queuing.push_battles_for_processing(b, batch_size), battles,
+                               args.repeat)
+        if state != reference_state:
+            mismatched = True
+        print("{:>16} {:>10.3f} {:>12.0f} {:>7.1f}x".format("batch of {}".format(batch_size), elapsed,
+                                                             len(battles) / elapsed, reference_time / elapsed))
+    if mismatched:
+        sys.exit("Batched enqueuing left redis in a different state to per-room enqueuing.")
+
+
+if __name__ == '__main__':
+    main()
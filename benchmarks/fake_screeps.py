@@ -0,0 +1,282 @@
+"""
+A local stand-in for the parts of screeps.com warreport talks to, serving a synthetic world of battles: the pvp API,
+room history segments, user lookups and alliances.js.
+
+The world's tick clock starts when the server does. Each room has one battle, starting at a random tick within the
+first `spread` seconds, between two players. A room's history segments are generated on request from its battle, and
+only become available `appear_delay` seconds after their last tick (a fraction `missing_rate` never do). Every
+request waits `latency` seconds before being answered.
+
+Point warreport at it by setting `screeps_url` and `alliances_url` in config.json to the URLs printed on startup.
+Run from the project directory with `python -m benchmarks.fake_screeps`; see benchmarks/end_to_end.py for using it
+to load test the whole application.
+"""
+import argparse
+import hashlib
+import json
+import random
+import socketserver
+import threading
+import time
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# User ID 2 is the invader user: its creeps don't count as players.
+_INVADER = "2"
+
+Battle = namedtuple("Battle", ["room", "start", "end", "owner", "attacker", "creeps", "controller_id"])
+# A creep in a battle: present from spawn to despawn, and attacking every tick of the battle if hostile.
+Creep = namedtuple("Creep", ["id", "user", "body", "hostile"])
+
+# Creep bodies used: (body, hostile).
+_ATTACKER_BODIES = [
+    (['tough', 'tough', 'attack', 'attack', 'move', 'move', 'move', 'move'], True),
+    (['ranged_attack', 'ranged_attack', 'move', 'move'], True),
+    (['heal', 'heal', 'move', 'move'], False),
+]
+_DEFENDER_BODIES = [
+    (['attack', 'attack', 'move'], True),
+    (['work', 'carry', 'move'], False),
+]
+
+
+def _object_id(*parts):
+    return hashlib.sha1(":".join(str(part) for part in parts).encode()).hexdigest()[:24]
+
+
+def _room_name(index):
+    return "W{}N{}".format(index % 50 + 1, index // 50 + 1)
+
+
+class World:
+    def __init__(self, rooms=100, spread=60.0, battle_ticks=(20, 200), creeps=(2, 10), players=40, structures=100,
+                 tick_seconds=0.2, appear_delay=2.0, missing_rate=0.0, latency=0.02, seed=1, start_tick=20000000):
+        self.tick_seconds = tick_seconds
+        self.appear_delay = appear_delay
+        self.missing_rate = missing_rate
+        self.latency = latency
+        self.seed = seed
+        self.start_tick = start_tick
+        self.structures = structures
+        self.started = time.time()
+
+        rng = random.Random(seed)
+        self.users = {_object_id(seed, "user", index): "player{}".format(index) for index in range(players)}
+        user_ids = sorted(self.users)
+        self.battles = {}
+        for index in range(rooms):
+            room = _room_name(index)
+            # Battles start a little after the server does, so that their earliest segments can always be found.
+            start = start_tick + 100 + int(rng.uniform(0, spread) / tick_seconds)
+            end = start + rng.randint(*battle_ticks) - 1
+            owner, attacker = rng.sample(user_ids, 2)
+            battle_creeps = []
+            for side, user, bodies in (("attacker", attacker, _ATTACKER_BODIES),
+                                       ("defender", owner, _DEFENDER_BODIES)):
+                count = rng.randint(*creeps) if side == "attacker" else rng.randint(1, max(1, creeps[1] // 2))
+                for creep_index in range(count):
+                    # The first creep on each side is always a military one, so that every battle is worth reporting.
+                    body, hostile = bodies[0] if creep_index == 0 else rng.choice(bodies)
+                    battle_creeps.append(Creep(_object_id(seed, room, side, creep_index), user, body, hostile))
+            if rng.random() < 0.2:
+                battle_creeps.append(Creep(_object_id(seed, room, "invader"), _INVADER, ['attack', 'move'], True))
+            self.battles[room] = Battle(room, start, end, owner, attacker, battle_creeps,
+                                        _object_id(seed, room, "controller"))
+
+        self._lock = threading.Lock()
+        # room -> the unix time the pvp API first returned it.
+        self.discovered_at = {}
+        self.counts = {
+            'pvp': 0,
+            'segments': 0,
+            'segments_not_found': 0,
+            'usernames': 0,
+            'alliances': 0,
+        }
+
+    def tick(self, at=None):
+        at = time.time() if at is None else at
+        return self.start_tick + int((at - self.started) / self.tick_seconds)
+
+    def time_of_tick(self, tick):
+        return self.started + (tick - self.start_tick) * self.tick_seconds
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def pvp(self, query):
+        now = self.tick()
+        if 'start' in query:
+            since = int(query['start'][0])
+        else:
+            since = now - int(query.get('interval', ['100'])[0])
+        rooms = []
+        at = time.time()
+        with self._lock:
+            self.counts['pvp'] += 1
+            for battle in self.battles.values():
+                last_pvp = min(now, battle.end)
+                if battle.start <= now and last_pvp > since:
+                    rooms.append({'_id': battle.room, 'lastPvpTime': last_pvp})
+                    self.discovered_at.setdefault(battle.room, at)
+        return 200, {'ok': 1, 'time': now, 'rooms': rooms}
+
+    def is_missing(self, room, tick):
+        """
+        :return: Whether the given segment is one of those which is never generated
+        """
+        digest = hashlib.sha1("{}:{}:{}".format(self.seed, room, tick).encode()).digest()
+        return int.from_bytes(digest[:4], 'big') / 2 ** 32 < self.missing_rate
+
+    def history(self, room, tick):
+        battle = self.battles.get(room)
+        if battle is None or tick % 20 or time.time() < self.time_of_tick(tick + 20) + self.appear_delay \
+                or self.is_missing(room, tick):
+            self._count('segments_not_found')
+            return 404, None
+        self._count('segments')
+        return 200, self.segment(battle, tick)
+
+    def segment(self, battle, first_tick):
+        """
+        Builds a full history segment of the given battle's room, in the same shape as the server's.
+        """
+        spawn = battle.start - 10
+        despawn = battle.end + 10
+        ticks = {}
+        for tick in range(first_tick, first_tick + 20):
+            objects = {}
+            if tick == first_tick:
+                objects[battle.controller_id] = {'type': 'controller', 'user': battle.owner, 'level': 6, 'x': 20,
+                                                 'y': 20, 'room': battle.room}
+                for index in range(self.structures):
+                    objects[_object_id(self.seed, battle.room, "structure", index)] = {
+                        'type': 'road' if index % 3 else 'constructedWall', 'x': index % 50, 'y': index // 50 + 1,
+                        'room': battle.room, 'hits': 5000, 'hitsMax': 5000,
+                    }
+            if spawn <= tick <= despawn:
+                for index, creep in enumerate(battle.creeps):
+                    update = {'x': 10 + (tick + index) % 30, 'y': 10 + index % 30}
+                    if tick == first_tick or tick == spawn:
+                        update.update({'type': 'creep', 'user': creep.user, 'room': battle.room, 'hits': 100,
+                                       'hitsMax': 100, 'body': [{'type': part, 'hits': 100} for part in creep.body]})
+                    if creep.hostile and battle.start <= tick <= battle.end:
+                        update['actionLog'] = {'attack': {'x': 25, 'y': 25}}
+                    objects[creep.id] = update
+            ticks[str(tick)] = objects
+        return {'timestamp': int(self.time_of_tick(first_tick) * 1000), 'room': battle.room, 'base': first_tick,
+                'ticks': ticks}
+
+    def find_user(self, query):
+        self._count('usernames')
+        user_id = query.get('id', [None])[0]
+        if user_id not in self.users:
+            return 200, {'error': 'user not found'}
+        return 200, {'ok': 1, 'user': {'_id': user_id, 'username': self.users[user_id]}}
+
+    def alliances(self):
+        self._count('alliances')
+        names = sorted(self.users.values())
+        return 200, {"A{}".format(index // 5): {"name": "Alliance {}".format(index // 5),
+                                                "members": names[index:index + 5]}
+                     for index in range(0, len(names), 5)}
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts, discovered=len(self.discovered_at))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        world = self.server.world
+        if world.latency:
+            time.sleep(world.latency)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = url.path.strip('/').split('/')
+        if url.path == '/api/experimental/pvp':
+            status, body = world.pvp(query)
+        elif url.path == '/api/user/find':
+            status, body = world.find_user(query)
+        elif url.path == '/alliances.js':
+            status, body = world.alliances()
+        elif len(parts) == 3 and parts[0] == 'room-history' and parts[2].endswith('.json') \
+                and parts[2][:-len('.json')].isdigit():
+            status, body = world.history(parts[1], int(parts[2][:-len('.json')]))
+        else:
+            status, body = 404, None
+        content = b'Not Found' if body is None else json.dumps(body, separators=(',', ':')).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json' if body is not None else 'text/plain')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(world, host="127.0.0.1", port=0):
+    """
+    Starts serving the given world in a background thread.
+    :type world: World
+    :return: The server, and the URL screeps_url should be set to
+    """
+    server = _Server((host, port), _Handler)
+    server.world = world
+    thread = threading.Thread(target=server.serve_forever, name="fake-screeps", daemon=True)
+    thread.start()
+    return server, "http://{}:{}/".format(host, server.server_address[1])
+
+
+def add_world_arguments(parser):
+    parser.add_argument("--rooms", type=int, default=100, help="battles to generate, each in its own room")
+    parser.add_argument("--spread", type=float, default=60, help="seconds over which battles start")
+    parser.add_argument("--battle-ticks", type=int, nargs=2, default=(20, 200), metavar=("MIN", "MAX"),
+                        help="range of battle lengths, in ticks")
+    parser.add_argument("--creeps", type=int, nargs=2, default=(2, 10), metavar=("MIN", "MAX"),
+                        help="range of attacking creeps in each battle")
+    parser.add_argument("--structures", type=int, default=100, help="structures in each room, to pad segments")
+    parser.add_argument("--tick-seconds", type=float, default=0.2, help="seconds each server tick takes")
+    parser.add_argument("--appear-delay", type=float, default=2, help="seconds after its last tick each history "
+                                                                      "segment becomes available")
+    parser.add_argument("--missing-rate", type=float, default=0, help="fraction of history segments which are "
+                                                                      "never available")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds taken to answer each request")
+    parser.add_argument("--seed", type=int, default=1)
+
+
+def world_from_arguments(args):
+    return World(rooms=args.rooms, spread=args.spread, battle_ticks=tuple(args.battle_ticks),
+                 creeps=tuple(args.creeps), structures=args.structures, tick_seconds=args.tick_seconds,
+                 appear_delay=args.appear_delay, missing_rate=args.missing_rate, latency=args.latency, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves a local stand-in for the parts of screeps.com "
+                                                 "warreport talks to.")
+    add_world_arguments(parser)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=21025)
+    args = parser.parse_args()
+
+    server, url = serve(world_from_arguments(args), args.host, args.port)
+    print("Serving on {} (screeps_url: {}, alliances_url: {}alliances.js)".format(url, url, url))
+    try:
+        while True:
+            time.sleep(10)
+            print(server.world.stats())
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
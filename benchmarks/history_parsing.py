@@ -0,0 +1,89 @@
+"""
+Compares decoding room history segments in full (what requests' Response.json() did) against
+history_parser.parse_history, on synthetic segments the size of a busy room.
+
+For each, reports CPU time to decode and then analyze a segment with modify_data_with_history, peak memory while
+decoding, and the memory a decoded segment holds on to while it waits to be analyzed. Also checks that the analysis
+gives the same results either way.
+
+Run from the project directory with `python -m benchmarks.history_parsing`.
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+from benchmarks.synthetic import generate_segments
+from warreport import history_parser, screeps_info
+
+
+def _new_battle_data(first_tick):
+    return {
+        'player_creep_counts': {},
+        'creeps_found': set(),
+        'owner': None,
+        'rcl': 0,
+        'earliest_hostilities_detected': first_tick,
+        'latest_hostilities_detected': first_tick,
+    }
+
+
+def _measure(decode, raw_segments, first_tick):
+    decode_time = 0
+    analyze_time = 0
+    battle_data = _new_battle_data(first_tick)
+    decisions = []
+    for raw in raw_segments:
+        start = time.perf_counter()
+        segment = decode(raw)
+        decoded = time.perf_counter()
+        decisions.append(screeps_info.modify_data_with_history(battle_data, segment, checking='latest'))
+        analyze_time += time.perf_counter() - decoded
+        decode_time += decoded - start
+
+    peak = 0
+    retained = 0
+    for raw in raw_segments:
+        # Tracing from scratch for each segment, as tracemalloc.reset_peak() is only in Python 3.9+.
+        tracemalloc.start()
+        segment = decode(raw)
+        current, segment_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peak = max(peak, segment_peak)
+        retained = max(retained, current)
+        del segment
+    count = len(raw_segments)
+    return decode_time / count, analyze_time / count, peak, retained, (battle_data, decisions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares decoding room history segments in full against "
+                                                 "history_parser.parse_history.")
+    parser.add_argument("--creeps", type=int, default=300)
+    parser.add_argument("--structures", type=int, default=1500)
+    parser.add_argument("--ticks", type=int, default=400)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    screeps_info.usernames_from_ids = lambda user_ids: {user_id: user_id for user_id in user_ids}
+    segments = generate_segments(creep_count=args.creeps, ticks=args.ticks, structures=args.structures, seed=args.seed)
+    raw_segments = [json.dumps(segment).encode() for segment in segments]
+    first_tick = segments[0]['base']
+    print("{} segments, {:.0f} KiB average".format(len(raw_segments),
+                                                   sum(map(len, raw_segments)) / len(raw_segments) / 1024))
+    print("{:<16} {:>12} {:>12} {:>12} {:>14}".format("", "decode ms", "analyze ms", "peak KiB", "retained KiB"))
+
+    results = []
+    for name, decode in (("full decode", lambda raw: json.loads(raw.decode())),
+                         ("parse_history", history_parser.parse_history)):
+        decode_time, analyze_time, peak, retained, result = _measure(decode, raw_segments, first_tick)
+        print("{:<16} {:>12.2f} {:>12.2f} {:>12.0f} {:>14.0f}".format(
+            name, decode_time * 1000, analyze_time * 1000, peak / 1024, retained / 1024))
+        results.append(result)
+
+    assert results[0] == results[1], "compact history gave different results"
+    print("modify_data_with_history results identical.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Compares finding each segment's earliest and latest hostile ticks by walking every (tick, object) pair of a full
+segment, as modify_data_with_history used to, against history_parser.hostility_window on the compact segment's columns.
+
+Also checks that both give the same windows. modify_data_with_history's earliest/latest/continue decisions only
+depend on these windows and each segment's first and last tick; benchmarks.history_parsing checks those end to end.
+
+Run from the project directory with `python -m benchmarks.hostility_windows`.
+"""
+import argparse
+import json
+import time
+
+from benchmarks.synthetic import generate_segments
+from warreport import history_parser
+
+
+def reference_hostility_window(full_segment):
+    earliest_hostilities_this_section = None
+    latest_hostilities_this_section = None
+    for tick, tick_data in full_segment['ticks'].items():
+        tick = int(tick)
+        hostilities_this_tick = False
+        bother_finding_hostilities = earliest_hostilities_this_section is None \
+                                     or latest_hostilities_this_section is None \
+                                     or tick < earliest_hostilities_this_section \
+                                     or tick > latest_hostilities_this_section
+        for creep_id, obj_data in tick_data.items():
+            if not obj_data:
+                continue
+            if bother_finding_hostilities and not hostilities_this_tick:
+                action_log = obj_data.get('actionLog')
+                if action_log and (action_log.get('attack') or action_log.get('rangedAttack')
+                                   or action_log.get('rangedMassAttack')
+                                   or action_log.get('heal') or action_log.get('rangedHeal')):
+                    hostilities_this_tick = True
+        if hostilities_this_tick:
+            if earliest_hostilities_this_section is None or tick < earliest_hostilities_this_section:
+                earliest_hostilities_this_section = tick
+            if latest_hostilities_this_section is None or tick > latest_hostilities_this_section:
+                latest_hostilities_this_section = tick
+    return earliest_hostilities_this_section, latest_hostilities_this_section
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares finding hostile ticks by walking full segments against "
+                                                 "history_parser.hostility_window.")
+    parser.add_argument("--creeps", type=int, default=1500)
+    parser.add_argument("--structures", type=int, default=1500)
+    parser.add_argument("--ticks", type=int, default=400)
+    parser.add_argument("--hostile-fraction", type=float, default=0.02,
+                        help="chance of each creep acting hostile each tick: low values mean long scans per tick")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    segments = generate_segments(creep_count=args.creeps, ticks=args.ticks, structures=args.structures,
+                                 hostile_fraction=args.hostile_fraction, seed=args.seed)
+    full_segments = [json.loads(json.dumps(segment)) for segment in segments]
+    compact_segments = [history_parser.compact_segment(segment['ticks']) for segment in full_segments]
+    print("{} segments, {} objects per segment".format(
+        len(segments), sum(len(objects) for segment in segments for objects in segment['ticks'].values())
+        // len(segments)))
+
+    start = time.perf_counter()
+    reference_windows = [reference_hostility_window(segment) for segment in full_segments]
+    reference_time = time.perf_counter() - start
+    start = time.perf_counter()
+    columnar_windows = [history_parser.hostility_window(segment) for segment in compact_segments]
+    columnar_time = time.perf_counter() - start
+
+    print("{:<20} {:>10.3f} ms/segment".format("object walk", reference_time / len(segments) * 1000))
+    print("{:<20} {:>10.3f} ms/segment ({:.0f}x faster)".format(
+        "columnar window", columnar_time / len(segments) * 1000, reference_time / columnar_time))
+
+    assert reference_windows == columnar_windows, "hostility windows differ"
+    print("Hostility windows identical.")
+
+
+if __name__ == '__main__':
+    main()
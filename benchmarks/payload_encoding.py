@@ -0,0 +1,123 @@
+"""
+Compares warreport.encoding against JSON for the payloads we store in redis: payload size, and encode and decode speed.
+
+Run from the project directory with `python -m benchmarks.payload_encoding`.
+"""
+import argparse
+import random
+import timeit
+
+try:
+    import rapidjson as json
+except ImportError:
+    import json
+
+from warreport import constants, encoding
+
+_ROLES = [constants.ranged_attacker, constants.melee_attacker, constants.healer, constants.dismantling_attacker,
+          constants.general_attacker, constants.tough_attacker, constants.work_and_carry_attacker, constants.civilian,
+          constants.scout]
+
+
+def _object_id(rng):
+    return '{:024x}'.format(rng.getrandbits(96))
+
+
+def generate_finished_battle(rng, players):
+    """
+    A finished battle as it's queued for reporting.
+    """
+    usernames = ['player{}'.format(rng.randrange(100000)) for _ in range(players)]
+    counts = {username: {role: rng.randrange(1, 40) for role in rng.sample(_ROLES, rng.randrange(1, 6))}
+              for username in usernames}
+    earliest = rng.randrange(10000000, 20000000)
+    duration = rng.randrange(1, 300)
+    return {
+        'room': 'E{}N{}'.format(rng.randrange(60), rng.randrange(60)),
+        'player_creep_counts': counts,
+        'alliances': {username: rng.choice([None, 'Some Alliance', 'Another Alliance']) for username in usernames},
+        'owner': usernames[0],
+        'rcl': rng.randrange(9),
+        'earliest_hostilities_detected': earliest,
+        'earliest_hostilities_collided': False,
+        'latest_hostilities_detected': earliest + duration - 1,
+        'battle_still_ongoing': rng.random() < 0.2,
+        'duration': duration,
+    }
+
+
+def generate_ongoing_battle(rng, players, creeps):
+    """
+    An ongoing battle as it was stored in one piece, creeps_found and all.
+    """
+    data = generate_finished_battle(rng, players)
+    user_ids = [_object_id(rng) for _ in range(players)]
+    data['usernames'] = dict(zip(user_ids, data.pop('alliances')))
+    for key in ('room', 'duration', 'battle_still_ongoing'):
+        del data[key]
+    data['max_tick_checked'] = data['latest_hostilities_detected'] - data['latest_hostilities_detected'] % 20
+    data['stop_checking_at'] = data['max_tick_checked'] + 120
+    data['creeps_found'] = {_object_id(rng) for _ in range(creeps)}
+    return data
+
+
+def _json_encode(value):
+    if isinstance(value.get('creeps_found'), set):
+        value = dict(value, creeps_found=list(value['creeps_found']))
+    return json.dumps(value).encode()
+
+
+def _json_decode(raw):
+    return json.loads(raw.decode())
+
+
+def _measure(name, payloads, number):
+    json_payloads = [_json_encode(payload) for payload in payloads]
+    encoded_payloads = [encoding.encode(payload) for payload in payloads]
+    for payload, encoded in zip(payloads, encoded_payloads):
+        assert encoding.decode(encoded) == payload
+
+    json_size = sum(len(raw) for raw in json_payloads) / len(payloads)
+    encoded_size = sum(len(raw) for raw in encoded_payloads) / len(payloads)
+
+    def per_payload_us(function, values):
+        seconds = min(timeit.repeat(lambda: [function(value) for value in values], number=number, repeat=3))
+        return seconds / number / len(values) * 1e6
+
+    rows = [
+        ("json", json_size, per_payload_us(_json_encode, payloads), per_payload_us(_json_decode, json_payloads)),
+        ("binary", encoded_size, per_payload_us(encoding.encode, payloads),
+         per_payload_us(encoding.decode, encoded_payloads)),
+    ]
+    print(name)
+    print("{:>10} {:>12} {:>12} {:>12}".format("format", "bytes", "encode us", "decode us"))
+    for row in rows:
+        print("{:>10} {:>12.0f} {:>12.1f} {:>12.1f}".format(*row))
+    print("{:>10} {:>11.0f}% smaller".format("", (1 - encoded_size / json_size) * 100))
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares warreport.encoding against JSON for the payloads "
+                                                 "we store in redis.")
+    parser.add_argument("--payloads", type=int, default=200)
+    parser.add_argument("--players", type=int, default=3)
+    parser.add_argument("--creeps", type=int, default=500, help="creeps found per ongoing battle")
+    parser.add_argument("--number", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    _measure("Finished battles (reporting queue)",
+             [generate_finished_battle(rng, args.players) for _ in range(args.payloads)], args.number)
+    _measure("Ongoing battles with {} creeps found".format(args.creeps),
+             [generate_ongoing_battle(rng, args.players, args.creeps) for _ in range(args.payloads // 10 or 1)],
+             args.number)
+
+    creep_ids = [_object_id(rng) for _ in range(args.creeps)]
+    print("Creep ID set members: {} bytes as hex, {} bytes packed".format(
+        sum(len(creep_id) for creep_id in creep_ids), sum(len(encoding.pack_object_id(c)) for c in creep_ids)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""
+Measures room processing throughput of battle_monitor.process_battles as the number of room workers grows.
+
+Redis and the screeps.com API are replaced with in-memory stand-ins which sleep to simulate network latency, so this
+only measures how well the workers overlap their waiting, not the real services.
+
+Run from the project directory with `python -m benchmarks.processing_workers`.
+"""
+import argparse
+import asyncio
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from warreport import battle_monitor, screeps_info
+
+
+class _FakeSchedule:
+    """
+    In-memory processing schedule, behaving like the sorted set used by queuing.get_next_room_to_process.
+    """
+
+    def __init__(self, room_count, segments_per_room, not_ready_fraction, latency, seed):
+        rng = random.Random(seed)
+        now = time.time()
+        self.due = {"W{}N{}".format(i // 100, i % 100): now for i in range(room_count)}
+        self.segments_left = {room: segments_per_room for room in self.due}
+        self.not_ready_left = {room: 1 if rng.random() < not_ready_fraction else 0 for room in self.due}
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.submitted = 0
+        self.room_count = room_count
+
+    def get_next_room_to_process(self, partition=0):
+        with self.lock:
+            if not self.due:
+                return None, None, None
+            now = time.time()
+            room_name = min(self.due, key=self.due.get)
+            if self.due[room_name] > now:
+                return None, None, self.due[room_name] - now
+            self.due[room_name] = now + 600
+            return room_name, "token", None
+
+    def reschedule_room(self, room_name, lease_token, delay):
+        with self.lock:
+            if room_name in self.due:
+                self.due[room_name] = time.time() + delay
+
+    def work_on_room_data(self, room_name, current_tick, lease_token):
+        with self.lock:
+            not_ready = self.not_ready_left[room_name]
+            if not_ready:
+                self.not_ready_left[room_name] -= 1
+        if not_ready:
+            # One 404 fetch, then back into the schedule.
+            time.sleep(self.latency)
+            return screeps_info.HistoryNotReady(current_tick)
+        # One fetch per segment, then the final 404.
+        time.sleep(self.latency * (self.segments_left[room_name] + 1))
+        return {'latest_hostilities_detected': current_tick}
+
+    def submit_processed_battle(self, room_name, lease_token, battle_data):
+        with self.lock:
+            del self.due[room_name]
+            self.submitted += 1
+            if self.submitted >= self.room_count:
+                self.finished.set()
+
+
+class _FakeRedisPool:
+    @asyncio.coroutine
+    def execute(self, *args, idempotent=False):
+        return b"1000"
+
+
+def _as_coroutine(function):
+    """
+    Wraps one of the fake's methods to stand in for the corresponding queuing coroutine, which takes the loop first.
+    """
+    @asyncio.coroutine
+    def coroutine(loop, *args):
+        return function(*args)
+    return coroutine
+
+
+def run_once(workers, room_count, segments_per_room, not_ready_fraction, latency, seed):
+    fake = _FakeSchedule(room_count, segments_per_room, not_ready_fraction, latency, seed)
+    battle_monitor.PROCESSING_WORKERS = workers
+    battle_monitor.async_redis.get_pool = lambda loop: _FakeRedisPool()
+    battle_monitor.ROOM_NOT_READY_DELAY = latency * 10
+    battle_monitor.IDLE_POLL_INTERVAL = latency
+    battle_monitor.queuing.get_next_room_to_process_async = _as_coroutine(fake.get_next_room_to_process)
+    battle_monitor.queuing.reschedule_room_async = _as_coroutine(fake.reschedule_room)
+    battle_monitor.queuing.submit_processed_battle_async = _as_coroutine(fake.submit_processed_battle)
+    battle_monitor.screeps_info.work_on_room_data = fake.work_on_room_data
+    battle_monitor.screeps_info.refresh_alliances = lambda: None
+    battle_monitor.history_timing.refresh_clock_async = _as_coroutine(lambda: None)
+
+    loop = asyncio.new_event_loop()
+    executor = ThreadPoolExecutor(max_workers=workers + 4)
+    loop.set_default_executor(executor)
+    task = loop.create_task(battle_monitor.process_battles(loop))
+
+    start = time.perf_counter()
+    loop.run_until_complete(loop.run_in_executor(None, fake.finished.wait))
+    elapsed = time.perf_counter() - start
+
+    task.cancel()
+    try:
+        loop.run_until_complete(task)
+    except asyncio.CancelledError:
+        pass
+    executor.shutdown(wait=True)
+    loop.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures room processing throughput as the number of room "
+                                                 "workers grows.")
+    parser.add_argument("--rooms", type=int, default=200)
+    parser.add_argument("--segments", type=int, default=5, help="history segments fetched per room")
+    parser.add_argument("--not-ready", type=float, default=0.3, help="fraction of rooms not ready on first look")
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds per simulated history fetch")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print("{:>8} {:>10} {:>12} {:>8}".format("workers", "seconds", "rooms/sec", "speedup"))
+    baseline = None
+    for workers in args.workers:
+        elapsed = run_once(workers, args.rooms, args.segments, args.not_ready, args.latency, args.seed)
+        rate = args.rooms / elapsed
+        if baseline is None:
+            baseline = rate
+        print("{:>8} {:>10.2f} {:>12.1f} {:>7.1f}x".format(workers, elapsed, rate, rate / baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Load tests the leased processing schedule with several consumer processes working on the same rooms at once.
+
+Consumers take rooms with queuing.get_next_room_to_process, sleep to simulate working on them, and then either submit
+them, reschedule them as not ready, or abandon them without a word as if they had crashed. Abandoned rooms are picked
+up again once their lease runs out. At the end, every room must have been submitted exactly once.
+
+This needs a real redis server, and uses a whole database of it: by default database 15 on localhost, which must be
+empty. Run from the project directory with `python -m benchmarks.queue_leases`.
+"""
+import argparse
+import collections
+import multiprocessing
+import random
+import sys
+import time
+
+import redis
+
+from warreport import queuing
+
+
+def _consume(consumer_id, args, results):
+    queuing.redis_conn = redis.StrictRedis(host=args.host, port=args.port, db=args.redis_db)
+    queuing.ROOM_LEASE_SECONDS = args.lease
+    rng = random.Random(args.seed * 1000 + consumer_id)
+    submitted = []
+    lost = 0
+    abandoned = 0
+    idle_since = None
+    while True:
+        room_name, lease_token, wait = queuing.get_next_room_to_process()
+        if room_name is None:
+            if wait is None:
+                break
+            if idle_since is None:
+                idle_since = time.time()
+            time.sleep(min(wait, 0.01))
+            continue
+        idle_since = None
+        time.sleep(args.work)
+        roll = rng.random()
+        if roll < args.crash:
+            abandoned += 1
+        elif roll < args.crash + args.not_ready:
+            if not queuing.reschedule_room(room_name, lease_token, 0):
+                lost += 1
+        elif queuing.submit_processed_battle(room_name, lease_token, {'latest_hostilities_detected': 1}):
+            submitted.append(room_name)
+        else:
+            lost += 1
+    results.put((submitted, lost, abandoned))
+
+
+def run_once(consumers, args, conn):
+    conn.flushdb()
+    queuing.redis_conn = conn
+    rooms = ["W{}N{}".format(i // 100, i % 100) for i in range(args.rooms)]
+    queuing.push_battles_for_processing((room, 1000) for room in rooms)
+
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=_consume, args=(i, args, results)) for i in range(consumers)]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    outcomes = [results.get() for _ in processes]
+    elapsed = time.perf_counter() - start
+    for process in processes:
+        process.join()
+
+    counts = collections.Counter(room for submitted, _, _ in outcomes for room in submitted)
+    duplicates = sum(1 for count in counts.values() if count > 1)
+    missing = len(set(rooms) - set(counts))
+    lost = sum(lost for _, lost, _ in outcomes)
+    abandoned = sum(abandoned for _, _, abandoned in outcomes)
+    conn.flushdb()
+    return elapsed, duplicates, missing, lost, abandoned
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load tests the leased processing schedule with several "
+                                                 "consumer processes.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--redis-db", type=int, default=15, help="redis database to use: must be empty")
+    parser.add_argument("--rooms", type=int, default=1000)
+    parser.add_argument("--work", type=float, default=0.005, help="seconds spent working on each room")
+    parser.add_argument("--lease", type=float, default=1, help="seconds each room is leased for")
+    parser.add_argument("--crash", type=float, default=0.02, help="fraction of rooms abandoned mid-lease")
+    parser.add_argument("--not-ready", type=float, default=0.2, help="fraction of rooms rescheduled as not ready")
+    parser.add_argument("--consumers", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    conn = redis.StrictRedis(host=args.host, port=args.port, db=args.redis_db)
+    if conn.dbsize():
+        sys.exit("Redis database {} isn't empty: refusing to run in it.".format(args.redis_db))
+
+    print("{:>9} {:>9} {:>11} {:>10} {:>9} {:>6} {:>10}".format(
+        "consumers", "seconds", "rooms/sec", "duplicate", "missing", "lost", "abandoned"))
+    failed = False
+    for consumers in args.consumers:
+        elapsed, duplicates, missing, lost, abandoned = run_once(consumers, args, conn)
+        failed = failed or duplicates or missing
+        print("{:>9} {:>9.2f} {:>11.1f} {:>10} {:>9} {:>6} {:>10}".format(
+            consumers, elapsed, args.rooms / elapsed, duplicates, missing, lost, abandoned))
+    if failed:
+        sys.exit("Some rooms were submitted more than once, or never.")
+
+
+if __name__ == '__main__':
+    main()
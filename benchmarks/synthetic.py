@@ -0,0 +1,94 @@
+"""
+Seeded generators of synthetic room history, shaped like screeps.com `room-history/{room}/{tick}.json` segments.
+
+The first tick of every segment holds the full state of every object in the room, and later ticks only hold the
+fields which changed, which is how the real history files are laid out.
+"""
+import random
+
+BODY_TEMPLATES = [
+    ['tough'] * 5 + ['move'] * 10 + ['ranged_attack'] * 5,
+    ['move'] * 10 + ['attack'] * 10,
+    ['move'] * 8 + ['heal'] * 8,
+    ['work'] * 15 + ['move'] * 10,
+    ['work'] * 2 + ['carry'] * 4 + ['move'] * 3,
+    ['move'] * 5 + ['ranged_attack'] * 3 + ['heal'] * 2,
+    ['tough'] * 10 + ['move'] * 10,
+    ['move'],
+    ['claim', 'claim', 'move', 'move'],
+    ['work', 'carry', 'move', 'attack'],
+]
+
+_HOSTILE_ACTIONS = ['attack', 'rangedAttack', 'rangedMassAttack', 'heal', 'rangedHeal']
+_PEACEFUL_ACTIONS = ['harvest', 'build', 'repair', 'upgradeController']
+
+
+def _object_id(rng):
+    return '{:024x}'.format(rng.getrandbits(96))
+
+
+def generate_segments(creep_count=500, ticks=2000, players=3, structures=200, start_tick=1000000,
+                      hostile_fraction=0.3, seed=0):
+    """
+    Generates one battle's worth of history.
+
+    :param creep_count: number of distinct creeps appearing over the whole battle
+    :param ticks: battle length, rounded down to a multiple of 20
+    :param players: number of players owning creeps (the first one also owns the room)
+    :param structures: number of roads/walls/etc in the room, which are included but irrelevant to the analysis
+    :param start_tick: first tick, must be an interval of 20
+    :param hostile_fraction: chance of each creep doing something hostile on each tick
+    :param seed: random seed
+    :return: A list of history segment dicts, in tick order
+    """
+    rng = random.Random(seed)
+    user_ids = ['{:024x}'.format(rng.getrandbits(96)) for _ in range(players)]
+    creeps = []
+    for _ in range(creep_count):
+        born = start_tick + rng.randrange(ticks)
+        creeps.append({
+            'id': _object_id(rng),
+            'user': rng.choice(user_ids),
+            'body': [{'type': part, 'hits': 100} for part in rng.choice(BODY_TEMPLATES)],
+            'born': born,
+            'dies': born + rng.randrange(50, 1500),
+        })
+    static_objects = {}
+    for _ in range(structures):
+        static_objects[_object_id(rng)] = {
+            'type': rng.choice(['road', 'constructedWall', 'rampart', 'extension']),
+            'x': rng.randrange(50), 'y': rng.randrange(50), 'hits': rng.randrange(1, 300000), 'room': 'W1N1',
+        }
+    controller_id = _object_id(rng)
+    static_objects[controller_id] = {'type': 'controller', 'user': user_ids[0], 'level': 7, 'x': 25, 'y': 25,
+                                     'room': 'W1N1'}
+
+    segments = []
+    for segment_tick in range(start_tick, start_tick + ticks - ticks % 20, 20):
+        segment_ticks = {}
+        for tick in range(segment_tick, segment_tick + 20):
+            objects = {}
+            first = tick == segment_tick
+            if first:
+                objects.update((obj_id, dict(obj)) for obj_id, obj in static_objects.items())
+            for creep in creeps:
+                if not creep['born'] <= tick < creep['dies']:
+                    continue
+                if first or tick == creep['born']:
+                    obj = {
+                        'type': 'creep', 'user': creep['user'], 'body': creep['body'], 'name': creep['id'][:8],
+                        'x': rng.randrange(50), 'y': rng.randrange(50), 'hits': 100 * len(creep['body']),
+                    }
+                else:
+                    obj = {'x': rng.randrange(50), 'y': rng.randrange(50)}
+                if rng.random() < hostile_fraction:
+                    obj['actionLog'] = {rng.choice(_HOSTILE_ACTIONS): {'x': rng.randrange(50), 'y': rng.randrange(50)}}
+                elif rng.random() < 0.2:
+                    obj['actionLog'] = {rng.choice(_PEACEFUL_ACTIONS): {'x': rng.randrange(50),
+                                                                        'y': rng.randrange(50)}}
+                objects[creep['id']] = obj
+            segment_ticks[str(tick)] = objects
+        segments.append({'timestamp': 1480000000000 + segment_tick * 3000, 'room': 'W1N1', 'base': segment_tick,
+                         'ticks': segment_ticks})
+    return segments
+
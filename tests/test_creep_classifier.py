@@ -0,0 +1,86 @@
+import random
+
+import pytest
+
+from warreport import screeps_info
+from warreport.constants import scout, civilian, general_attacker, dismantling_attacker, healer, melee_attacker, \
+    ranged_attacker, tough_attacker, work_and_carry_attacker
+
+_ALL_PARTS = ['move', 'work', 'carry', 'attack', 'ranged_attack', 'heal', 'claim', 'tough']
+
+
+def reference_identify_creep(creep_obj):
+    """
+    identify_creep as it was before it was table driven, kept as the definition of the rules.
+    """
+    body = creep_obj['body']
+
+    def has(type):
+        return any(x.get('type') == type for x in body)
+
+    def count(type):
+        return sum(x.get('type') == type for x in body)
+
+    ranged = has('ranged_attack')
+    heal = has('heal')
+    attack = has('attack')
+    work = has('work')
+    carry = has('carry')
+    claim = has('claim')
+    if ranged and not attack:
+        return ranged_attacker
+    elif attack and not ranged:
+        return melee_attacker
+    elif heal and not ranged and not attack:
+        return healer
+    elif work and not carry and count('work') > 8:
+        return dismantling_attacker
+    elif (ranged or heal or attack) and not carry:
+        return general_attacker
+    elif all(x.get('type') == 'move' or x.get('type') == 'tough' for x in body):
+        return tough_attacker
+    elif (work or carry or claim) and not heal and not ranged and not attack:
+        return civilian
+    elif (work or carry or claim) and (heal or ranged or attack):
+        return work_and_carry_attacker
+    elif all(x.get('type') == 'move' for x in body):
+        return scout
+    else:
+        return ''.join(x['type'][0].upper() for x in body)
+
+
+def _random_body(rng):
+    # Bias towards few distinct part types, so that every rule gets exercised, and sometimes include a part type the
+    # rules don't know about.
+    palette = rng.sample(_ALL_PARTS, rng.randint(1, 4))
+    if rng.random() < 0.05:
+        palette.append('unknown')
+    return [{'type': rng.choice(palette), 'hits': 100} for _ in range(rng.randint(0, 50))]
+
+
+def _body(*part_types):
+    return {'body': [{'type': part_type, 'hits': 100} for part_type in part_types]}
+
+
+@pytest.mark.parametrize('creep', [
+    _body(),
+    _body('move'),
+    _body('tough', 'move'),
+    _body('unknown'),
+    _body('move', 'unknown'),
+    _body(*['work'] * 8 + ['move']),
+    _body(*['work'] * 9 + ['move']),
+    _body(*['work'] * 9 + ['carry']),
+    _body('claim', 'move'),
+    _body('heal', 'attack', 'ranged_attack'),
+])
+def test_identify_creep_matches_reference(creep):
+    assert screeps_info.identify_creep(creep) == reference_identify_creep(creep)
+
+
+def test_identify_creep_matches_reference_on_random_bodies():
+    rng = random.Random(0)
+    for _ in range(20000):
+        creep = {'body': _random_body(rng)}
+        assert screeps_info.identify_creep(creep) == reference_identify_creep(creep), \
+            [part['type'] for part in creep['body']]
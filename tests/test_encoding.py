@@ -0,0 +1,48 @@
+import pytest
+
+from warreport import encoding
+
+
+@pytest.mark.parametrize('object_id', [
+    '582f8e657a1fc8bf5cd28be5',
+    '',
+    'abc',
+    'sim-creep-1',
+    'sim-creep-12',
+    'sim-creep-123',
+    '582F8E657A1FC8BF5CD28BE5',
+    '582f8e657a1fc8bf5cd28be',
+    '582f8e657a1fc8bf5cd28be5a',
+    'crëep-ñame',
+])
+def test_object_id_round_trip(object_id):
+    assert encoding.unpack_object_id(encoding.pack_object_id(object_id)) == object_id
+
+
+def test_only_hex_object_ids_pack_to_12_bytes():
+    assert len(encoding.pack_object_id('582f8e657a1fc8bf5cd28be5')) == 12
+    assert len(encoding.pack_object_id('sim-creep-12')) != 12
+
+
+def test_round_trip():
+    data = {
+        'owner': 'daboross',
+        'rcl': 7,
+        'tick': -1234567,
+        'ratio': 0.5,
+        'done': True,
+        'missing': None,
+        'creeps_found': {'582f8e657a1fc8bf5cd28be5', 'sim-creep-12'},
+        'player_creep_counts': {
+            'daboross': {'ranged_attacker': 3, 'healer': 1},
+            '582f8e657a1fc8bf5cd28be5': {'scout': 1},
+        },
+        'rooms': ['W1N1', 'W1N1', 'E2S3'],
+    }
+    encoded = encoding.encode(data)
+    assert encoded[0] == encoding.FORMAT_VERSION
+    assert encoding.decode(encoded) == data
+
+
+def test_decode_accepts_json():
+    assert encoding.decode(b'{"owner": "daboross", "rcl": 7}') == {'owner': 'daboross', 'rcl': 7}
@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+from warreport import history_parser
+
+SEGMENT = {
+    'timestamp': 1480000000000,
+    'room': 'W1N1',
+    'base': 1000000,
+    'ticks': {
+        '1000000': {
+            '582f8e657a1fc8bf5cd28be5': {'type': 'creep', 'user': '57874d42d0ae911e3bd15bbc', 'x': 1, 'y': 2,
+                                         'body': [{'type': 'move', 'hits': 100}, {'type': 'attack', 'hits': 100}],
+                                         'actionLog': {'attack': {'x': 2, 'y': 2}, 'heal': None}},
+            '579fa8f20700be0674d2c15f': {'type': 'controller', 'user': '57874d42d0ae911e3bd15bbc', 'level': 5,
+                                         'x': 25, 'y': 25},
+            '5836b6b2a4c7e8e9c5f2a5c1': {'type': 'road', 'x': 3, 'y': 4, 'hits': 5000},
+        },
+        '1000001': {
+            '582f8e657a1fc8bf5cd28be5': {'x': 2, 'actionLog': {'rangedAttack': {'x': 3, 'y': 3}}},
+            '5836b6b2a4c7e8e9c5f2a5c1': None,
+        },
+        '1000002': None,
+        '1000003': {},
+    },
+}
+
+
+@pytest.mark.parametrize('indent', [None, 2])
+def test_parse_history_matches_full_decode(indent):
+    raw = json.dumps(SEGMENT, indent=indent).encode()
+    assert history_parser.parse_history(raw) == history_parser.compact_segment(SEGMENT['ticks'])
+
+
+def test_parse_history_without_ticks():
+    assert history_parser.parse_history(b'{}') is None
+    assert history_parser.parse_history(b'null') is None
+    assert history_parser.parse_history(b'{"room": "W1N1"}') is None
+    assert history_parser.parse_history(b'{"ticks": null}') == history_parser.compact_segment({})
+
+
+@pytest.mark.parametrize('raw', [b'', b'{', b'{"ticks": {"1": }}', b'{"a" 1}', b'{"a": 1,}', b'{"a": 1} x',
+                                 b'{"ticks": [1]}'])
+def test_parse_history_rejects_invalid_json(raw):
+    with pytest.raises(ValueError):
+        history_parser.parse_history(raw)
+
+
+def test_hostility_window():
+    segment = history_parser.parse_history(json.dumps(SEGMENT).encode())
+    assert history_parser.hostility_window(segment) == (1000000, 1000001)
+    assert history_parser.hostility_window(segment, {(1000000, '582f8e657a1fc8bf5cd28be5')}) == (1000001, 1000001)
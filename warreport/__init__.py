@@ -5,8 +5,43 @@ import os
 import redis
 
 SLACK_URL = None
+# Where to find the screeps server and alliance data. Only changed to run against a stand-in server.
+SCREEPS_URL = "https://screeps.com/"
+ALLIANCES_URL = "http://www.leagueofautomatednations.com/alliances.js"
+PROCESSING_WORKERS = 4
+HISTORY_PREFETCH_WINDOW = 4
+# Most connections kept open to each host. None sizes the pool to every thread which can make requests at once.
+HTTP_POOL_SIZE = None
+HTTP_TIMEOUT = 10
+HTTP_RETRIES = 3
+HISTORY_CACHE_DIRECTORY = None
+HISTORY_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# With 0 processor processes, everything runs in the one process. Otherwise, python -m warreport supervises one battle
+# discovery process, PROCESSOR_PROCESSES room processing processes and REPORTER_PROCESSES reporting processes.
+PROCESSOR_PROCESSES = 0
+REPORTER_PROCESSES = 1
+# Rooms inserted into processing per script call when enqueuing newly found battles.
+ENQUEUE_BATCH_SIZE = 500
+# Rooms are split between this many processing schedules, one per processor process.
+PROCESSING_PARTITIONS = 1
 redis_conn = None
 DATABASE_PREFIX = None
+# Most connections each event loop opens to redis for async_redis.
+REDIS_ASYNC_POOL_SIZE = 16
+# Slack webhook delivery: messages per second on average, messages sent at once after a quiet period, battles
+# combined into one message when more are waiting, and posts in flight at once.
+SLACK_RATE_PER_SECOND = 1.0
+SLACK_BURST = 3
+SLACK_COALESCE_MAX = 5
+SLACK_SENDERS = 2
+# Bounds, in seconds, of the adaptive interval between polls of the pvp API for new battles.
+DISCOVERY_MIN_INTERVAL = 60
+DISCOVERY_MAX_INTERVAL = 60 * 15
+# Where battles are reported, as a list of sink configurations: see battle_reporting.create_sinks.
+REPORT_SINKS = []
+# Port to serve Prometheus metrics on, or None not to. See metrics_server.
+METRICS_PORT = None
+METRICS_HOST = "127.0.0.1"
 
 
 def _setup_logging(logging_config):
@@ -64,12 +99,61 @@ def _setup_logging(logging_config):
     logging.config.dictConfig(dict_config)
 
 
+def _set_http(http_config):
+    global HTTP_POOL_SIZE, HTTP_TIMEOUT, HTTP_RETRIES
+    pool_size = http_config.get('pool_size', HTTP_POOL_SIZE)
+    HTTP_POOL_SIZE = max(1, int(pool_size)) if pool_size is not None else None
+    HTTP_TIMEOUT = float(http_config.get('timeout', HTTP_TIMEOUT))
+    HTTP_RETRIES = max(0, int(http_config.get('retries', HTTP_RETRIES)))
+
+
+def _set_history_cache(history_cache_config):
+    global HISTORY_CACHE_DIRECTORY, HISTORY_CACHE_MAX_BYTES
+    directory = history_cache_config.get('directory', 'cache/history')
+    if directory is None:
+        # Explicitly disabled.
+        HISTORY_CACHE_DIRECTORY = None
+    else:
+        HISTORY_CACHE_DIRECTORY = os.path.join(os.path.abspath(os.path.curdir), directory)
+    HISTORY_CACHE_MAX_BYTES = int(history_cache_config.get('max_size_mb', 512) * 1024 * 1024)
+
+
+def _set_processes(processes_config):
+    global PROCESSOR_PROCESSES, REPORTER_PROCESSES, PROCESSING_PARTITIONS
+    PROCESSOR_PROCESSES = max(0, int(processes_config.get('processors', PROCESSOR_PROCESSES)))
+    REPORTER_PROCESSES = max(1, int(processes_config.get('reporters', REPORTER_PROCESSES)))
+    PROCESSING_PARTITIONS = max(1, PROCESSOR_PROCESSES)
+
+
+def _set_discovery(discovery_config):
+    global DISCOVERY_MIN_INTERVAL, DISCOVERY_MAX_INTERVAL
+    DISCOVERY_MIN_INTERVAL = max(1, float(discovery_config.get('min_interval', DISCOVERY_MIN_INTERVAL)))
+    DISCOVERY_MAX_INTERVAL = max(DISCOVERY_MIN_INTERVAL,
+                                 float(discovery_config.get('max_interval', DISCOVERY_MAX_INTERVAL)))
+
+
+def _set_metrics(metrics_config):
+    global METRICS_PORT, METRICS_HOST
+    port = metrics_config.get('port', METRICS_PORT)
+    METRICS_PORT = int(port) if port is not None else None
+    METRICS_HOST = metrics_config.get('host', METRICS_HOST)
+
+
+def _set_slack(slack_config):
+    global SLACK_RATE_PER_SECOND, SLACK_BURST, SLACK_COALESCE_MAX, SLACK_SENDERS
+    SLACK_RATE_PER_SECOND = max(0.01, float(slack_config.get('rate_per_second', SLACK_RATE_PER_SECOND)))
+    SLACK_BURST = max(1, int(slack_config.get('burst', SLACK_BURST)))
+    SLACK_COALESCE_MAX = max(1, int(slack_config.get('coalesce_max', SLACK_COALESCE_MAX)))
+    SLACK_SENDERS = max(1, int(slack_config.get('senders', SLACK_SENDERS)))
+
+
 def _set_database(database_config):
-    global redis_conn, DATABASE_PREFIX
+    global redis_conn, DATABASE_PREFIX, REDIS_ASYNC_POOL_SIZE
     host = database_config.get('host', 'localhost')
     port = database_config.get('port', 6379)
     database = database_config.get('database', 0)
     prefix = database_config.get('prefix', 'screeps:warreport:')
+    REDIS_ASYNC_POOL_SIZE = max(1, int(database_config.get('async_pool_size', REDIS_ASYNC_POOL_SIZE)))
 
     redis_conn = redis.StrictRedis(host=host, port=port, db=database)
     DATABASE_PREFIX = prefix
@@ -101,12 +185,26 @@ def _setup():
 
     _setup_logging(logging_config)
     _set_database(database_config)
-
-    global SLACK_URL
+    _set_http(json_conf.get("http", {}))
+    _set_history_cache(json_conf.get("history_cache", {}))
+    _set_processes(json_conf.get("processes", {}))
+    _set_slack(json_conf.get("slack", {}))
+    _set_discovery(json_conf.get("discovery", {}))
+    _set_metrics(json_conf.get("metrics", {}))
+
+    global SLACK_URL, PROCESSING_WORKERS, HISTORY_PREFETCH_WINDOW, ENQUEUE_BATCH_SIZE, REPORT_SINKS, SCREEPS_URL, \
+        ALLIANCES_URL
     SLACK_URL = json_conf.get('slack_url', None)
     # This can stand in as a good default that we should NOT try and use.
     if SLACK_URL == "https://hooks.slack.com/services/XXX/YYY/ZZZ":
         SLACK_URL = None
+    REPORT_SINKS = list(json_conf.get('sinks', REPORT_SINKS))
+    SCREEPS_URL = json_conf.get('screeps_url', SCREEPS_URL)
+    ALLIANCES_URL = json_conf.get('alliances_url', ALLIANCES_URL)
+
+    PROCESSING_WORKERS = max(1, int(json_conf.get('processing_workers', PROCESSING_WORKERS)))
+    HISTORY_PREFETCH_WINDOW = max(1, int(json_conf.get('history_prefetch_window', HISTORY_PREFETCH_WINDOW)))
+    ENQUEUE_BATCH_SIZE = max(1, int(json_conf.get('enqueue_batch_size', ENQUEUE_BATCH_SIZE)))
 
 
 _setup()
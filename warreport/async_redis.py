@@ -0,0 +1,256 @@
+"""
+A small asyncio redis client, so that event loop code can talk to redis without tying up an executor thread per call.
+
+Only what we need is here: running commands, pipelining many commands in one round trip, and running lua scripts. Each
+event loop gets its own pool of at most REDIS_ASYNC_POOL_SIZE connections to the same server as warreport.redis_conn,
+from get_pool.
+
+Any command can be cancelled, including blocking ones: a connection whose reply was never read is closed rather than
+put back in the pool. Idle connections which redis has closed, say from restarting or dropping idle connections, are
+noticed and replaced before anything is sent on them, and failing to connect is tried once more. Once commands have
+been sent, redis may have run them even if the connection was lost before their replies came back, so they're only
+tried again on a new connection if the caller marked them as idempotent.
+"""
+import asyncio
+import collections
+import hashlib
+import logging
+
+from redis.exceptions import ConnectionError, ResponseError, NoScriptError
+
+from warreport import redis_conn, REDIS_ASYNC_POOL_SIZE
+
+logger = logging.getLogger("warreport")
+
+__all__ = ["get_pool", "close_pool", "ConnectionPool"]
+
+_pools = {}
+
+
+def get_pool(loop):
+    """
+    Gets the connection pool for the given event loop, creating it if needed.
+    :type loop: asyncio.events.AbstractEventLoop
+    :rtype: ConnectionPool
+    """
+    pool = _pools.get(loop)
+    if pool is None:
+        connection_kwargs = redis_conn.connection_pool.connection_kwargs
+        pool = _pools[loop] = ConnectionPool(connection_kwargs.get('host', 'localhost'),
+                                             connection_kwargs.get('port', 6379), connection_kwargs.get('db', 0),
+                                             REDIS_ASYNC_POOL_SIZE, loop)
+    return pool
+
+
+def close_pool(loop):
+    """
+    Closes every connection of the given event loop's pool, if it has one.
+    :type loop: asyncio.events.AbstractEventLoop
+    """
+    pool = _pools.pop(loop, None)
+    if pool is not None:
+        pool.close()
+
+
+def _encode(value):
+    if isinstance(value, bytes):
+        return value
+    elif isinstance(value, str):
+        return value.encode()
+    elif isinstance(value, float):
+        return repr(value).encode()
+    else:
+        return str(value).encode()
+
+
+def _pack_command(args):
+    parts = [b'*', str(len(args)).encode(), b'\r\n']
+    for arg in args:
+        arg = _encode(arg)
+        parts += (b'$', str(len(arg)).encode(), b'\r\n', arg, b'\r\n')
+    return b''.join(parts)
+
+
+def _error(message):
+    if message.startswith('NOSCRIPT'):
+        return NoScriptError(message)
+    return ResponseError(message)
+
+
+class _Connection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @asyncio.coroutine
+    def execute_many(self, commands):
+        """
+        Sends all commands at once, then reads every reply. Error replies are returned as exception instances.
+        """
+        self.writer.write(b''.join(_pack_command(command) for command in commands))
+        replies = []
+        for _ in commands:
+            replies.append((yield from self._read_reply()))
+        return replies
+
+    @asyncio.coroutine
+    def _read_reply(self):
+        line = yield from self.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError("Connection closed by redis.")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest
+        elif kind == b'-':
+            return _error(rest.decode())
+        elif kind == b':':
+            return int(rest)
+        elif kind == b'$':
+            length = int(rest)
+            if length < 0:
+                return None
+            data = yield from self.reader.readexactly(length + 2)
+            return data[:-2]
+        elif kind == b'*':
+            length = int(rest)
+            if length < 0:
+                return None
+            items = []
+            for _ in range(length):
+                items.append((yield from self._read_reply()))
+            return items
+        else:
+            raise ConnectionError("Unexpected reply from redis: {!r}".format(line))
+
+    def close(self):
+        self.writer.close()
+
+
+class ConnectionPool:
+    def __init__(self, host, port, db, max_connections, loop):
+        """
+        :type loop: asyncio.events.AbstractEventLoop
+        """
+        self.host = host
+        self.port = port
+        self.db = db
+        self.loop = loop
+        self._idle = collections.deque()
+        self._available = asyncio.Semaphore(max_connections, loop=loop)
+        self._loaded_scripts = set()
+
+    @asyncio.coroutine
+    def _connect(self):
+        reader, writer = yield from asyncio.open_connection(self.host, self.port, loop=self.loop)
+        connection = _Connection(reader, writer)
+        if self.db:
+            reply, = yield from connection.execute_many([('SELECT', self.db)])
+            if isinstance(reply, Exception):
+                connection.close()
+                raise reply
+        return connection
+
+    @asyncio.coroutine
+    def _take_connection(self):
+        while self._idle:
+            connection = self._idle.pop()
+            if not connection.reader.at_eof():
+                return connection
+            # Closed by redis while idle. Whatever closed it most likely closed the other idle ones too, but they're
+            # checked the same way in turn.
+            logger.debug("Idle redis connection was closed: discarding it.")
+            connection.close()
+        try:
+            return (yield from self._connect())
+        except (ConnectionError, OSError, EOFError) as e:
+            logger.warning("Couldn't connect to redis ({}): trying again.".format(e))
+            return (yield from self._connect())
+
+    @asyncio.coroutine
+    def _execute_many(self, commands, idempotent=False):
+        yield from self._available.acquire()
+        try:
+            connection = yield from self._take_connection()
+            try:
+                return (yield from self._execute_on_connection(connection, commands))
+            except (ConnectionError, OSError, EOFError) as e:
+                # Whatever dropped this connection most likely dropped the other idle ones too.
+                self.close()
+                if not idempotent:
+                    raise
+                logger.warning("Lost connection to redis ({}): reconnecting.".format(e))
+                return (yield from self._execute_on_connection((yield from self._take_connection()), commands))
+        finally:
+            self._available.release()
+
+    @asyncio.coroutine
+    def _execute_on_connection(self, connection, commands):
+        try:
+            replies = yield from connection.execute_many(commands)
+        except BaseException:
+            # Cancelled or failed part way through: there may be replies we haven't read, so this connection can't be
+            # used again.
+            connection.close()
+            raise
+        self._idle.append(connection)
+        return replies
+
+    @asyncio.coroutine
+    def execute(self, *args, idempotent=False):
+        """
+        Runs one command, and returns its reply.
+        :param idempotent: Whether running the command twice is the same as running it once, so it can be tried again
+                           if the connection is lost after sending it
+        :raises redis.exceptions.ResponseError: if redis replied with an error
+        """
+        reply, = yield from self._execute_many([args], idempotent)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    @asyncio.coroutine
+    def pipeline(self, commands, idempotent=False):
+        """
+        Runs a number of commands in one round trip, and returns their replies.
+        :param commands: A list of command tuples, like ('SET', key, value)
+        :param idempotent: Whether running the commands twice is the same as running them once, as for execute
+        :raises redis.exceptions.ResponseError: if redis replied to any command with an error, after all have run
+        """
+        replies = yield from self._execute_many(commands, idempotent)
+        for reply in replies:
+            if isinstance(reply, Exception):
+                raise reply
+        return replies
+
+    @asyncio.coroutine
+    def run_script_many(self, script, calls):
+        """
+        Runs a lua script a number of times in one round trip.
+        :param script: The script, as a redis.client.Script
+        :param calls: A list of (keys, args) for each run
+        :return: The result of each run
+        """
+        sha = hashlib.sha1(script.script.encode()).hexdigest()
+        load = ('SCRIPT', 'LOAD', script.script)
+        commands = [('EVALSHA', sha, len(keys)) + tuple(keys) + tuple(args) for keys, args in calls]
+        if sha not in self._loaded_scripts:
+            replies = (yield from self._execute_many([load] + commands))[1:]
+            self._loaded_scripts.add(sha)
+        else:
+            replies = yield from self._execute_many(commands)
+        retry = [index for index, reply in enumerate(replies) if isinstance(reply, NoScriptError)]
+        if retry:
+            # Redis has lost our scripts, probably from being restarted. Nothing was run by the calls which failed
+            # with this, so they can just be tried again.
+            logger.debug("Reloading script {} into redis.".format(sha))
+            retried = (yield from self._execute_many([load] + [commands[index] for index in retry]))[1:]
+            for index, reply in zip(retry, retried):
+                replies[index] = reply
+        for reply in replies:
+            if isinstance(reply, Exception):
+                raise reply
+        return replies
+
+    def close(self):
+        while self._idle:
+            self._idle.pop().close()
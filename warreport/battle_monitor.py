@@ -3,23 +3,77 @@ import logging
 
 from functools import partial
 
-from warreport import redis_conn, screeps_info, queuing
+from warreport import async_redis, screeps_info, queuing, history_cache, history_timing, metrics, PROCESSING_WORKERS, \
+    DISCOVERY_MIN_INTERVAL, DISCOVERY_MAX_INTERVAL
 from warreport.key_constants import _LAST_CHECKED_TICK_KEY, _LAST_CHECKED_TICK_EXPIRE_SECONDS
 from warreport.screeps_info import ScreepsError
 
 logger = logging.getLogger("warreport")
 
+# Seconds to wait before looking at a room again after its next history segment wasn't available, when
+# history_timing can't predict when it will be yet. Otherwise, we wait until it predicts the segment will be available,
+# within these bounds.
+ROOM_NOT_READY_DELAY = 30
+ROOM_NOT_READY_MIN_DELAY = 5
+ROOM_NOT_READY_MAX_DELAY = 60 * 5
+# Seconds before retrying a room whose processing failed with an unexpected error.
+ROOM_ERROR_DELAY = 60
+# Longest a worker with nothing to do sleeps before checking the processing schedule again.
+IDLE_POLL_INTERVAL = 2
+# Seconds between checks that our in-memory alliance data is up to date.
+ALLIANCE_REFRESH_INTERVAL = 60
+# Seconds between loading the server tick clock published by battle discovery.
+TICK_CLOCK_REFRESH_INTERVAL = 30
+# Seconds between renewals of the lease on a room being worked on. Must be well under ROOM_LEASE_SECONDS.
+ROOM_LEASE_RENEW_INTERVAL = 20
+# A poll of the pvp API finding at least this many new battles means we should be polling more often.
+DISCOVERY_BUSY_BATTLES = 10
+# How much longer to wait after a poll finds nothing, and after one fails.
+DISCOVERY_EMPTY_BACKOFF = 1.5
+DISCOVERY_ERROR_BACKOFF = 2
+
+_WORKER_BUSY_SECONDS = metrics.ROOM_WORKER_SECONDS.labels('busy')
+_WORKER_IDLE_SECONDS = metrics.ROOM_WORKER_SECONDS.labels('idle')
+
+
+def next_poll_interval(interval, battles_found, failed, rooms_due):
+    """
+    Decides how long to wait before polling the pvp API again, between DISCOVERY_MIN_INTERVAL and
+    DISCOVERY_MAX_INTERVAL.
+
+    Polls which fail or find nothing back off, so that quiet periods cost no more API calls than polling at the longest
+    interval. Polls which find many battles, or find some while the room workers have nothing due, halve the interval:
+    battles are found sooner when there are enough of them to be worth it, or there's spare capacity to process them.
+
+    :param interval: Seconds waited before the last poll
+    :param battles_found: New battles the last poll found
+    :param failed: Whether the last poll failed
+    :param rooms_due: Rooms due for processing and not yet taken by a worker
+    """
+    if failed:
+        interval *= DISCOVERY_ERROR_BACKOFF
+    elif not battles_found:
+        interval *= DISCOVERY_EMPTY_BACKOFF
+    elif battles_found >= DISCOVERY_BUSY_BATTLES or not rooms_due:
+        interval /= 2
+    return min(DISCOVERY_MAX_INTERVAL, max(DISCOVERY_MIN_INTERVAL, interval))
+
 
 @asyncio.coroutine
 def grab_new_battles(loop):
     """
     :type loop: asyncio.events.AbstractEventLoop
     """
-    last_grabbed_tick = yield from loop.run_in_executor(None, redis_conn.get, _LAST_CHECKED_TICK_KEY)
+    redis_pool = async_redis.get_pool(loop)
+    last_grabbed_tick = yield from redis_pool.execute('GET', _LAST_CHECKED_TICK_KEY, idempotent=True)
     if last_grabbed_tick:
         last_grabbed_tick = int(last_grabbed_tick)
+    interval = DISCOVERY_MAX_INTERVAL
     while True:
         logger.debug("Grabbing battles.")
+        battles_found = 0
+        rooms_due = 0
+        failed = False
         try:
             if last_grabbed_tick is not None:
                 battles = yield from loop.run_in_executor(None, partial(screeps_info.grab_battles,
@@ -29,51 +83,161 @@ def grab_new_battles(loop):
                                                                         interval=2000))
         except ScreepsError as e:
             logging.warning("Error accessing battles API: {}".format(e))
+            failed = True
         else:
             grabbed_from = last_grabbed_tick
             last_grabbed_tick = int(battles['time'])
-            if len(battles['rooms']):
+            battles_found = len(battles['rooms'])
+            if battles_found:
                 if logger.isEnabledFor(logging.DEBUG):
                     logger.debug("Found {} new battles in the last {} ticks.".format(
                         len(battles['rooms']), int(last_grabbed_tick) - int(grabbed_from) if grabbed_from else 2000))
+                # Counted before adding these, to tell whether the workers have kept up with what we'd found so far.
+                rooms_due = yield from queuing.count_rooms_due_async(loop)
                 yield from asyncio.gather(
-                    loop.run_in_executor(None, partial(redis_conn.set, _LAST_CHECKED_TICK_KEY, last_grabbed_tick,
-                                                       ex=_LAST_CHECKED_TICK_EXPIRE_SECONDS)),
-                    loop.run_in_executor(None, queuing.push_battles_for_processing,
-                                         ((obj['_id'], obj['lastPvpTime']) for obj in battles['rooms'])),
+                    redis_pool.execute('SET', _LAST_CHECKED_TICK_KEY, last_grabbed_tick,
+                                       'EX', _LAST_CHECKED_TICK_EXPIRE_SECONDS, idempotent=True),
+                    queuing.push_battles_for_processing_async(
+                        loop, ((obj['_id'], obj['lastPvpTime']) for obj in battles['rooms'])),
                     loop=loop
                 )
             elif logger.isEnabledFor(logging.DEBUG):
                 logger.debug("Found no new battles in the last {} ticks.".format(
                     int(last_grabbed_tick) - int(grabbed_from) if grabbed_from else 2000))
-        yield from asyncio.sleep(60 * 15, loop=loop)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("HTTP connections: {opened} opened, {reused} reused over {requests} requests."
+                         .format(**screeps_info.http_connection_stats()))
+            logger.debug("History cache: {hits} hits, {misses} misses, {segments} segments ({bytes} bytes) stored, "
+                         "{missing_suppressed} fetches of missing and {empty_suppressed} of empty segments suppressed."
+                         .format(**history_cache.stats()))
+        if not failed:
+            yield from history_timing.publish_clock_async(loop)
+        interval = next_poll_interval(interval, battles_found, failed, rooms_due)
+        logger.debug("Next poll for battles in {:.0f} seconds.".format(interval))
+        yield from asyncio.sleep(interval, loop=loop)
+
+
+@asyncio.coroutine
+def process_battles(loop, partition=0):
+    """
+    Runs PROCESSING_WORKERS room workers concurrently, each taking rooms from the given partition of the processing
+    schedule as they become due. A room whose history isn't ready yet is just scheduled again for later, so it only
+    delays itself.
+
+    :type loop: asyncio.events.AbstractEventLoop
+    :param partition: The processing schedule partition to take rooms from
+    """
+    logger.debug("Starting {} room processing workers for partition {}.".format(PROCESSING_WORKERS, partition))
+    yield from asyncio.gather(_keep_alliances_fresh(loop), keep_tick_clock_fresh(loop),
+                              *(_process_rooms_worker(loop, partition) for _ in range(PROCESSING_WORKERS)),
+                              loop=loop)
 
 
 @asyncio.coroutine
-def process_battles(loop):
+def _keep_alliances_fresh(loop):
     """
     :type loop: asyncio.events.AbstractEventLoop
     """
     while True:
-        room_name = yield from loop.run_in_executor(None, queuing.get_next_room_to_process)
+        yield from loop.run_in_executor(None, screeps_info.refresh_alliances)
+        yield from asyncio.sleep(ALLIANCE_REFRESH_INTERVAL, loop=loop)
 
-        latest_tick = yield from loop.run_in_executor(None, redis_conn.get, _LAST_CHECKED_TICK_KEY)
-        if latest_tick:
-            latest_tick = int(latest_tick.decode())
-        else:
-            latest_tick = 0
 
-        battle_data = yield from loop.run_in_executor(None, partial(screeps_info.work_on_room_data,
-                                                                    room_name, latest_tick))
+@asyncio.coroutine
+def keep_tick_clock_fresh(loop):
+    """
+    Keeps loading the server tick clock published by battle discovery, for processes which don't poll the pvp API.
+    :type loop: asyncio.events.AbstractEventLoop
+    """
+    while True:
+        yield from history_timing.refresh_clock_async(loop)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("History timing: {deferred} fetches deferred, {not_found} not found ({early_predictions} "
+                         "predicted available), {mean_abs_error:.1f}s mean error over {error_samples} segments."
+                         .format(**history_timing.stats()))
+        yield from asyncio.sleep(TICK_CLOCK_REFRESH_INTERVAL, loop=loop)
+
 
-        if battle_data is None:
-            # If we continue without sending queuing a finished battle, the battle will simply be sent to the back of
-            # the processing queue. This way, we'll keep checking to see if we have any history parts available every 30
-            # seconds, and if we have multiple battles which aren't in order, we'll still get to all of them in good
-            # time.
-            yield from asyncio.sleep(30, loop=loop)
+@asyncio.coroutine
+def _process_rooms_worker(loop, partition):
+    """
+    :type loop: asyncio.events.AbstractEventLoop
+    """
+    idle_since = loop.time()
+    while True:
+        try:
+            room_name, lease_token, wait = yield from queuing.get_next_room_to_process_async(loop, partition)
+        except Exception:
+            logger.exception("Error taking the next room to process.")
+            yield from asyncio.sleep(IDLE_POLL_INTERVAL, loop=loop)
+            continue
+        if room_name is None:
+            # Nothing is due: sleep until something is, but wake up regularly to notice newly found battles.
+            yield from asyncio.sleep(IDLE_POLL_INTERVAL if wait is None else min(wait, IDLE_POLL_INTERVAL), loop=loop)
             continue
 
-        logger.debug("Processed {}: submitting to reporting queue!".format(room_name))
+        busy_since = loop.time()
+        _WORKER_IDLE_SECONDS.inc(busy_since - idle_since)
+        try:
+            yield from _process_room(loop, room_name, lease_token)
+        except Exception:
+            # One room failing shouldn't stop this worker, or the rest of process_battles along with it.
+            logger.exception("Error processing {}: retrying it in {} seconds.".format(room_name, ROOM_ERROR_DELAY))
+            try:
+                yield from queuing.reschedule_room_async(loop, room_name, lease_token, ROOM_ERROR_DELAY)
+            except Exception:
+                logger.exception("Error rescheduling {}: leaving it until its lease expires.".format(room_name))
+        finally:
+            idle_since = loop.time()
+            _WORKER_BUSY_SECONDS.inc(idle_since - busy_since)
+
+
+@asyncio.coroutine
+def _process_room(loop, room_name, lease_token):
+    """
+    Works on a room taken from the processing schedule, then reschedules it or submits the finished battle.
+    :type loop: asyncio.events.AbstractEventLoop
+    """
+    redis_pool = async_redis.get_pool(loop)
+    latest_tick = yield from redis_pool.execute('GET', _LAST_CHECKED_TICK_KEY, idempotent=True)
+    if latest_tick:
+        latest_tick = int(latest_tick.decode())
+    else:
+        latest_tick = 0
+
+    battle_data = yield from _while_holding_lease(loop, room_name, lease_token, loop.run_in_executor(
+        None, partial(screeps_info.work_on_room_data, room_name, latest_tick, lease_token)))
+
+    if isinstance(battle_data, screeps_info.HistoryNotReady):
+        # The next history segment isn't available yet: there's no point looking at this room again until it
+        # should be. Every other room carries on being processed in the meantime.
+        delay = history_timing.seconds_until_available(battle_data.tick)
+        if delay is None:
+            delay = ROOM_NOT_READY_DELAY
+        else:
+            delay = min(ROOM_NOT_READY_MAX_DELAY, max(ROOM_NOT_READY_MIN_DELAY, delay))
+        yield from queuing.reschedule_room_async(loop, room_name, lease_token, delay)
+        return
+
+    logger.debug("Processed {}: submitting to reporting queue!".format(room_name))
+
+    yield from queuing.submit_processed_battle_async(loop, room_name, lease_token, battle_data)
+
 
-        yield from loop.run_in_executor(None, queuing.submit_processed_battle, room_name, battle_data)
+@asyncio.coroutine
+def _while_holding_lease(loop, room_name, lease_token, future):
+    """
+    Waits for the given future, renewing the lease on room_name every ROOM_LEASE_RENEW_INTERVAL seconds until it's
+    done, so that no other consumer takes the room over while it's still being worked on.
+
+    :type loop: asyncio.events.AbstractEventLoop
+    """
+    while True:
+        done, _ = yield from asyncio.wait([future], timeout=ROOM_LEASE_RENEW_INTERVAL, loop=loop)
+        if done:
+            return future.result()
+        held = yield from queuing.renew_room_lease_async(loop, room_name, lease_token)
+        if not held:
+            # Carry on anyways: storing progress and submitting both check the lease, so they'll fail harmlessly, as
+            # the new lease holder's token is the one in redis.
+            logger.warning("Lost the lease on {} while processing it.".format(room_name))
@@ -1,48 +1,444 @@
 import asyncio
 import logging
+import os
 
 import requests
 from functools import partial
 
-from warreport import SLACK_URL, queuing
+try:
+    import rapidjson as json
+except ImportError:
+    import json
+
+from warreport import SLACK_URL, SLACK_RATE_PER_SECOND, SLACK_BURST, SLACK_COALESCE_MAX, SLACK_SENDERS, HTTP_TIMEOUT, \
+    REPORT_SINKS, queuing, history_timing, metrics
 from warreport.constants import civilian, scout
+from warreport.key_constants import REPORT_LEASE_SECONDS
 
 logger = logging.getLogger("warreport")
 
+# Longest the reporter sleeps before checking the reporting schedule again when nothing is due.
+IDLE_POLL_INTERVAL = 2
+# Seconds before a sink first tries again to deliver a battle which it couldn't. Each further failure of the same
+# battle doubles this, up to REPORT_RETRY_MAX_DELAY.
+REPORT_RETRY_DELAY = 15
+REPORT_RETRY_MAX_DELAY = 60 * 30
+# Seconds before offering a battle again to a sink whose buffer was full, or which hasn't finished backing off from it.
+REPORT_DEFER_DELAY = 5
+# Battles each of a sink's senders may have waiting for it, per battle it can send at once. Kept small so that
+# waiting for a sink never comes close to outlasting a battle's lease.
+REPORT_BUFFER_PER_SENDER = 2
+# Seconds a battle may wait for a sink before being handed back to the schedule rather than risk its lease running out
+# mid-delivery.
+REPORT_MAX_WAIT = REPORT_LEASE_SECONDS // 2
+
+
+class TokenBucket:
+    """
+    Allows on average `rate` acquisitions per second, with up to `burst` at once after a quiet period.
+    """
+
+    def __init__(self, rate, burst, loop):
+        """
+        :type loop: asyncio.events.AbstractEventLoop
+        """
+        self.rate = rate
+        self.burst = burst
+        self.loop = loop
+        self.tokens = burst
+        self.updated = loop.time()
+        self.paused_until = 0
+        self._lock = asyncio.Lock(loop=loop)
+
+    @asyncio.coroutine
+    def acquire(self):
+        """
+        Waits until a token is available, and takes it. Waiters are served in order.
+        """
+        yield from self._lock.acquire()
+        try:
+            while True:
+                now = self.loop.time()
+                if now < self.paused_until:
+                    yield from asyncio.sleep(self.paused_until - now, loop=self.loop)
+                    continue
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                yield from asyncio.sleep((1 - self.tokens) / self.rate, loop=self.loop)
+        finally:
+            self._lock.release()
+
+    def pause(self, seconds):
+        """
+        Empties the bucket and stops handing out tokens for the given number of seconds, for when the other end has
+        told us to slow down.
+        """
+        self.paused_until = max(self.paused_until, self.loop.time() + seconds)
+        self.tokens = 0
+        self.updated = self.paused_until
+
+
+class _Dispatch:
+    """
+    One battle taken from the reporting schedule, while it's being delivered to sinks.
+    """
+
+    def __init__(self, battle_info, database_key, taken_at):
+        self.battle_info = battle_info
+        self.database_key = database_key
+        self.taken_at = taken_at
+        # Sinks still working on this battle.
+        self.waiting = set()
+        # When a required sink didn't deliver it, the soonest any of them want it offered again.
+        self.retry_delay = None
+
+    @property
+    def battle_id(self):
+        return self.database_key[0]
+
+    def defer(self, delay):
+        self.retry_delay = delay if self.retry_delay is None else min(self.retry_delay, delay)
+
+
+class ReportSink:
+    """
+    Somewhere battles are reported to. Subclasses implement deliver.
+
+    Each sink has its own bounded buffer, senders, optional rate limit and retry state, so one which is slow or failing
+    never holds up the others: when its buffer is full, battles are offered to it again later instead of waiting.
+
+    Battles are marked reported once every required sink has acknowledged them. A sink which isn't required gets each
+    battle on a best effort basis, and only while battles are being retried for required sinks anyways.
+    """
+
+    def __init__(self, name, required=True, senders=1, coalesce_max=1, buffer_size=None, rate_per_second=None,
+                 burst=1):
+        """
+        :param name: Unique name of this sink, recorded against each battle it acknowledges
+        :param required: Whether a battle needs to be delivered here before it counts as reported
+        :param senders: Deliveries in flight at once
+        :param coalesce_max: Most battles given to deliver at once
+        :param buffer_size: Most battles waiting for delivery at once
+        :param rate_per_second: Most deliveries a second, on average, or None for no limit
+        :param burst: Most deliveries at once after a quiet period, with rate_per_second
+        """
+        self.name = name
+        self.required = required
+        self.senders = senders
+        self.coalesce_max = coalesce_max
+        self.buffer_size = buffer_size or REPORT_BUFFER_PER_SENDER * senders * coalesce_max
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        # Battle ID -> (failed deliveries, loop time before which not to try again).
+        self.failures = {}
+        self.queue = None
+        self.bucket = None
+        self._delivery_seconds = metrics.SINK_DELIVERY_SECONDS.labels(name)
+        self._delivered = metrics.SINK_DELIVERIES.labels(name, 'delivered')
+        self._failed = metrics.SINK_DELIVERIES.labels(name, 'failed')
+
+    @asyncio.coroutine
+    def deliver(self, loop, battles):
+        """
+        Delivers some battles.
+        :type loop: asyncio.events.AbstractEventLoop
+        :param battles: A list of up to coalesce_max battle info dicts
+        :return: A tuple of (delivered, retry_after), where retry_after is the number of seconds the other end asked us
+                 to wait before delivering anything else, if it did.
+        """
+        raise NotImplementedError
+
+    def offer(self, loop, dispatch):
+        """
+        Buffers a battle for delivery, unless the buffer is full or this sink is still backing off from it.
+        :type loop: asyncio.events.AbstractEventLoop
+        :type dispatch: _Dispatch
+        :return: True if taken
+        """
+        failed = self.failures.get(dispatch.battle_id)
+        if failed is not None and failed[1] > loop.time():
+            return False
+        try:
+            self.queue.put_nowait(dispatch)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    def run(self, loop, finished):
+        """
+        :type loop: asyncio.events.AbstractEventLoop
+        :param finished: Coroutine function called with (dispatch, sink, delivered, retry_delay) after each attempt.
+        :return: A coroutine running this sink's senders
+        """
+        self.queue = asyncio.Queue(maxsize=self.buffer_size, loop=loop)
+        if self.rate_per_second is not None:
+            self.bucket = TokenBucket(self.rate_per_second, self.burst, loop)
+        return asyncio.gather(*(self._send(loop, finished) for _ in range(self.senders)), loop=loop)
+
+    @asyncio.coroutine
+    def _send(self, loop, finished):
+        while True:
+            batch = [(yield from self.queue.get())]
+            if self.bucket is not None:
+                yield from self.bucket.acquire()
+            # Anything which turned up while we waited for the rate limit goes in the same delivery.
+            while len(batch) < self.coalesce_max and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            now = loop.time()
+            stale = [dispatch for dispatch in batch if now - dispatch.taken_at > REPORT_MAX_WAIT]
+            if stale:
+                logger.warning("{} battles waited too long for {}: handing them back.".format(len(stale), self.name))
+                batch = [dispatch for dispatch in batch if dispatch not in stale]
+                for dispatch in stale:
+                    yield from finished(dispatch, self, False, 0)
+                if not batch:
+                    continue
+
+            started = loop.time()
+            try:
+                delivered, retry_after = yield from self.deliver(loop, [dispatch.battle_info for dispatch in batch])
+            except Exception:
+                logger.exception("Couldn't deliver battles to {}!".format(self.name))
+                delivered, retry_after = False, None
+            self._delivery_seconds.observe(loop.time() - started)
+            (self._delivered if delivered else self._failed).inc()
+            if not delivered and retry_after is not None and self.bucket is not None:
+                self.bucket.pause(retry_after)
+            now = loop.time()
+            for dispatch in batch:
+                if delivered:
+                    self.failures.pop(dispatch.battle_id, None)
+                    yield from finished(dispatch, self, True, None)
+                else:
+                    attempts = self.failures.get(dispatch.battle_id, (0, 0))[0] + 1
+                    delay = max(min(REPORT_RETRY_MAX_DELAY, REPORT_RETRY_DELAY * 2 ** (attempts - 1)),
+                                retry_after or 0)
+                    self.failures[dispatch.battle_id] = (attempts, now + delay)
+                    yield from finished(dispatch, self, False, delay)
+
+
+class SlackSink(ReportSink):
+    """
+    Posts one line per battle to a slack incoming webhook.
+    """
+
+    def __init__(self, url, name="slack", rate_per_second=None, burst=None, coalesce_max=None, senders=None,
+                 **options):
+        super().__init__(name, rate_per_second=rate_per_second or SLACK_RATE_PER_SECOND, burst=burst or SLACK_BURST,
+                         coalesce_max=coalesce_max or SLACK_COALESCE_MAX, senders=senders or SLACK_SENDERS, **options)
+        self.url = url
+
+    @asyncio.coroutine
+    def deliver(self, loop, battles):
+        return (yield from _post_json(loop, self.name, self.url, {
+            "text": "\n".join(format_message(battle_info) for battle_info in battles),
+        }))
+
+
+class WebhookSink(ReportSink):
+    """
+    Posts battles to a URL as JSON: {"battles": [battle_info, ...]}, with each battle_info also having the "message" we
+    would post to slack.
+    """
+
+    def __init__(self, url, name="webhook", coalesce_max=10, **options):
+        super().__init__(name, coalesce_max=coalesce_max, **options)
+        self.url = url
+
+    @asyncio.coroutine
+    def deliver(self, loop, battles):
+        return (yield from _post_json(loop, self.name, self.url, {
+            "battles": [dict(battle_info, message=format_message(battle_info)) for battle_info in battles],
+        }))
+
+
+class JsonLinesFileSink(ReportSink):
+    """
+    Appends one JSON object per battle, like WebhookSink's, to a local file.
+    """
+
+    def __init__(self, path, name="file", coalesce_max=50, **options):
+        super().__init__(name, coalesce_max=coalesce_max, **options)
+        self.path = os.path.abspath(path)
+
+    @asyncio.coroutine
+    def deliver(self, loop, battles):
+        lines = "".join(json.dumps(dict(battle_info, message=format_message(battle_info))) + "\n"
+                        for battle_info in battles)
+        try:
+            yield from loop.run_in_executor(None, self._append, lines)
+        except OSError as e:
+            logger.error("Couldn't write battles to {}! {}".format(self.path, e))
+            return False, None
+        return True, None
+
+    def _append(self, lines):
+        directory = os.path.dirname(self.path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self.path, 'a') as file:
+            file.write(lines)
+
+
+class LogSink(ReportSink):
+    """
+    Logs each battle's message, for when there's nowhere else to report to.
+    """
+
+    def __init__(self, name="log", **options):
+        super().__init__(name, **options)
+
+    @asyncio.coroutine
+    def deliver(self, loop, battles):
+        for battle_info in battles:
+            logger.info(format_message(battle_info))
+        return True, None
+
+
+_SINK_TYPES = {
+    "slack": SlackSink,
+    "webhook": WebhookSink,
+    "jsonl": JsonLinesFileSink,
+    "log": LogSink,
+}
+
+
+def create_sinks(sinks_config):
+    """
+    Creates report sinks from configuration: a list of dicts, each with a "type" of "slack", "webhook", "jsonl" or
+    "log", that type's own options ("url" for slack and webhook, "path" for jsonl), and any of ReportSink's options.
+
+    With no sinks configured, battles go to slack_url if it's set, and to the log otherwise.
+    :rtype: list[ReportSink]
+    """
+    if not sinks_config:
+        sinks_config = [{"type": "slack", "url": SLACK_URL}] if SLACK_URL is not None else [{"type": "log"}]
+    sinks = []
+    for sink_config in sinks_config:
+        options = dict(sink_config)
+        sink_type = options.pop("type")
+        if sink_type not in _SINK_TYPES:
+            raise ValueError("Unknown report sink type: {}".format(sink_type))
+        sinks.append(_SINK_TYPES[sink_type](**options))
+    names = [sink.name for sink in sinks]
+    if len(set(names)) != len(names):
+        raise ValueError("Report sinks need unique names, found: {}".format(names))
+    return sinks
+
+
+@asyncio.coroutine
+def _post_json(loop, name, url, payload):
+    """
+    :type loop: asyncio.events.AbstractEventLoop
+    :return: A tuple of (posted, retry_after), as for ReportSink.deliver.
+    """
+    try:
+        response = yield from loop.run_in_executor(None, partial(requests.post, url, json=payload,
+                                                                 timeout=HTTP_TIMEOUT))
+    except requests.RequestException as e:
+        logger.error("Couldn't post to {}! {} (for payload {})".format(name, e, payload))
+        return False, None
+    assert isinstance(response, requests.Response)
+    if 200 <= response.status_code < 300:
+        return True, None
+    logger.error("Couldn't post to {}! {} ({}, for payload {})".format(name, response.text, response.status_code,
+                                                                       payload))
+    if response.status_code == 429:
+        try:
+            return False, float(response.headers.get('Retry-After', REPORT_RETRY_DELAY))
+        except ValueError:
+            return False, REPORT_RETRY_DELAY
+    return False, None
+
 
 @asyncio.coroutine
-def process_and_requeue_reports(loop):
+def process_and_requeue_reports(loop, sinks=None):
     """
+    Takes battles from the reporting schedule and delivers each to every report sink concurrently.
+
+    A battle is marked reported once every required sink has acknowledged it. Until then, it goes back into the
+    schedule to be offered again only to the sinks which haven't, after the shortest delay any of them asked for.
+
     :type loop: asyncio.events.AbstractEventLoop
+    :param sinks: The sinks to report to, by default created from REPORT_SINKS
+    :type sinks: list[ReportSink]
+    """
+    if sinks is None:
+        sinks = create_sinks(REPORT_SINKS)
+    # Bounds battles held at once, so we don't keep leasing battles which every sink would turn away.
+    in_flight = asyncio.Semaphore(sum(sink.buffer_size for sink in sinks), loop=loop)
+
+    @asyncio.coroutine
+    def finished(dispatch, sink, delivered, retry_delay):
+        if delivered:
+            yield from queuing.mark_battle_delivered_async(loop, dispatch.battle_id, sink.name)
+        elif sink.required:
+            dispatch.defer(retry_delay)
+        dispatch.waiting.discard(sink)
+        if not dispatch.waiting:
+            yield from _settle(loop, dispatch)
+            in_flight.release()
+
+    yield from asyncio.gather(_take_reports(loop, sinks, in_flight, finished),
+                              *(sink.run(loop, finished) for sink in sinks), loop=loop)
+
+
+@asyncio.coroutine
+def _take_reports(loop, sinks, in_flight, finished):
+    """
+    :type loop: asyncio.events.AbstractEventLoop
+    :type sinks: list[ReportSink]
+    :type in_flight: asyncio.Semaphore
     """
     while True:
-        battle_info, database_key = yield from loop.run_in_executor(None, queuing.get_next_battle_to_report)
+        yield from in_flight.acquire()
+        battle_info, database_key, wait = yield from queuing.get_next_battle_to_report_async(loop)
+        if battle_info is None:
+            in_flight.release()
+            yield from asyncio.sleep(IDLE_POLL_INTERVAL if wait is None else min(wait, IDLE_POLL_INTERVAL), loop=loop)
+            continue
         assert isinstance(battle_info, dict)
-        if should_report(battle_info):
-            text = format_message(battle_info)
-            if SLACK_URL is None:
-                logger.info(text)
-            else:
-                payload = {
-                    "text": text,
-                }
-                slack_response = yield from loop.run_in_executor(None, partial(requests.post, SLACK_URL, json=payload))
-                assert isinstance(slack_response, requests.Response)
-                if slack_response.status_code != 200:
-                    logger.error("Couldn't post to slack! {} ({}, for payload {})"
-                                 .format(slack_response.text, slack_response.status_code, payload))
-                    # When we can't post, let's just go and try the next battle. If we don't tell queuing that we've
-                    # finished the battle, it will just go to the end of the queue, and we'll try to report it again
-                    # once we've reported everything else.
-                    yield from asyncio.sleep(60, loop=loop)
-                    continue  # < don't mark as finished
-            logger.debug("Reported battle {}:{}!".format(battle_info['room'],
-                                                         battle_info['latest_hostilities_detected']))
-        else:
+        if not should_report(battle_info):
             logger.debug("Skipping battle {}:{} ({}).".format(battle_info['room'],
                                                               battle_info['latest_hostilities_detected'],
                                                               describe_battle(battle_info)))
-        yield from loop.run_in_executor(None, queuing.mark_battle_reported, database_key)
+            yield from queuing.mark_battle_reported_async(loop, database_key)
+            in_flight.release()
+            continue
+
+        dispatch = _Dispatch(battle_info, database_key, loop.time())
+        delivered_to = yield from queuing.get_battle_deliveries_async(loop, dispatch.battle_id)
+        for sink in sinks:
+            if sink.name in delivered_to:
+                continue
+            if sink.offer(loop, dispatch):
+                dispatch.waiting.add(sink)
+            elif sink.required:
+                dispatch.defer(REPORT_DEFER_DELAY)
+        if not dispatch.waiting:
+            yield from _settle(loop, dispatch)
+            in_flight.release()
+
+
+@asyncio.coroutine
+def _settle(loop, dispatch):
+    """
+    Marks a battle reported, or hands it back to be retried, once no sinks are working on it any more.
+    :type loop: asyncio.events.AbstractEventLoop
+    :type dispatch: _Dispatch
+    """
+    if dispatch.retry_delay is None:
+        yield from queuing.mark_battle_reported_async(loop, dispatch.database_key)
+        age = history_timing.seconds_since_tick(dispatch.battle_info['latest_hostilities_detected'])
+        if age is not None:
+            metrics.BATTLE_AGE_AT_REPORT.observe(age)
+        logger.debug("Reported battle {}:{}!".format(dispatch.battle_info['room'],
+                                                     dispatch.battle_info['latest_hostilities_detected']))
+    else:
+        yield from queuing.retry_battle_report_async(loop, dispatch.database_key, dispatch.retry_delay)
 
 
 def should_report(battle_info):
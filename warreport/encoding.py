@@ -0,0 +1,232 @@
+"""
+A compact binary encoding for the JSON-like payloads we store in redis, such as finished battles waiting to be
+reported.
+
+Encoded payloads start with a format version byte. JSON payloads always start with '{' or '[', so decode tells the two
+apart, and still accepts anything stored as JSON before this format was used.
+
+Within a payload:
+
+- strings are interned: each distinct string is written out once, and later uses refer back to it by index
+- strings of 24 hex characters (creep IDs, user IDs and other object IDs) are packed into 12 bytes
+- field names and creep roles we use everywhere are interned up front, and cost one byte wherever they appear
+- integers are written as zigzag varints
+
+The up front strings are part of the format version: changing them means adding a new FORMAT_VERSION, and keeping the
+old list around to decode payloads written with it.
+"""
+import binascii
+import re
+import struct
+
+try:
+    import rapidjson as json
+except ImportError:
+    import json
+
+from warreport import constants
+
+__all__ = ["encode", "decode", "pack_object_id", "unpack_object_id", "FORMAT_VERSION"]
+
+FORMAT_VERSION = 1
+
+_KNOWN_STRINGS = {
+    1: (
+        # Battle data fields, see storage.py
+        'max_tick_checked', 'tick_to_check', 'player_creep_counts', 'creeps_found', 'usernames', 'owner', 'rcl',
+        'earliest_hostilities_detected', 'earliest_hostilities_collided', 'latest_hostilities_detected', 'duration',
+        'stop_checking_at', 'battle_still_ongoing', 'alliances', 'room',
+        # Creep roles
+        constants.ranged_attacker, constants.melee_attacker, constants.healer, constants.dismantling_attacker,
+        constants.general_attacker, constants.tough_attacker, constants.work_and_carry_attacker, constants.civilian,
+        constants.scout,
+    ),
+}
+
+_NONE, _FALSE, _TRUE, _INT, _FLOAT, _NEW_STRING, _STRING_REF, _NEW_OBJECT_ID, _LIST, _DICT, _SET = range(11)
+
+_OBJECT_ID_PATTERN = re.compile('[0-9a-f]{24}')
+_double = struct.Struct('<d')
+
+
+def pack_object_id(object_id):
+    """
+    Packs a 24 hex character object ID into 12 bytes. Anything which isn't one is UTF-8 encoded, with a NUL byte
+    appended if it's 12 bytes or longer, so a packed ID is the only value which is exactly 12 bytes long.
+    :type object_id: str
+    :rtype: bytes
+    """
+    if _OBJECT_ID_PATTERN.fullmatch(object_id):
+        return binascii.unhexlify(object_id)
+    raw = object_id.encode()
+    if len(raw) >= 12:
+        raw += b'\x00'
+    return raw
+
+
+def unpack_object_id(raw):
+    """
+    Reverses pack_object_id.
+    :type raw: bytes
+    :rtype: str
+    """
+    if len(raw) == 12:
+        return binascii.hexlify(raw).decode()
+    if len(raw) > 12 and raw.endswith(b'\x00'):
+        raw = raw[:-1]
+    return raw.decode()
+
+
+def _write_varint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, position):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, position
+        shift += 7
+
+
+class _Encoder:
+    def __init__(self):
+        self.out = bytearray((FORMAT_VERSION,))
+        self.strings = {string: index for index, string in enumerate(_KNOWN_STRINGS[FORMAT_VERSION])}
+
+    def write(self, value):
+        out = self.out
+        if value is None:
+            out.append(_NONE)
+        elif value is True:
+            out.append(_TRUE)
+        elif value is False:
+            out.append(_FALSE)
+        elif isinstance(value, int):
+            out.append(_INT)
+            _write_varint(out, (value << 1) if value >= 0 else ((-value << 1) - 1))
+        elif isinstance(value, float):
+            out.append(_FLOAT)
+            out += _double.pack(value)
+        elif isinstance(value, str):
+            self.write_string(value)
+        elif isinstance(value, dict):
+            out.append(_DICT)
+            _write_varint(out, len(value))
+            for key, item in value.items():
+                self.write_string(key)
+                self.write(item)
+        elif isinstance(value, (set, frozenset)):
+            out.append(_SET)
+            _write_varint(out, len(value))
+            for item in value:
+                self.write(item)
+        elif isinstance(value, (list, tuple)):
+            out.append(_LIST)
+            _write_varint(out, len(value))
+            for item in value:
+                self.write(item)
+        else:
+            raise TypeError("Can't encode {!r}".format(value))
+
+    def write_string(self, value):
+        out = self.out
+        index = self.strings.get(value)
+        if index is not None:
+            out.append(_STRING_REF)
+            _write_varint(out, index)
+            return
+        self.strings[value] = len(self.strings)
+        if _OBJECT_ID_PATTERN.fullmatch(value):
+            out.append(_NEW_OBJECT_ID)
+            out += binascii.unhexlify(value)
+        else:
+            raw = value.encode()
+            out.append(_NEW_STRING)
+            _write_varint(out, len(raw))
+            out += raw
+
+
+class _Decoder:
+    def __init__(self, data):
+        self.data = data
+        self.position = 1
+        self.strings = list(_KNOWN_STRINGS[data[0]])
+
+    def read(self):
+        data = self.data
+        tag = data[self.position]
+        self.position += 1
+        if tag == _NONE:
+            return None
+        elif tag == _TRUE:
+            return True
+        elif tag == _FALSE:
+            return False
+        elif tag == _INT:
+            zigzag, self.position = _read_varint(data, self.position)
+            return (zigzag >> 1) if not zigzag & 1 else -((zigzag + 1) >> 1)
+        elif tag == _FLOAT:
+            value, = _double.unpack_from(data, self.position)
+            self.position += 8
+            return value
+        elif tag == _DICT:
+            count, self.position = _read_varint(data, self.position)
+            result = {}
+            for _ in range(count):
+                # Not a dict comprehension: before python 3.8, those evaluate each value before its key.
+                key = self.read()
+                result[key] = self.read()
+            return result
+        elif tag == _SET:
+            count, self.position = _read_varint(data, self.position)
+            return {self.read() for _ in range(count)}
+        elif tag == _LIST:
+            count, self.position = _read_varint(data, self.position)
+            return [self.read() for _ in range(count)]
+        else:
+            return self.read_string(tag)
+
+    def read_string(self, tag):
+        data = self.data
+        if tag == _STRING_REF:
+            index, self.position = _read_varint(data, self.position)
+            return self.strings[index]
+        elif tag == _NEW_OBJECT_ID:
+            value = binascii.hexlify(data[self.position:self.position + 12]).decode()
+            self.position += 12
+        elif tag == _NEW_STRING:
+            length, self.position = _read_varint(data, self.position)
+            value = data[self.position:self.position + length].decode()
+            self.position += length
+        else:
+            raise ValueError("Unknown tag {} at byte {}".format(tag, self.position - 1))
+        self.strings.append(value)
+        return value
+
+
+def encode(value):
+    """
+    Encodes a JSON-like value: dicts with string keys, lists, sets, strings, ints, floats, bools and None.
+    :rtype: bytes
+    """
+    encoder = _Encoder()
+    encoder.write(value)
+    return bytes(encoder.out)
+
+
+def decode(raw):
+    """
+    Decodes a value encoded with encode, or stored as JSON. Sets stored as JSON come back as lists.
+    :type raw: bytes
+    """
+    if raw[0] in _KNOWN_STRINGS:
+        return _Decoder(raw).read()
+    return json.loads(raw.decode())
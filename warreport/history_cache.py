@@ -0,0 +1,217 @@
+"""
+A local on-disk cache of room history segments.
+
+A `room-history/{room}/{tick}.json` segment never changes once it's been generated, so once we've successfully
+downloaded one we never need to download it again: not when the forward search walks back over segments the backward
+search already pulled, not when a room is re-queued for a follow-up battle, and not when reprocessing after a restart.
+
+Segments are stored gzipped under HISTORY_CACHE_DIRECTORY, one file per (room, tick). The cache is capped at
+HISTORY_CACHE_MAX_BYTES of compressed data, evicting the least recently used segments first. Recency is kept in file
+modification times, so it survives restarts.
+
+With several processor processes, they all share the one directory. Each keeps an index of it in memory, but rescans
+the directory every HISTORY_CACHE_RESCAN_SECONDS while storing segments, so that the cap applies to everything in the
+directory and not just to the segments that process stored itself.
+
+Segments which were missing (a 404) or an empty document are remembered too, in redis so that every process sees them,
+with an expiry that grows as the segment gets older. Fetching them again is skipped until the entry expires.
+"""
+import gzip
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from warreport import storage, history_parser, history_timing, HISTORY_CACHE_DIRECTORY, HISTORY_CACHE_MAX_BYTES
+from warreport.key_constants import MISSING_SEGMENT_EXPIRE_FRACTION, MISSING_SEGMENT_MIN_EXPIRE, \
+    MISSING_SEGMENT_MAX_EXPIRE, HISTORY_CACHE_RESCAN_SECONDS
+
+__all__ = ["get", "put", "get_missing", "put_missing", "stats", "MISSING", "EMPTY"]
+
+MISSING = "missing"
+EMPTY = "empty"
+
+logger = logging.getLogger("warreport")
+
+_lock = threading.Lock()
+# Maps path -> compressed size, least recently used first. None until the directory has been scanned.
+_entries = None
+_total_bytes = 0
+# time.monotonic() of the last scan of the directory.
+_last_scan = 0
+_stats = {
+    'hits': 0,
+    'misses': 0,
+    'stores': 0,
+    'evictions': 0,
+    # Fetches skipped because the segment was recently missing, or an empty document.
+    'missing_suppressed': 0,
+    'empty_suppressed': 0,
+    'missing_stored': 0,
+}
+
+
+def _path_for(room, tick):
+    return os.path.join(HISTORY_CACHE_DIRECTORY, room, "{}.json.gz".format(tick))
+
+
+def _load_index():
+    """
+    Scans the cache directory, ordering existing segments by modification time. Must be called with _lock held.
+    """
+    global _entries, _total_bytes, _last_scan
+    _last_scan = time.monotonic()
+    found = []
+    for dir_path, dir_names, file_names in os.walk(HISTORY_CACHE_DIRECTORY):
+        for file_name in file_names:
+            if not file_name.endswith(".json.gz"):
+                continue
+            path = os.path.join(dir_path, file_name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            found.append((stat.st_mtime, path, stat.st_size))
+    found.sort()
+    _entries = OrderedDict((path, size) for mtime, path, size in found)
+    _total_bytes = sum(size for mtime, path, size in found)
+    logger.debug("Loaded history cache index: {} segments, {} bytes.".format(len(_entries), _total_bytes))
+
+
+def _evict():
+    """
+    Removes least recently used segments until we're under the size cap. Must be called with _lock held.
+    """
+    global _total_bytes
+    while _total_bytes > HISTORY_CACHE_MAX_BYTES and _entries:
+        path, size = _entries.popitem(last=False)
+        _total_bytes -= size
+        _stats['evictions'] += 1
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def get(room, tick):
+    """
+    Gets a cached history segment.
+    :param room: The room
+    :param tick: The segment's tick, an interval of 20
+    :return: The segment in compact form (see history_parser), or None if it isn't cached.
+    :rtype: None | dict[str, Any]
+    """
+    if HISTORY_CACHE_DIRECTORY is None:
+        return None
+    global _total_bytes
+    path = _path_for(room, tick)
+    with _lock:
+        if _entries is None:
+            _load_index()
+        if path not in _entries:
+            # It may have been stored by another process since we last scanned.
+            try:
+                _entries[path] = os.stat(path).st_size
+            except OSError:
+                _stats['misses'] += 1
+                return None
+            _total_bytes += _entries[path]
+        _entries.move_to_end(path)
+    try:
+        with gzip.open(path, 'rb') as f:
+            raw = f.read()
+        os.utime(path, None)
+        result = history_parser.parse_history(raw)
+        if result is None:
+            raise ValueError("Empty history document")
+    except (OSError, ValueError):
+        logger.warning("Unreadable history cache entry {}, discarding it.".format(path))
+        _discard(path)
+        with _lock:
+            _stats['misses'] += 1
+        return None
+    with _lock:
+        _stats['hits'] += 1
+    return result
+
+
+def put(room, tick, content):
+    """
+    Stores a history segment. Only segments which have been successfully downloaded and decoded should be stored: these
+    are then assumed to never change.
+    :param room: The room
+    :param tick: The segment's tick, an interval of 20
+    :param content: The raw response body
+    :type content: bytes
+    """
+    if HISTORY_CACHE_DIRECTORY is None:
+        return
+    global _total_bytes
+    path = _path_for(room, tick)
+    compressed = gzip.compress(content, compresslevel=5)
+    temp_path = "{}.{}.tmp".format(path, threading.get_ident())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(temp_path, 'wb') as f:
+            f.write(compressed)
+        os.replace(temp_path, path)
+    except OSError:
+        logger.exception("Error writing history cache entry {}.".format(path))
+        return
+    with _lock:
+        if _entries is None or time.monotonic() - _last_scan > HISTORY_CACHE_RESCAN_SECONDS:
+            _load_index()
+        _total_bytes -= _entries.pop(path, 0)
+        _entries[path] = len(compressed)
+        _total_bytes += len(compressed)
+        _stats['stores'] += 1
+        _evict()
+
+
+def get_missing(room, tick):
+    """
+    Checks whether a segment was recently found missing or empty, with put_missing.
+    :return: MISSING, EMPTY, or None if the segment should be fetched.
+    """
+    kind = storage.get_missing_segment(room, tick)
+    if kind is not None:
+        with _lock:
+            _stats['missing_suppressed' if kind == MISSING else 'empty_suppressed'] += 1
+    return kind
+
+
+def put_missing(room, tick, kind):
+    """
+    Remembers that a segment was missing or empty, for MISSING_SEGMENT_EXPIRE_FRACTION of the time since it ended.
+    :param kind: MISSING or EMPTY
+    """
+    age = history_timing.seconds_since_segment_ended(tick) or 0
+    expire = min(MISSING_SEGMENT_MAX_EXPIRE, max(MISSING_SEGMENT_MIN_EXPIRE, age * MISSING_SEGMENT_EXPIRE_FRACTION))
+    storage.set_missing_segment(room, tick, kind, expire)
+    with _lock:
+        _stats['missing_stored'] += 1
+
+
+def _discard(path):
+    global _total_bytes
+    with _lock:
+        if _entries is not None and path in _entries:
+            _total_bytes -= _entries.pop(path)
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def stats():
+    """
+    :return: A dict of hit, miss, store and eviction counts since startup, plus the number of segments and compressed
+             bytes currently cached, and counts of missing and empty segments remembered and fetches suppressed.
+    :rtype: dict[str, int]
+    """
+    with _lock:
+        result = dict(_stats)
+        result['segments'] = len(_entries) if _entries is not None else 0
+        result['bytes'] = _total_bytes
+    return result
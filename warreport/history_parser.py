@@ -0,0 +1,269 @@
+"""
+Decodes room history segments into the compact, partly columnar form modify_data_with_history works on.
+
+A full history segment holds every structure, road and wall in the room on its first tick, and every change to every
+object on later ticks. We only need a small part of it: creeps' type/user/body, the controller's owner and level,
+and which objects did something hostile on which ticks. A compact segment keeps just those:
+
+{
+    # Creeps and the controller, in the same shape as in the full segment but only with the fields we use. Every tick
+    # is kept, even when none of its objects are.
+    'ticks': {
+        '1234560': {
+            '582f8e657a1fc8bf5cd28be5': {'type': 'creep', 'user': '57874d42d0ae911e3bd15bbc',
+                                         'body': [{'type': 'move'}, {'type': 'attack'}]},
+            '579fa8f20700be0674d2c15f': {'type': 'controller', 'user': '57874d42d0ae911e3bd15bbc', 'level': 5},
+        },
+        '1234561': {},
+        # ...
+    },
+    # The first and last tick numbers in 'ticks', or None if there are no ticks.
+    'first_tick': 1234560,
+    'last_tick': 1234579,
+    # Every object which did something hostile, in the order first seen.
+    'objects': ['582f8116e8c62a5d2e464ad2', ...],
+    # One row for each (tick, object) where the object did something hostile, as parallel arrays: the tick, the
+    # object's index in 'objects', and a bitmask of ACTION_FLAGS.
+    'columns': {
+        'tick': array('l', [1234560, 1234561, ...]),
+        'object': array('l', [0, 0, ...]),
+        'actions': array('B', [2, 1, ...]),
+    },
+}
+
+parse_history never builds the full segment: it walks the top level of the document itself, decodes one tick at a
+time with the C JSON scanner, and compacts each tick before decoding the next. Peak memory is then the response text
+plus one tick's objects rather than the whole segment. Walking further down in Python, to skip individual structures,
+was measured to cost more than decoding them. On 406 KiB synthetic segments (benchmarks/history_parsing.py) this takes
+decoding from 16.0 to 9.4 ms and its peak memory from 4178 to 2391 KiB, and a decoded segment waiting to be analyzed
+holds 207 KiB rather than 3491 KiB.
+"""
+import json
+import re
+from array import array
+from json.decoder import scanstring as _scanstring
+
+__all__ = ["parse_history", "compact_segment", "hostility_window", "ACTION_FLAGS"]
+
+ACTION_FLAGS = {
+    'attack': 1,
+    'rangedAttack': 2,
+    'rangedMassAttack': 4,
+    'heal': 8,
+    'rangedHeal': 16,
+}
+_ACTION_FLAG_ITEMS = tuple(ACTION_FLAGS.items())
+
+_scan_once = json.JSONDecoder().scan_once
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+# Body parts only keep their type, so every part of the same type can share one (never modified) dict.
+_body_parts = {}
+
+
+def _body_part(part_type):
+    part = _body_parts.get(part_type)
+    if part is None:
+        part = _body_parts.setdefault(part_type, {'type': part_type})
+    return part
+
+
+class _SegmentCompactor:
+    """
+    Builds a compact segment one tick at a time, so a segment can be compacted while it's being decoded.
+    """
+
+    def __init__(self):
+        self.ticks = {}
+        self.first_tick = None
+        self.last_tick = None
+        self.objects = []
+        self.object_indices = {}
+        self.tick_column = array('l')
+        self.object_column = array('l')
+        self.actions_column = array('B')
+
+    def add_tick(self, tick, tick_data):
+        """
+        Compacts one tick of a full history segment.
+        :param tick: The tick number, as a string
+        :param tick_data: The tick's objects
+        :type tick: str
+        :type tick_data: dict[str, dict[str, Any]]
+        """
+        tick_number = int(tick)
+        if self.first_tick is None or tick_number < self.first_tick:
+            self.first_tick = tick_number
+        if self.last_tick is None or tick_number > self.last_tick:
+            self.last_tick = tick_number
+        compact_objects = {}
+        self.ticks[tick] = compact_objects
+        if not tick_data:
+            return
+        objects = self.objects
+        object_indices = self.object_indices
+        for obj_id, obj_data in tick_data.items():
+            if not obj_data:
+                continue
+            obj_type = obj_data.get('type')
+            if obj_type == 'creep':
+                compact_objects[obj_id] = {
+                    'type': obj_type,
+                    'user': obj_data.get('user'),
+                    'body': [_body_part(part.get('type')) for part in obj_data.get('body') or ()],
+                }
+            elif obj_type == 'controller':
+                compact = {'type': obj_type, 'level': obj_data.get('level')}
+                if obj_data.get('user') is not None:
+                    compact['user'] = obj_data['user']
+                reservation = obj_data.get('reservation')
+                if reservation is not None:
+                    compact['reservation'] = {'user': reservation.get('user')}
+                compact_objects[obj_id] = compact
+            action_log = obj_data.get('actionLog')
+            if action_log:
+                flags = 0
+                for action, flag in _ACTION_FLAG_ITEMS:
+                    if action_log.get(action):
+                        flags |= flag
+                if flags:
+                    index = object_indices.get(obj_id)
+                    if index is None:
+                        index = object_indices[obj_id] = len(objects)
+                        objects.append(obj_id)
+                    self.tick_column.append(tick_number)
+                    self.object_column.append(index)
+                    self.actions_column.append(flags)
+
+    def result(self):
+        """
+        :return: The compact segment, as described in the module docs.
+        """
+        return {
+            'ticks': self.ticks,
+            'first_tick': self.first_tick,
+            'last_tick': self.last_tick,
+            'objects': self.objects,
+            'columns': {
+                'tick': self.tick_column,
+                'object': self.object_column,
+                'actions': self.actions_column,
+            },
+        }
+
+
+def compact_segment(full_ticks):
+    """
+    Compacts the ticks of a full history segment.
+    :param full_ticks: The 'ticks' of a full history segment
+    :type full_ticks: dict[str, dict[str, dict[str, Any]]]
+    :return: The compact segment, as described in the module docs.
+    """
+    compactor = _SegmentCompactor()
+    for tick, tick_data in full_ticks.items():
+        compactor.add_tick(tick, tick_data)
+    return compactor.result()
+
+
+def hostility_window(segment, excluded=None):
+    """
+    Finds the earliest and latest ticks in a compact segment on which anything did something hostile.
+    :param segment: A compact segment
+    :param excluded: A set of (tick, object_id) whose actions shouldn't count
+    :type excluded: set[(int, str)]
+    :return: A tuple of (earliest, latest), both None if there were no hostilities.
+    :rtype: (int | None, int | None)
+    """
+    tick_column = segment['columns']['tick']
+    if excluded:
+        objects = segment['objects']
+        tick_column = [tick for tick, index in zip(tick_column, segment['columns']['object'])
+                       if (tick, objects[index]) not in excluded]
+    if not tick_column:
+        return None, None
+    return min(tick_column), max(tick_column)
+
+
+def _skip_whitespace(text, index):
+    return _WHITESPACE.match(text, index).end()
+
+
+def _scan_value(text, index):
+    """
+    Decodes the JSON value starting at text[index] with the C scanner.
+    :return: A tuple of (value, index just past the value)
+    :raises ValueError: if there's no valid value there
+    """
+    try:
+        return _scan_once(text, index)
+    except StopIteration as e:
+        raise ValueError("Expecting value: char {}".format(e.value)) from None
+
+
+def _scan_object(text, index, on_member):
+    """
+    Walks the JSON object starting at text[index] one member at a time, without decoding the members' values.
+    :param on_member: Called with (key, index of the value) for each member, and must return the index just past the
+                      value.
+    :type on_member: (str, int) -> int
+    :return: The index just past the object
+    :raises ValueError: if the object isn't valid JSON
+    """
+    if text[index:index + 1] != '{':
+        raise ValueError("Expecting '{{': char {}".format(index))
+    index = _skip_whitespace(text, index + 1)
+    if text[index:index + 1] == '}':
+        return index + 1
+    while True:
+        if text[index:index + 1] != '"':
+            raise ValueError("Expecting property name: char {}".format(index))
+        key, index = _scanstring(text, index + 1)
+        index = _skip_whitespace(text, index)
+        if text[index:index + 1] != ':':
+            raise ValueError("Expecting ':': char {}".format(index))
+        index = _skip_whitespace(text, on_member(key, _skip_whitespace(text, index + 1)))
+        delimiter = text[index:index + 1]
+        if delimiter == '}':
+            return index + 1
+        if delimiter != ',':
+            raise ValueError("Expecting ',' or '}}': char {}".format(index))
+        index = _skip_whitespace(text, index + 1)
+
+
+def parse_history(content):
+    """
+    Decodes a history segment into its compact form, one tick at a time.
+    :param content: The raw history segment
+    :type content: bytes
+    :return: The compact segment, or None if the document was empty or had no ticks.
+    :raises ValueError: if the document isn't valid JSON
+    """
+    text = content.decode()
+    index = _skip_whitespace(text, 0)
+    if text[index:index + 1] != '{':
+        # Not a segment: only check it's valid.
+        json.loads(text)
+        return None
+    compactor = _SegmentCompactor()
+    found_ticks = False
+
+    def on_tick(tick, value_index):
+        tick_data, end = _scan_value(text, value_index)
+        compactor.add_tick(tick, tick_data)
+        return end
+
+    def on_member(key, value_index):
+        nonlocal found_ticks
+        if key == 'ticks':
+            found_ticks = True
+            if text.startswith('null', value_index):
+                return value_index + 4
+            return _scan_object(text, value_index, on_tick)
+        return _scan_value(text, value_index)[1]
+
+    end = _scan_object(text, index, on_member)
+    if _skip_whitespace(text, end) != len(text):
+        raise ValueError("Extra data: char {}".format(end))
+    if not found_ticks:
+        return None
+    return compactor.result()
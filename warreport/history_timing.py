@@ -0,0 +1,246 @@
+"""
+Predicts when room history segments become available, so that we only ask for segments which should exist by now
+rather than finding out from a 404.
+
+Two things are tracked:
+
+- the server's tick clock: which tick it was on at some time, and how many seconds each tick takes. This comes from the
+  pvp API's `time` each time we poll it for new battles, and is shared between processes through redis. It's also
+  moved forwards whenever a history segment turns up which the clock says couldn't exist yet.
+- how long after its last tick a segment appears. A segment starting at tick T holds ticks T to T + 19, so it's
+  predicted to be available some offset after the clock reaches T + 20.
+
+We only learn about the offset from fetching segments around when they're predicted to be available, which either
+finds them or doesn't. So the offset is nudged up a step each time a segment is missing when we thought it'd be there,
+and down a fraction of a step each time one is found: it settles where TARGET_FOUND of first fetches find the segment.
+Segments we've seen go from missing to available are also used to measure how far predictions are off.
+
+Until the clock has been observed twice, we don't know how fast ticks are and every segment is assumed to be available.
+
+Everything here is per process and safe to use from any thread.
+"""
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+from warreport import async_redis
+from warreport.key_constants import TICK_CLOCK_KEY, TICK_CLOCK_EXPIRE
+
+__all__ = ["observe_server_tick", "observe_fetch", "record_deferred", "is_probably_available",
+           "seconds_until_available", "seconds_since_tick", "seconds_since_segment_ended", "publish_clock_async",
+           "refresh_clock_async", "stats"]
+
+# Fraction of segments which should be there when first asked for: the rest are 404s spent finding out how soon we can
+# ask.
+TARGET_FOUND = 0.9
+# Seconds the availability offset moves up when a segment we expected isn't there.
+_OFFSET_STEP = 2.0
+# Weight given to each new observation in the running averages.
+_SMOOTHING = 0.2
+# Observations of the server tick closer together than this many seconds are too noisy to estimate tick length from.
+_MIN_TICK_LENGTH_SPAN = 20
+# Most (room, tick) segments to remember having found missing, to learn when they appear.
+_MAX_MISSING_REMEMBERED = 10000
+
+_lock = threading.Lock()
+_clock = {
+    'tick': None,
+    'time': None,
+    'seconds_per_tick': None,
+    # The observation seconds_per_tick was last measured from.
+    'measured_tick': None,
+    'measured_time': None,
+}
+# Seconds after the clock reaches the end of a segment at which we expect it to be available.
+_offset = {
+    'seconds': 0.0,
+}
+# (room, tick) -> the last time the segment was found missing.
+_missing = OrderedDict()
+_stats = {
+    # Fetches skipped because the segment wasn't predicted to be available yet: 404s avoided.
+    'deferred': 0,
+    # Fetches which found the segment missing anyways, and how many of those it was predicted to be available for.
+    'not_found': 0,
+    'early_predictions': 0,
+    # Segments seen appearing, and the average absolute difference between when each was predicted to be available and
+    # when it appeared.
+    'error_samples': 0,
+    'mean_abs_error': 0.0,
+}
+
+
+def _time_of_tick(tick):
+    return _clock['time'] + (tick - _clock['tick']) * _clock['seconds_per_tick']
+
+
+def _tick_at(at):
+    return _clock['tick'] + (at - _clock['time']) / _clock['seconds_per_tick']
+
+
+def _available_at(tick):
+    return _time_of_tick(tick + 20) + _offset['seconds']
+
+
+def observe_server_tick(tick, at=None):
+    """
+    Records that the server was on the given tick, as reported by the pvp API.
+    :param tick: The server's tick
+    :param at: The unix time it was on that tick, by default now
+    """
+    at = time.time() if at is None else at
+    with _lock:
+        if _clock['measured_tick'] is None:
+            _clock['measured_tick'] = tick
+            _clock['measured_time'] = at
+        elif tick > _clock['measured_tick'] and at - _clock['measured_time'] >= _MIN_TICK_LENGTH_SPAN:
+            sample = (at - _clock['measured_time']) / (tick - _clock['measured_tick'])
+            if _clock['seconds_per_tick'] is None:
+                _clock['seconds_per_tick'] = sample
+            else:
+                _clock['seconds_per_tick'] += _SMOOTHING * (sample - _clock['seconds_per_tick'])
+            _clock['measured_tick'] = tick
+            _clock['measured_time'] = at
+        _clock['tick'] = tick
+        _clock['time'] = at
+
+
+def observe_fetch(room, tick, available, at=None):
+    """
+    Records the result of fetching a history segment from the server (not from a cache).
+    :param room: The room
+    :param tick: The segment's first tick
+    :param available: True if the segment was returned, False if the fetch was a 404. Other errors say nothing about
+                      the segment, so shouldn't be recorded.
+    :param at: The unix time of the fetch, by default now
+    """
+    at = time.time() if at is None else at
+    key = (room, tick)
+    with _lock:
+        if not available:
+            _stats['not_found'] += 1
+            _missing[key] = at
+            _missing.move_to_end(key)
+            while len(_missing) > _MAX_MISSING_REMEMBERED:
+                _missing.popitem(last=False)
+        missing_at = _missing.pop(key, None) if available else None
+        if _clock['seconds_per_tick'] is None:
+            return
+        ended_at = _time_of_tick(tick + 20)
+        if not available:
+            if at >= _available_at(tick):
+                _stats['early_predictions'] += 1
+                _offset['seconds'] += _OFFSET_STEP * TARGET_FOUND
+            return
+        if _tick_at(at) < tick + 20:
+            # The server must have got past this segment, whatever our clock says.
+            _clock['tick'] = tick + 20
+            _clock['time'] = at
+            ended_at = at
+        if missing_at is not None:
+            appeared_at = (missing_at + at) / 2
+            _stats['error_samples'] += 1
+            _stats['mean_abs_error'] += _SMOOTHING * (abs(_available_at(tick) - appeared_at) - _stats['mean_abs_error'])
+        if at - ended_at <= _offset['seconds'] + _OFFSET_STEP:
+            # Found about when we predicted. Segments fetched long after that say nothing about how soon we could have.
+            _offset['seconds'] = max(0.0, _offset['seconds'] - _OFFSET_STEP * (1 - TARGET_FOUND))
+
+
+def record_deferred():
+    """
+    Records that a fetch was skipped because is_probably_available said no.
+    """
+    with _lock:
+        _stats['deferred'] += 1
+
+
+def is_probably_available(tick, at=None):
+    """
+    :param tick: A segment's first tick
+    :param at: The unix time to predict for, by default now
+    :return: Whether the segment should be available from the server at the given time
+    """
+    at = time.time() if at is None else at
+    with _lock:
+        return _clock['seconds_per_tick'] is None or at >= _available_at(tick)
+
+
+def seconds_until_available(tick):
+    """
+    :param tick: A segment's first tick
+    :return: Seconds from now until the segment should be available, 0 if it already should be, or None if we don't
+             know yet.
+    :rtype: float | None
+    """
+    with _lock:
+        if _clock['seconds_per_tick'] is None:
+            return None
+        return max(0.0, _available_at(tick) - time.time())
+
+
+def seconds_since_tick(tick):
+    """
+    :param tick: A server tick
+    :return: Seconds since the clock reached the given tick (negative if it hasn't yet), or None if we don't know yet.
+    :rtype: float | None
+    """
+    with _lock:
+        if _clock['seconds_per_tick'] is None:
+            return None
+        return time.time() - _time_of_tick(tick)
+
+
+def seconds_since_segment_ended(tick):
+    """
+    :param tick: A segment's first tick
+    :return: Seconds since the clock passed the segment's last tick (negative if it hasn't yet), or None if we don't
+             know yet.
+    :rtype: float | None
+    """
+    with _lock:
+        if _clock['seconds_per_tick'] is None:
+            return None
+        return time.time() - _time_of_tick(tick + 20)
+
+
+@asyncio.coroutine
+def publish_clock_async(loop):
+    """
+    Stores this process's tick clock in redis, for refresh_clock_async in other processes.
+    :type loop: asyncio.events.AbstractEventLoop
+    """
+    with _lock:
+        if _clock['seconds_per_tick'] is None:
+            return
+        state = dict(_clock)
+    yield from async_redis.get_pool(loop).pipeline([
+        ('HMSET', TICK_CLOCK_KEY, 'tick', state['tick'], 'time', state['time'], 'seconds_per_tick',
+         state['seconds_per_tick']),
+        ('EXPIRE', TICK_CLOCK_KEY, TICK_CLOCK_EXPIRE),
+    ], idempotent=True)
+
+
+@asyncio.coroutine
+def refresh_clock_async(loop):
+    """
+    Takes the tick clock stored in redis by publish_clock_async, if it's more recent than this process's.
+    :type loop: asyncio.events.AbstractEventLoop
+    """
+    stored = yield from async_redis.get_pool(loop).execute('HGETALL', TICK_CLOCK_KEY, idempotent=True)
+    if not stored:
+        return
+    fields = {stored[i].decode(): float(stored[i + 1]) for i in range(0, len(stored), 2)}
+    with _lock:
+        if _clock['time'] is None or fields['time'] > _clock['time']:
+            _clock['tick'] = fields['tick']
+            _clock['time'] = fields['time']
+            _clock['seconds_per_tick'] = fields['seconds_per_tick']
+
+
+def stats():
+    """
+    :return: The predictor's current estimates, and counts of how it's done. See _stats.
+    """
+    with _lock:
+        return dict(_stats, seconds_per_tick=_clock['seconds_per_tick'], offset=_offset['seconds'])
@@ -1,29 +1,89 @@
 from warreport import DATABASE_PREFIX
 
 _VERSION = "0.2"
-PROCESSING_QUEUE = DATABASE_PREFIX + _VERSION + ":processing_queue"
+# Sorted sets of rooms to process, one per partition, scored by the unix time at which each room is next worth looking
+# at. Rooms are assigned to partitions by queuing.room_partition.
+PROCESSING_SCHEDULE_KEY = DATABASE_PREFIX + _VERSION + ":processing_schedule:{}"
+# The number of partitions PROCESSING_SCHEDULE_KEY is currently split into.
+PROCESSING_PARTITIONS_KEY = DATABASE_PREFIX + _VERSION + ":processing_partitions"
 PROCESSING_QUEUE_SET = DATABASE_PREFIX + _VERSION + ":processing_set"
+# Hash of room name -> lease token, for rooms currently taken from a processing schedule.
+PROCESSING_LEASES = DATABASE_PREFIX + _VERSION + ":processing_leases"
+# The single sorted set rooms to process used to be kept in, and before that the list. Only read to migrate old rooms.
+PROCESSING_SCHEDULE = DATABASE_PREFIX + _VERSION + ":processing_schedule"
+PROCESSING_QUEUE = DATABASE_PREFIX + _VERSION + ":processing_queue"
 
+# Sorted set of battle IDs to report, scored by the unix time at which each is next due to be reported.
+REPORTING_SCHEDULE = DATABASE_PREFIX + _VERSION + ":reporting_schedule"
+# Hash of battle ID -> finished battle data (encoded with encoding.encode), for every battle in REPORTING_SCHEDULE.
+REPORTING_BATTLES = DATABASE_PREFIX + _VERSION + ":reporting_battles"
+# Hash of battle ID -> lease token, for battles currently taken from REPORTING_SCHEDULE.
+REPORTING_LEASES = DATABASE_PREFIX + _VERSION + ":reporting_leases"
+# Sets of the names of report sinks which have acknowledged a battle, by battle ID, for battles not yet fully reported.
+REPORTING_DELIVERIES_KEY = DATABASE_PREFIX + _VERSION + ":reporting_deliveries:{}"
+# The list finished battles used to be kept in, before REPORTING_SCHEDULE. Only read to migrate old battles over.
 REPORTING_QUEUE = DATABASE_PREFIX + _VERSION + ":reporting_queue"
 
 USERNAME_CACHE_KEY = DATABASE_PREFIX + "cache:username:{}"
 USERNAME_CACHE_EXPIRE = 60 * 60 * 5
 
-ALLIANCE_CACHE_KEY = DATABASE_PREFIX + "cache:alliance:{}"
-ALLIANCE_CACHE_EXPIRE = 60 * 60 * 5
+# Hash of username -> alliance, replaced as a whole whenever alliances.js changes.
+ALLIANCES_KEY = DATABASE_PREFIX + "alliances"
+# Incremented each time ALLIANCES_KEY is replaced, so that in-memory copies know when to reload.
+ALLIANCES_VERSION_KEY = DATABASE_PREFIX + "alliances-version"
+# Hash of the 'etag' and 'last_modified' headers of the alliances.js response ALLIANCES_KEY was built from.
+ALLIANCES_VALIDATORS_KEY = DATABASE_PREFIX + "alliances-validators"
+ALLIANCES_TEMP_KEY = DATABASE_PREFIX + "alliances-incoming"
 
 ALLIANCES_FETCHED_KEY = DATABASE_PREFIX + "fetched-alliance-cache"
 ALLIANCES_FETCHED_EXPIRE = 60 * 60 * 4
 
+# The ongoing battle data for a room is split over these, so that each processing step only writes what changed. See
+# storage.py for what goes in each.
+# Hash of scalar field -> JSON value.
+BATTLE_STATE_KEY = DATABASE_PREFIX + "ongoing-state:{}"
+# Set of creep IDs, packed with encoding.pack_object_id.
+BATTLE_CREEPS_KEY = DATABASE_PREFIX + "ongoing-creeps:{}"
+# Hash of "username:role" -> creep count.
+BATTLE_COUNTS_KEY = DATABASE_PREFIX + "ongoing-counts:{}"
+# Hash of user ID -> username.
+BATTLE_USERNAMES_KEY = DATABASE_PREFIX + "ongoing-usernames:{}"
+# Ongoing battle data used to be stored as one JSON string here. Only read to migrate old data over.
 BATTLE_DATA_KEY = DATABASE_PREFIX + "ongoing-data:{}"
 # if it's still in here for 3 days, something has gone wrong and we can just get rid of it.
 BATTLE_DATA_EXPIRE = 60 * 60 * 24 * 3
 
+# "missing" or "empty", for a history segment (room, tick) which was a 404 or an empty document when last fetched.
+MISSING_SEGMENT_KEY = DATABASE_PREFIX + "missing-segment:{}:{}"
+"""
+Seconds a missing or empty history segment is remembered for: a fraction of the time since the segment ended, within
+these bounds. Segments which have only just ended usually just haven't been generated yet, while ones still missing
+long after probably never will be.
+"""
+MISSING_SEGMENT_EXPIRE_FRACTION = 0.25
+MISSING_SEGMENT_MIN_EXPIRE = 5
+MISSING_SEGMENT_MAX_EXPIRE = 60 * 15
+
+"""
+Seconds between rescans of the history cache directory while storing segments, to count (and evict) segments stored by
+other processes sharing it.
+"""
+HISTORY_CACHE_RESCAN_SECONDS = 60
+
 ROOM_LAST_BATTLE_END_TICK_KEY = DATABASE_PREFIX + "last-finished-battle:{}"
 ROOM_LAST_BATTLE_END_TICK_EXPIRE = 60 * 60 * 24 * 10
 
+"""
+Seconds to remember which sinks a battle has been delivered to after the last delivery, in case it's never fully
+reported.
+"""
+REPORTING_DELIVERIES_EXPIRE = 60 * 60 * 24 * 7
+
 _LAST_CHECKED_TICK_KEY = DATABASE_PREFIX + "last-checked-tick"
 _LAST_CHECKED_TICK_EXPIRE_SECONDS = 60 * 60
+# Hash of the server tick clock, see history_timing: a recent tick, the unix time it was seen, and seconds per tick.
+TICK_CLOCK_KEY = DATABASE_PREFIX + _VERSION + ":tick_clock"
+TICK_CLOCK_EXPIRE = 60 * 60
 
 """
 NOTE: This max ticks is max _history ticks successfully retrieved after starting_.
@@ -35,3 +95,11 @@ This is the hard deadline where no more history collection will be attempted (if
 after the last known hostilities (or the first hostilities if no history has been found), give up.)
 """
 KEEP_IN_QUEUE_FOR_MAX_TICKS_UNSUCCESSFUL = 2000
+
+"""
+When a room or battle is taken from the processing or reporting schedule, it's leased for this many seconds: it's
+rescheduled this far in the future so no one else takes it while it's being worked on. Leases are renewed while work
+continues, and if the process working on one dies, the room or battle is picked up again once its lease runs out.
+"""
+ROOM_LEASE_SECONDS = 60
+REPORT_LEASE_SECONDS = 60
@@ -0,0 +1,190 @@
+"""
+In-process counters and histograms, rendered in the Prometheus text format by metrics_server.
+
+Recording is meant to stay cheap enough for the hot loops: each metric (or each combination of label values, taken
+once up front with labels()) is a couple of numbers behind a lock, with no formatting or allocation until scraped.
+Anything which can be read when scraped instead, like queue lengths and cache statistics, is left to metrics_server.
+
+Every process keeps its own metrics, so with several worker processes each serves its own endpoint.
+"""
+import bisect
+import threading
+
+__all__ = ["Counter", "Histogram", "render", "HISTORY_FETCH_SECONDS", "HISTORY_SEGMENTS", "BATTLES_FETCH_SECONDS",
+           "SINK_DELIVERY_SECONDS", "SINK_DELIVERIES", "BATTLE_AGE_AT_REPORT", "ROOM_WORKER_SECONDS",
+           "USERNAME_LOOKUPS", "ALLIANCE_REFRESHES"]
+
+# Bucket upper bounds, in seconds.
+HTTP_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+AGE_BUCKETS = (60, 120, 300, 600, 900, 1800, 3600, 2 * 3600, 6 * 3600, 24 * 3600)
+
+_metrics = []
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._children = {}
+        self._children_lock = threading.Lock()
+        _metrics.append(self)
+
+    def labels(self, *label_values):
+        """
+        :return: The metric for the given label values, which is best kept rather than looked up on every use.
+        """
+        if len(label_values) != len(self.label_names):
+            raise ValueError("{} takes labels {}, got {}".format(self.name, self.label_names, label_values))
+        label_values = tuple(str(value) for value in label_values)
+        child = self._children.get(label_values)
+        if child is None:
+            with self._children_lock:
+                child = self._children.setdefault(label_values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _label_text(self, label_values, extra=()):
+        pairs = list(zip(self.label_names, label_values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + "}"
+
+    def render(self, lines):
+        lines.append("# HELP {} {}".format(self.name, self.documentation))
+        lines.append("# TYPE {} {}".format(self.name, self.kind))
+        with self._children_lock:
+            children = sorted(self._children.items())
+        for label_values, child in children:
+            self._render_child(lines, label_values, child)
+
+    def _render_child(self, lines, label_values, child):
+        raise NotImplementedError
+
+
+class _CounterValue:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    """
+    A total which only goes up. Without labels, inc() can be called on the counter itself.
+    """
+    kind = "counter"
+
+    def __init__(self, name, documentation, label_names=()):
+        super().__init__(name, documentation, label_names)
+        if not self.label_names:
+            self.inc = self.labels().inc
+
+    def _new_child(self):
+        return _CounterValue()
+
+    def _render_child(self, lines, label_values, child):
+        lines.append("{}{} {}".format(self.name, self._label_text(label_values), _format_value(child.value)))
+
+
+class _HistogramValue:
+    __slots__ = ('upper_bounds', 'counts', 'sum', '_lock')
+
+    def __init__(self, upper_bounds):
+        self.upper_bounds = upper_bounds
+        # One count per bucket, plus one for values above every bound. Only made cumulative when rendered.
+        self.counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.upper_bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class Histogram(_Metric):
+    """
+    Counts of observed values falling under each of a fixed set of bucket bounds. Without labels, observe() can be
+    called on the histogram itself.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=HTTP_BUCKETS):
+        self.upper_bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, label_names)
+        if not self.label_names:
+            self.observe = self.labels().observe
+
+    def _new_child(self):
+        return _HistogramValue(self.upper_bounds)
+
+    def _render_child(self, lines, label_values, child):
+        with child._lock:
+            counts = list(child.counts)
+            total = child.sum
+        cumulative = 0
+        for bound, count in zip(self.upper_bounds + (float('inf'),), counts):
+            cumulative += count
+            label_text = self._label_text(label_values, [('le', _format_value(bound))])
+            lines.append("{}_bucket{} {}".format(self.name, label_text, cumulative))
+        lines.append("{}_sum{} {}".format(self.name, self._label_text(label_values), _format_value(total)))
+        lines.append("{}_count{} {}".format(self.name, self._label_text(label_values), cumulative))
+
+
+def render():
+    """
+    :return: Every metric in the Prometheus text format, as a list of lines.
+    :rtype: list[str]
+    """
+    lines = []
+    for metric in _metrics:
+        metric.render(lines)
+    return lines
+
+
+HISTORY_FETCH_SECONDS = Histogram("warreport_history_fetch_seconds",
+                                  "Time taken by each request for a history segment from the server.")
+HISTORY_SEGMENTS = Counter("warreport_history_segments_total",
+                           "History segments requested from the server, by result: found, not_found, empty or invalid.",
+                           ["result"])
+BATTLES_FETCH_SECONDS = Histogram("warreport_battles_fetch_seconds",
+                                  "Time taken by each poll of the pvp API for new battles.")
+SINK_DELIVERY_SECONDS = Histogram("warreport_sink_delivery_seconds",
+                                  "Time taken by each delivery of battles to a report sink, such as a slack post.",
+                                  ["sink"])
+SINK_DELIVERIES = Counter("warreport_sink_deliveries_total",
+                          "Deliveries of battles to report sinks, by sink and whether the sink took them.",
+                          ["sink", "result"])
+BATTLE_AGE_AT_REPORT = Histogram("warreport_battle_age_at_report_seconds",
+                                 "Seconds from each battle's last hostilities until it was reported, as far as the "
+                                 "tick clock can tell.", buckets=AGE_BUCKETS)
+ROOM_WORKER_SECONDS = Counter("warreport_room_worker_seconds_total",
+                              "Seconds room workers have spent busy processing rooms, and idle waiting for rooms to "
+                              "become due.", ["state"])
+USERNAME_LOOKUPS = Counter("warreport_username_lookups_total",
+                           "Usernames looked up, by where they were found: memory, redis or api.", ["source"])
+ALLIANCE_REFRESHES = Counter("warreport_alliance_refreshes_total",
+                             "Checks of the in-memory alliance data, by result: current if it was up to date, "
+                             "reloaded if it was reloaded from redis, and fetched when alliances.js was fetched.",
+                             ["result"])
@@ -0,0 +1,181 @@
+"""
+Serves this process's metrics (see metrics.py) at /metrics in the Prometheus text format, when `metrics.port` is
+configured.
+
+The server runs on the process's own event loop. Everything only read when scraped is gathered then: cache and
+predictor statistics, HTTP connection reuse, and (from the process given include_queues) the lengths of the redis
+queues, so none of it costs anything between scrapes.
+
+In single process mode the endpoint is on `metrics.port`. With worker processes, battle discovery serves on
+`metrics.port`, processor N on `metrics.port` + 1 + N, and reporter N on the ports after the processors', so each is
+scraped as its own target.
+"""
+import asyncio
+import logging
+import time
+from functools import partial
+
+from warreport import metrics, history_cache, history_timing, screeps_info, queuing, async_redis, METRICS_HOST, \
+    PROCESSING_PARTITIONS
+from warreport.key_constants import PROCESSING_SCHEDULE_KEY, PROCESSING_QUEUE_SET, PROCESSING_LEASES, \
+    PROCESSING_QUEUE, REPORTING_SCHEDULE, REPORTING_LEASES, REPORTING_QUEUE
+
+logger = logging.getLogger("warreport")
+
+__all__ = ["serve_metrics", "collect"]
+
+# Seconds a scraper gets to send its request before being disconnected.
+REQUEST_TIMEOUT = 10
+
+# Statistics from history_cache.stats() and history_timing.stats() which are current values rather than totals.
+_GAUGE_STATS = {'segments', 'bytes', 'seconds_per_tick', 'offset', 'mean_abs_error'}
+
+_HISTORY_CACHE_HELP = {
+    'hits': "History segments read from the disk cache.",
+    'misses': "History segments looked for in the disk cache and not found there.",
+    'stores': "History segments written to the disk cache.",
+    'evictions': "History segments removed from the disk cache to keep it under its size limit.",
+    'missing_suppressed': "History fetches skipped because the segment was recently found missing.",
+    'empty_suppressed': "History fetches skipped because the segment was recently found empty.",
+    'missing_stored': "History segments remembered in redis as missing or empty.",
+    'segments': "History segments currently in the disk cache.",
+    'bytes': "Compressed bytes currently in the disk cache.",
+}
+_HISTORY_TIMING_HELP = {
+    'deferred': "History fetches skipped because the segment wasn't predicted to be available yet.",
+    'not_found': "History fetches which found the segment missing.",
+    'early_predictions': "History fetches which found the segment missing although it was predicted to be available.",
+    'error_samples': "History segments seen appearing, which mean_abs_error is measured over.",
+    'mean_abs_error': "Smoothed mean of the seconds between when each segment was predicted to be available and "
+                      "when it appeared.",
+    'seconds_per_tick': "Estimated seconds per server tick.",
+    'offset': "Seconds after a segment ends that it's predicted to become available.",
+}
+_HTTP_CONNECTIONS_HELP = {
+    'requests': "HTTP requests made by the shared session.",
+    'opened': "HTTP connections opened by the shared session.",
+    'reused': "HTTP requests made on an already open connection.",
+}
+
+
+def _render_samples(lines, name, documentation, kind, samples):
+    """
+    :param samples: A list of (label dict, value)
+    """
+    lines.append("# HELP {} {}".format(name, documentation))
+    lines.append("# TYPE {} {}".format(name, kind))
+    for labels, value in samples:
+        label_text = ",".join('{}="{}"'.format(label, label_value) for label, label_value in sorted(labels.items()))
+        lines.append("{}{} {}".format(name, "{" + label_text + "}" if label_text else "", value))
+
+
+def _render_stats(lines, prefix, documentation, stats):
+    """
+    :param documentation: A dict of stat -> help text
+    """
+    for stat, value in sorted(stats.items()):
+        if value is None:
+            continue
+        if stat in _GAUGE_STATS:
+            _render_samples(lines, "{}_{}".format(prefix, stat), documentation[stat], "gauge", [({}, value)])
+        else:
+            _render_samples(lines, "{}_{}_total".format(prefix, stat), documentation[stat], "counter", [({}, value)])
+
+
+@asyncio.coroutine
+def _queue_lengths(loop):
+    """
+    :return: A tuple of ({queue: length}, {queue: number due now})
+    """
+    partitions = range(PROCESSING_PARTITIONS)
+    replies = yield from async_redis.get_pool(loop).pipeline(
+        [('ZCARD', PROCESSING_SCHEDULE_KEY.format(partition)) for partition in partitions]
+        + [('SCARD', PROCESSING_QUEUE_SET),
+           ('HLEN', PROCESSING_LEASES),
+           ('ZCARD', REPORTING_SCHEDULE),
+           ('ZCOUNT', REPORTING_SCHEDULE, '-inf', time.time()),
+           ('HLEN', REPORTING_LEASES),
+           ('LLEN', PROCESSING_QUEUE),
+           ('LLEN', REPORTING_QUEUE)], idempotent=True)
+    processing_schedule = sum(replies[:len(partitions)])
+    processing_set, processing_leases, reporting_schedule, reports_due, reporting_leases, legacy_processing, \
+        legacy_reporting = replies[len(partitions):]
+    rooms_due = yield from queuing.count_rooms_due_async(loop)
+    lengths = {
+        'processing_schedule': processing_schedule,
+        'processing_set': processing_set,
+        'processing_leases': processing_leases,
+        'reporting_schedule': reporting_schedule,
+        'reporting_leases': reporting_leases,
+        # Only non-zero until old queues have been migrated.
+        'processing_queue': legacy_processing,
+        'reporting_queue': legacy_reporting,
+    }
+    return lengths, {'processing_schedule': rooms_due, 'reporting_schedule': reports_due}
+
+
+@asyncio.coroutine
+def collect(loop, include_queues=False):
+    """
+    :type loop: asyncio.events.AbstractEventLoop
+    :param include_queues: Whether to include the lengths of the redis queues, which are the same from any process
+    :return: Every metric in the Prometheus text format
+    :rtype: str
+    """
+    lines = metrics.render()
+    _render_stats(lines, "warreport_history_cache", _HISTORY_CACHE_HELP, history_cache.stats())
+    _render_stats(lines, "warreport_history_timing", _HISTORY_TIMING_HELP, history_timing.stats())
+    _render_stats(lines, "warreport_http_connections", _HTTP_CONNECTIONS_HELP, screeps_info.http_connection_stats())
+    if include_queues:
+        lengths, due = yield from _queue_lengths(loop)
+        _render_samples(lines, "warreport_queue_length", "Rooms or battles in each redis queue.", "gauge",
+                        [({'queue': queue}, length) for queue, length in sorted(lengths.items())])
+        _render_samples(lines, "warreport_queue_due", "Rooms or battles due to be taken from each schedule now.",
+                        "gauge", [({'queue': queue}, count) for queue, count in sorted(due.items())])
+    return "\n".join(lines) + "\n"
+
+
+def _response(status, body, content_type="text/plain; charset=utf-8"):
+    body = body.encode()
+    return "HTTP/1.0 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(
+        status, content_type, len(body)).encode() + body
+
+
+@asyncio.coroutine
+def _handle(loop, include_queues, reader, writer):
+    try:
+        request_line = yield from asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT, loop=loop)
+        while True:
+            header = yield from asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT, loop=loop)
+            if header in (b'\r\n', b'\n', b''):
+                break
+        parts = request_line.decode('latin-1').split()
+        if len(parts) < 2 or parts[0] != 'GET':
+            writer.write(_response("405 Method Not Allowed", "Only GET is supported.\n"))
+        elif parts[1].split('?')[0] != '/metrics':
+            writer.write(_response("404 Not Found", "Metrics are at /metrics.\n"))
+        else:
+            body = yield from collect(loop, include_queues)
+            writer.write(_response("200 OK", body, "text/plain; version=0.0.4; charset=utf-8"))
+        yield from writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    except Exception:
+        logger.exception("Error serving metrics.")
+    finally:
+        writer.close()
+
+
+@asyncio.coroutine
+def serve_metrics(loop, port, include_queues=False):
+    """
+    Serves metrics on the given port of METRICS_HOST until cancelled.
+    :type loop: asyncio.events.AbstractEventLoop
+    :param include_queues: Whether to include the lengths of the redis queues: best done by only one process
+    """
+    server = yield from asyncio.start_server(partial(_handle, loop, include_queues), METRICS_HOST, port, loop=loop)
+    logger.info("Serving metrics on http://{}:{}/metrics.".format(METRICS_HOST, port))
+    try:
+        yield from asyncio.Future(loop=loop)
+    finally:
+        server.close()
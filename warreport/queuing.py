@@ -1,125 +1,526 @@
+import asyncio
+import collections
 import logging
+import time
+import uuid
+import zlib
 
-from warreport.key_constants import PROCESSING_QUEUE_SET, PROCESSING_QUEUE, REPORTING_QUEUE, BATTLE_DATA_EXPIRE, \
-    BATTLE_DATA_KEY, KEEP_IN_QUEUE_FOR_MAX_TICKS, ROOM_LAST_BATTLE_END_TICK_KEY, ROOM_LAST_BATTLE_END_TICK_EXPIRE
-
-try:
-    import rapidjson as json
-except ImportError:
-    import json
+from warreport.key_constants import PROCESSING_QUEUE_SET, PROCESSING_QUEUE, PROCESSING_SCHEDULE, PROCESSING_LEASES, \
+    PROCESSING_SCHEDULE_KEY, PROCESSING_PARTITIONS_KEY, \
+    REPORTING_QUEUE, REPORTING_SCHEDULE, REPORTING_BATTLES, REPORTING_LEASES, REPORTING_DELIVERIES_KEY, \
+    REPORTING_DELIVERIES_EXPIRE, BATTLE_DATA_EXPIRE, BATTLE_STATE_KEY, \
+    KEEP_IN_QUEUE_FOR_MAX_TICKS, ROOM_LAST_BATTLE_END_TICK_KEY, ROOM_LAST_BATTLE_END_TICK_EXPIRE, ROOM_LEASE_SECONDS, \
+    REPORT_LEASE_SECONDS
 
 import redis
 
-from warreport import redis_conn
+from warreport import redis_conn, storage, encoding, async_redis, PROCESSING_PARTITIONS, ENQUEUE_BATCH_SIZE
 
 logger = logging.getLogger("warreport")
 
-# This is a fairly rigid, fairly small little LUA script to set a single value.
-# Keys should be [processing_queue_set_key, processing_queue_key, battle_info_key]
-# Args should be [room_name, new_room_data_if_new_room, room_data_expire_seconds]
-# This might be quite inefficient to create and pass in a new battle-data-info each call, so that could definitely
-# change in the future.
-# One other thing that might want to be changed about this is that the script currently runs once for each room.
-# I think this _is_ better than running once on a list of rooms, which could definitely be possible, because while
-# lua scripts are running the redis server pauses all other queries. However, the other way could definitely also be
-# done!
+# Inserts a batch of rooms into processing, skipping any which are already being processed. The initial battle data
+# for each room is built here rather than sent over, so each room only costs its name and tick in arguments.
+# Keys should be [processing_queue_set_key, then processing_schedule_key and battle_state_key for each room]
+# Args should be [room_data_expire_seconds, now, keep_in_queue_for_max_ticks, then room_name and hostilities_tick for
+#                 each room]
+# Returns the number of rooms newly added.
+# While lua scripts are running the redis server pauses all other queries, so batches are kept to a limited size by
+# push_battles_for_processing rather than sending every room at once.
 _battle_insert_script = redis.client.Script(None, """
-local added = redis.call('sismember', KEYS[1], ARGV[1])
-if added == 0 then
-    redis.call('sadd', KEYS[1], ARGV[1])
-    redis.call('lpush', KEYS[2], ARGV[1])
-    redis.call('set', KEYS[3], ARGV[2], 'ex', ARGV[3])
+local added = 0
+for i = 1, (#ARGV - 3) / 2 do
+    local room_name = ARGV[2 + i * 2]
+    if redis.call('sadd', KEYS[1], room_name) == 1 then
+        local tick = tonumber(ARGV[3 + i * 2])
+        redis.call('zadd', KEYS[i * 2], ARGV[2], room_name)
+        -- See storage.py for documentation on this format.
+        redis.call('hmset', KEYS[i * 2 + 1], 'tick_to_check', string.format('%d', tick),
+                   'stop_checking_at', string.format('%d', tick - tick % 20 + tonumber(ARGV[3])))
+        redis.call('expire', KEYS[i * 2 + 1], ARGV[1])
+        added = added + 1
+    end
+end
+return added
+""")
+
+# Leases whichever item has been due the longest in a schedule: reschedules it to when the lease runs out, and records
+# the lease token. Used for both processing and reporting.
+# Keys should be [schedule_key, leases_key, payloads_key_or_empty_string]
+# Args should be [now, lease_until, lease_token]
+# Returns {1, item, payload} if an item was due (payload being nil unless a payloads key was given), otherwise
+# {0, next_due_time}, with next_due_time being '' if the schedule is empty.
+_lease_due_script = redis.client.Script(None, """
+local due = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1], 'limit', 0, 1)
+if due[1] then
+    redis.call('zadd', KEYS[1], ARGV[2], due[1])
+    redis.call('hset', KEYS[2], due[1], ARGV[3])
+    local payload = false
+    if KEYS[3] ~= '' then
+        payload = redis.call('hget', KEYS[3], due[1])
+    end
+    return {1, due[1], payload}
+end
+local next_due = redis.call('zrange', KEYS[1], 0, 0, 'withscores')
+if next_due[2] then
+    return {0, next_due[2]}
+end
+return {0, ''}
+""")
+
+# Moves an item's due time, only if the given lease token still holds its lease. If release is '1', the lease is also
+# given up. Used both to renew leases, and to put items back in the schedule for later.
+# Keys should be [schedule_key, leases_key]
+# Args should be [item, lease_token, new_due_time, release]
+# Returns 1 if the lease was held, 0 otherwise.
+_move_leased_script = redis.client.Script(None, """
+if redis.call('hget', KEYS[2], ARGV[1]) ~= ARGV[2] then
+    return 0
 end
+redis.call('zadd', KEYS[1], ARGV[3], ARGV[1])
+if ARGV[4] == '1' then
+    redis.call('hdel', KEYS[2], ARGV[1])
+end
+return 1
 """)
 
+# Removes a leased item from its schedule, only if the given lease token still holds its lease.
+# Keys should be [schedule_key, leases_key, payloads_key], optionally followed by another key of the item's to delete
+# Args should be [item, lease_token]
+# Returns 1 if the lease was held, 0 otherwise.
+_ack_leased_script = redis.client.Script(None, """
+if redis.call('hget', KEYS[2], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('zrem', KEYS[1], ARGV[1])
+redis.call('hdel', KEYS[2], ARGV[1])
+redis.call('hdel', KEYS[3], ARGV[1])
+if KEYS[4] then
+    redis.call('del', KEYS[4])
+end
+return 1
+""")
 
-def push_battles_for_processing(battles_array):
+# Finishes processing a room: removes it from processing, and queues its battle for reporting, only if the given lease
+# token still holds the room's lease.
+# Keys should be [processing_schedule, processing_set, processing_leases, reporting_schedule, reporting_battles,
+#                 room_last_battle_end_tick_key, then every key of the room's ongoing battle data]
+# Args should be [room_name, lease_token, now, battle_id, encoded_battle, last_battle_end_tick, last_battle_end_expire]
+# with the last four being '' if the battle shouldn't be reported.
+# Returns 1 if the lease was held, 0 otherwise.
+_submit_processed_script = redis.client.Script(None, """
+if redis.call('hget', KEYS[3], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('zrem', KEYS[1], ARGV[1])
+redis.call('srem', KEYS[2], ARGV[1])
+redis.call('hdel', KEYS[3], ARGV[1])
+for i = 7, #KEYS do
+    redis.call('del', KEYS[i])
+end
+if ARGV[4] ~= '' then
+    redis.call('hset', KEYS[5], ARGV[4], ARGV[5])
+    redis.call('zadd', KEYS[4], ARGV[3], ARGV[4])
+    redis.call('set', KEYS[6], ARGV[6], 'ex', ARGV[7])
+end
+return 1
+""")
+
+
+def room_partition(room_name):
     """
-    Pushes a number of battles into the processing queue.
-    :param battles_array: A list of (room_name, hostilities_tick) tuples
+    Gets the partition of the processing schedule a room belongs to. This is a stable hash of the room name, so the
+    same room always goes to the same room processing process.
+    :param room_name: The room name, as str or bytes
+    :rtype: int
     """
-    if not _battle_insert_script.sha \
-            or not redis_conn.script_exists(_battle_insert_script.sha):
-        # Load for pipeline
-        _battle_insert_script.sha = redis_conn.script_load(_battle_insert_script.script)
+    if isinstance(room_name, str):
+        room_name = room_name.encode()
+    return zlib.crc32(room_name) % PROCESSING_PARTITIONS
+
+
+def _schedule_key(room_name):
+    return PROCESSING_SCHEDULE_KEY.format(room_partition(room_name))
+
+
+def _ensure_script_loaded(script):
+    # Only load each script once per process: after that, if the server has lost it (say it was restarted), calling the
+    # script directly reloads it on the NoScriptError, and pipelines check for and load their scripts when executed.
+    if not script.sha:
+        script.sha = redis_conn.script_load(script.script)
+
+
+# A batch of script calls making up one queuing operation, and how to turn the script results into the operation's
+# result. Every operation is described like this once, and then run either with redis_conn by _run, or with the event
+# loop's async_redis pool by _run_async.
+_ScriptCalls = collections.namedtuple('_ScriptCalls', ['script', 'calls', 'parse'])
+
+
+def _run(request):
+    """
+    :type request: _ScriptCalls
+    """
+    if not request.calls:
+        return request.parse([])
+    _ensure_script_loaded(request.script)
+    if len(request.calls) == 1:
+        keys, args = request.calls[0]
+        return request.parse([request.script(keys=keys, args=args, client=redis_conn)])
     pipe = redis_conn.pipeline()
     assert isinstance(pipe, redis.client.StrictPipeline)
+    for keys, args in request.calls:
+        request.script(keys=keys, args=args, client=pipe)
+    return request.parse(pipe.execute())
 
-    for room_name, hostilities_tick in battles_array:
-        _battle_insert_script(
-            keys=[PROCESSING_QUEUE_SET, PROCESSING_QUEUE, BATTLE_DATA_KEY.format(room_name)],
-            args=[room_name, json.dumps({
-                # See storage.py for documentation on this format.
-                'tick_to_check': hostilities_tick,
-                'stop_checking_at': (hostilities_tick - hostilities_tick % 20) + KEEP_IN_QUEUE_FOR_MAX_TICKS,
-            }), BATTLE_DATA_EXPIRE],
-            client=pipe,
-        )
 
-    pipe.execute()
+@asyncio.coroutine
+def _run_async(loop, request):
+    """
+    :type loop: asyncio.events.AbstractEventLoop
+    :type request: _ScriptCalls
+    """
+    if not request.calls:
+        return request.parse([])
+    results = yield from async_redis.get_pool(loop).run_script_many(request.script, request.calls)
+    return request.parse(results)
 
 
-def get_next_room_to_process():
+def _push_battles_request(battles, batch_size):
+    if batch_size is None:
+        batch_size = ENQUEUE_BATCH_SIZE
+    base_args = [BATTLE_DATA_EXPIRE, time.time(), KEEP_IN_QUEUE_FOR_MAX_TICKS]
+    calls = []
+    keys = [PROCESSING_QUEUE_SET]
+    args = list(base_args)
+    for room_name, hostilities_tick in battles:
+        keys.append(_schedule_key(room_name))
+        keys.append(BATTLE_STATE_KEY.format(room_name))
+        args.append(room_name)
+        args.append(int(hostilities_tick))
+        if len(keys) > batch_size * 2:
+            calls.append((keys, args))
+            keys = [PROCESSING_QUEUE_SET]
+            args = list(base_args)
+    if len(keys) > 1:
+        calls.append((keys, args))
+    return _ScriptCalls(_battle_insert_script, calls, sum)
+
+
+def push_battles_for_processing(battles, batch_size=None):
     """
-    Gets a single battle to process. This method returns the battle's room, and the stored 'battle data' from the last
-    time the battle was processed (or the beginning battle data if it hasn't been processed yet).
-    :return: A tuple of (room_name, battle_data)
+    Pushes a number of battles into the processing queue. New rooms are due to be processed immediately.
+
+    Rooms are inserted batch_size at a time per script call, with all batches sent in one round trip.
+    :param battles: An iterable of (room_name, hostilities_tick) tuples
+    :param batch_size: Rooms to insert per script call, defaulting to ENQUEUE_BATCH_SIZE
+    :return: The number of rooms newly added to processing
     """
-    # TODO: This implementation currently allows for the possibility of processing the same data twice when we have at
-    # least two clients, and a queue shorter than the number of clients. On one hand, this should be changed. On the
-    # other, we really only support one client at a time, and this allows us to not require a separate
-    # "currently_processing" queue to monitor.
-    return redis_conn.brpoplpush(PROCESSING_QUEUE, PROCESSING_QUEUE).decode()
+    return _run(_push_battles_request(battles, batch_size))
 
 
-def submit_processed_battle(room_name, battle_info_dict):
+@asyncio.coroutine
+def push_battles_for_processing_async(loop, battles, batch_size=None):
     """
-    Submit a processed battle via a database_key and battle_info_dict.
-    :param room_name: The room name that was processed
-    :param battle_info_dict: The processed battle data.
+    push_battles_for_processing, run on the event loop's async_redis pool.
+    """
+    return (yield from _run_async(loop, _push_battles_request(battles, batch_size)))
+
+
+def migrate_processing_queue():
     """
+    Moves every room into the partition of the processing schedule it belongs to, keeping when it's due: this covers
+    rooms left in the old round-robin processing list or the old single schedule, and rooms scheduled while a different
+    number of partitions was configured.
+
+    This should only be called while no rooms are being processed.
+    """
+    now = time.time()
+    to_move = [(room_name, now) for room_name in set(redis_conn.lrange(PROCESSING_QUEUE, 0, -1))]
+    to_move.extend(redis_conn.zrange(PROCESSING_SCHEDULE, 0, -1, withscores=True))
+
     pipe = redis_conn.pipeline()
-    pipe.lrem(PROCESSING_QUEUE, -1, room_name)
-    pipe.srem(PROCESSING_QUEUE_SET, room_name)
-    pipe.delete(BATTLE_DATA_KEY.format(room_name))
+    old_partitions = redis_conn.get(PROCESSING_PARTITIONS_KEY)
+    old_partitions = int(old_partitions) if old_partitions else 1
+    if old_partitions != PROCESSING_PARTITIONS:
+        for partition in range(old_partitions):
+            key = PROCESSING_SCHEDULE_KEY.format(partition)
+            for room_name, due in redis_conn.zrange(key, 0, -1, withscores=True):
+                if room_partition(room_name) != partition:
+                    pipe.zrem(key, room_name)
+                    to_move.append((room_name, due))
+
+    for room_name, due in to_move:
+        pipe.zadd(_schedule_key(room_name), due, room_name)
+    pipe.delete(PROCESSING_QUEUE, PROCESSING_SCHEDULE)
+    pipe.set(PROCESSING_PARTITIONS_KEY, PROCESSING_PARTITIONS)
+    pipe.execute()
+    if to_move:
+        logger.info("Moved {} rooms into {} processing schedule partitions.".format(len(to_move),
+                                                                                  PROCESSING_PARTITIONS))
+
+
+def _lease_due_request(schedule_key, leases_key, lease_seconds, payloads_key=''):
+    """
+    The request's result is (item, payload, lease_token, None) if an item was due, otherwise
+    (None, None, None, seconds_until_next_due).
+    """
+    now = time.time()
+    token = uuid.uuid4().hex
+
+    def parse(results):
+        result = results[0]
+        if result[0]:
+            return result[1].decode(), result[2] if len(result) > 2 else None, token, None
+        elif result[1]:
+            return None, None, None, max(0.0, float(result[1]) - now)
+        else:
+            return None, None, None, None
+
+    return _ScriptCalls(_lease_due_script, [([schedule_key, leases_key, payloads_key],
+                                             [now, now + lease_seconds, token])], parse)
+
+
+def _move_leased_request(schedule_key, leases_key, item, lease_token, delay, release):
+    return _ScriptCalls(_move_leased_script, [([schedule_key, leases_key],
+                                               [item, lease_token, time.time() + delay, '1' if release else '0'])],
+                        lambda results: bool(results[0]))
+
+
+def _next_room_request(partition):
+    def parse(results):
+        room_name, _, lease_token, wait = lease_request.parse(results)
+        return room_name, lease_token, wait
+
+    lease_request = _lease_due_request(PROCESSING_SCHEDULE_KEY.format(partition), PROCESSING_LEASES,
+                                       ROOM_LEASE_SECONDS)
+    return lease_request._replace(parse=parse)
+
+
+def get_next_room_to_process(partition=0):
+    """
+    Leases the room which has been due for processing the longest in the given partition, if any are due.
+
+    The room stays in the processing schedule, but is rescheduled ROOM_LEASE_SECONDS in the future so that no one else
+    takes it in the meantime. Renew the lease with renew_room_lease_async while still working on it, and call either
+    submit_processed_battle or reschedule_room when done with it. If the lease runs out, the room will be handed out
+    again, and this lease token will no longer work.
+
+    Any number of processes may call this at once: each room is only ever leased to one of them at a time.
+
+    :param partition: The partition of the processing schedule to take from, less than PROCESSING_PARTITIONS.
+    :return: A tuple of (room_name, lease_token, None) if a room was due, otherwise
+             (None, None, seconds_until_next_due). Seconds until next due is None if no rooms are scheduled at all.
+    :rtype: (str | None, str | None, float | None)
+    """
+    return _run(_next_room_request(partition))
+
+
+@asyncio.coroutine
+def get_next_room_to_process_async(loop, partition=0):
+    """
+    get_next_room_to_process, run on the event loop's async_redis pool.
+    """
+    return (yield from _run_async(loop, _next_room_request(partition)))
+
+
+@asyncio.coroutine
+def renew_room_lease_async(loop, room_name, lease_token):
+    """
+    Extends a room's lease to ROOM_LEASE_SECONDS from now.
+    :type loop: asyncio.events.AbstractEventLoop
+    :return: False if the lease had already run out and been taken by someone else.
+    """
+    return (yield from _run_async(loop, _move_leased_request(_schedule_key(room_name), PROCESSING_LEASES, room_name,
+                                                             lease_token, ROOM_LEASE_SECONDS, False)))
+
+
+def reschedule_room(room_name, lease_token, delay):
+    """
+    Gives up the lease of a room taken with get_next_room_to_process, and puts it back in the schedule due again after
+    the given delay.
+    :param room_name: The room
+    :param lease_token: The lease token from get_next_room_to_process
+    :param delay: Seconds until the room should be looked at again
+    :return: False if the lease had already run out and been taken by someone else.
+    """
+    return _run(_move_leased_request(_schedule_key(room_name), PROCESSING_LEASES, room_name, lease_token, delay,
+                                     True))
+
+
+@asyncio.coroutine
+def reschedule_room_async(loop, room_name, lease_token, delay):
+    """
+    reschedule_room, run on the event loop's async_redis pool.
+    """
+    return (yield from _run_async(loop, _move_leased_request(_schedule_key(room_name), PROCESSING_LEASES, room_name,
+                                                             lease_token, delay, True)))
+
+
+def _submit_request(room_name, lease_token, battle_info_dict):
     if 'latest_hostilities_detected' in battle_info_dict:
-        pipe.lpush(REPORTING_QUEUE, json.dumps(battle_info_dict))
-        pipe.set(ROOM_LAST_BATTLE_END_TICK_KEY.format(room_name), battle_info_dict['latest_hostilities_detected'],
-                 ex=ROOM_LAST_BATTLE_END_TICK_EXPIRE)
+        battle_id = "{}:{}".format(room_name, battle_info_dict['latest_hostilities_detected'])
+        report_args = [battle_id, encoding.encode(battle_info_dict), battle_info_dict['latest_hostilities_detected'],
+                       ROOM_LAST_BATTLE_END_TICK_EXPIRE]
     else:
         # This means something has gone wrong, and no hostilities have been detected!
         # We should still remove this battle from the queue, as it was deemed 'unprocessable' by screeps_info,
         # but we shouldn't add it to the reporting queue since it wasn't processed!
         logger.warning("Battle submitted with no hostilities - not reporting battle in {}! {}".format(
             room_name, battle_info_dict))
+        report_args = ['', '', '', '']
+
+    def parse(results):
+        if not results[0]:
+            logger.warning("Lease on {} ran out before it was submitted: discarding this result.".format(room_name))
+        return bool(results[0])
+
+    keys = [_schedule_key(room_name), PROCESSING_QUEUE_SET, PROCESSING_LEASES, REPORTING_SCHEDULE, REPORTING_BATTLES,
+            ROOM_LAST_BATTLE_END_TICK_KEY.format(room_name)] + storage.ongoing_data_keys(room_name)
+    return _ScriptCalls(_submit_processed_script, [(keys, [room_name, lease_token, time.time()] + report_args)], parse)
+
+
+def submit_processed_battle(room_name, lease_token, battle_info_dict):
+    """
+    Submit a processed battle, removing the room from processing and queuing the battle for reporting.
+    :param room_name: The room name that was processed
+    :param lease_token: The lease token from get_next_room_to_process
+    :param battle_info_dict: The processed battle data.
+    :return: False if the lease had already run out and been taken by someone else, in which case nothing is changed.
+    """
+    return _run(_submit_request(room_name, lease_token, battle_info_dict))
+
+
+@asyncio.coroutine
+def submit_processed_battle_async(loop, room_name, lease_token, battle_info_dict):
+    """
+    submit_processed_battle, run on the event loop's async_redis pool.
+    """
+    return (yield from _run_async(loop, _submit_request(room_name, lease_token, battle_info_dict)))
+
+
+@asyncio.coroutine
+def count_rooms_due_async(loop):
+    """
+    Counts the rooms due to be processed right now, over every partition of the processing schedule.
+    :type loop: asyncio.events.AbstractEventLoop
+    :rtype: int
+    """
+    now = time.time()
+    counts = yield from async_redis.get_pool(loop).pipeline([
+        ('ZCOUNT', PROCESSING_SCHEDULE_KEY.format(partition), '-inf', now)
+        for partition in range(PROCESSING_PARTITIONS)
+    ], idempotent=True)
+    return sum(counts)
+
+
+def migrate_reporting_queue():
+    """
+    Moves any battles left in the old round-robin reporting list into the reporting schedule, due immediately.
+
+    This should only be called while no battles are being reported.
+    """
+    raw_list = redis_conn.lrange(REPORTING_QUEUE, 0, -1)
+    if not raw_list:
+        return
+    now = time.time()
+    pipe = redis_conn.pipeline()
+    for raw_battle_info in raw_list:
+        battle_info = encoding.decode(raw_battle_info)
+        battle_id = "{}:{}".format(battle_info['room'], battle_info['latest_hostilities_detected'])
+        pipe.hset(REPORTING_BATTLES, battle_id, raw_battle_info)
+        pipe.zadd(REPORTING_SCHEDULE, now, battle_id)
+    pipe.delete(REPORTING_QUEUE)
     pipe.execute()
+    logger.info("Moved {} battles from the old reporting queue to the reporting schedule.".format(len(raw_list)))
+
+
+def _next_battle_request():
+    return _lease_due_request(REPORTING_SCHEDULE, REPORTING_LEASES, REPORT_LEASE_SECONDS, REPORTING_BATTLES)
+
+
+def _ack_request(database_key):
+    battle_id, lease_token = database_key
+    return _ScriptCalls(_ack_leased_script, [([REPORTING_SCHEDULE, REPORTING_LEASES, REPORTING_BATTLES,
+                                               REPORTING_DELIVERIES_KEY.format(battle_id)], [battle_id, lease_token])],
+                        lambda results: bool(results[0]))
 
 
-def get_next_battle_to_report():
+def _retry_request(database_key, delay):
+    battle_id, lease_token = database_key
+    return _move_leased_request(REPORTING_SCHEDULE, REPORTING_LEASES, battle_id, lease_token, delay, True)
+
+
+@asyncio.coroutine
+def get_next_battle_to_report_async(loop):
     """
-    Gets a single battle to report. This method returns the processed information dict, and a database_key for use when
-    marking as completed.
+    Leases the battle which has been due for reporting the longest, if any are due. This method returns the processed
+    information dict, and a database_key for use when marking as completed.
+
+    Like get_next_room_to_process, the battle is leased for REPORT_LEASE_SECONDS, and will be handed out again if
+    neither mark_battle_reported_async nor retry_battle_report_async is called by then.
 
     TODO: describe in detail the battle_info_dict format here.
 
-    :return: A tuple of (battle_info_dict, database_key)
+    :type loop: asyncio.events.AbstractEventLoop
+    :return: A tuple of (battle_info_dict, database_key, None) if a battle was due, otherwise
+             (None, None, seconds_until_next_due). Seconds until next due is None if no battles are scheduled at all.
+    """
+    while True:
+        battle_id, raw_battle_info, lease_token, wait = yield from _run_async(loop, _next_battle_request())
+        if battle_id is None:
+            return None, None, wait
+        database_key = (battle_id, lease_token)
+        if raw_battle_info is None:
+            logger.warning("Battle {} scheduled for reporting has no data! Dropping it.".format(battle_id))
+            yield from mark_battle_reported_async(loop, database_key)
+            continue
+        return encoding.decode(raw_battle_info), database_key, None
+
+
+@asyncio.coroutine
+def retry_battle_report_async(loop, database_key, delay):
     """
-    # TODO: This implementation currently allows for the possibility of processing the same data twice when we have at
-    # least two clients, and a queue shorter than the number of clients. On one hand, this should be changed. On the
-    # other, we really only support one client at a time, and this allows us to not require a separate
-    # "currently_processing" queue to monitor.
-    raw_battle_info = redis_conn.brpoplpush(REPORTING_QUEUE, REPORTING_QUEUE)
-    battle_info = json.loads(raw_battle_info.decode())
-    return battle_info, raw_battle_info
+    Gives up the lease of a battle which couldn't be reported, and schedules it to be tried again after a delay.
+    :type loop: asyncio.events.AbstractEventLoop
+    :param database_key: The database_key returned from get_next_battle_to_report_async
+    :param delay: Seconds until the battle should be tried again
+    """
+    yield from _run_async(loop, _retry_request(database_key, delay))
 
 
-def mark_battle_reported(database_key):
+@asyncio.coroutine
+def mark_battle_reported_async(loop, database_key):
     """
-    Marks a battle from the reporting queue as reported, given a database_key retrieved from get_next_battle_to_report.
+    Marks a battle from the reporting queue as reported, given a database_key retrieved from
+    get_next_battle_to_report_async.
 
-    If this method isn't called, get_next_battle_to_report will start returning already-reported battles once it has
-    returned each battle once.
-    :param database_key: The database_key returned from get_next_battle_to_report corresponding to the battle
+    If this method isn't called, get_next_battle_to_report_async will return the battle again once its lease runs out.
+    :type loop: asyncio.events.AbstractEventLoop
+    :param database_key: The database_key returned from get_next_battle_to_report_async corresponding to the battle
                          successfully reported.
+    :return: False if the lease had already run out and been taken by someone else.
+    """
+    return (yield from _run_async(loop, _ack_request(database_key)))
+
+
+@asyncio.coroutine
+def get_battle_deliveries_async(loop, battle_id):
+    """
+    Gets the names of the report sinks which have already acknowledged a battle, from mark_battle_delivered_async.
+    :type loop: asyncio.events.AbstractEventLoop
+    :rtype: set[str]
+    """
+    names = yield from async_redis.get_pool(loop).execute('SMEMBERS', REPORTING_DELIVERIES_KEY.format(battle_id),
+                                                         idempotent=True)
+    return {name.decode() for name in names}
+
+
+@asyncio.coroutine
+def mark_battle_delivered_async(loop, battle_id, sink_name):
+    """
+    Records that one report sink has acknowledged a battle, so that it isn't sent there again if the battle needs to be
+    retried for other sinks. Forgotten when the battle is marked reported.
+    :type loop: asyncio.events.AbstractEventLoop
     """
-    redis_conn.lrem(REPORTING_QUEUE, -1, database_key)
+    key = REPORTING_DELIVERIES_KEY.format(battle_id)
+    yield from async_redis.get_pool(loop).pipeline([('SADD', key, sink_name),
+                                                    ('EXPIRE', key, REPORTING_DELIVERIES_EXPIRE)], idempotent=True)
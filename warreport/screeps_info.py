@@ -1,23 +1,55 @@
+import functools
 import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.exceptions import NewConnectionError
+from requests.packages.urllib3.util.retry import Retry
 
-from warreport import storage
+from warreport import storage, history_cache, history_parser, history_timing, metrics, SCREEPS_URL, ALLIANCES_URL, \
+    PROCESSING_WORKERS, HISTORY_PREFETCH_WINDOW, HTTP_POOL_SIZE, HTTP_TIMEOUT, \
+    HTTP_RETRIES
 from warreport.constants import scout, civilian, general_attacker, dismantling_attacker, healer, melee_attacker, \
     ranged_attacker, tough_attacker, work_and_carry_attacker
 from warreport.key_constants import KEEP_IN_QUEUE_FOR_MAX_TICKS_UNSUCCESSFUL
 
-_URL_ROOT = "https://screeps.com/"
+_URL_ROOT = SCREEPS_URL
 
 USERNAME_URL_FORMAT = _URL_ROOT + "api/user/find"
 HISTORY_URL_FORMAT = _URL_ROOT + "room-history/{room}/{tick}.json"
 BATTLES_URL_FORMAT = _URL_ROOT + "api/experimental/pvp"
 
-ALLIANCES_URL = "http://www.leagueofautomatednations.com/alliances.js"
+_SEGMENTS_FOUND = metrics.HISTORY_SEGMENTS.labels('found')
+_SEGMENTS_NOT_FOUND = metrics.HISTORY_SEGMENTS.labels('not_found')
+_SEGMENTS_EMPTY = metrics.HISTORY_SEGMENTS.labels('empty')
+_SEGMENTS_INVALID = metrics.HISTORY_SEGMENTS.labels('invalid')
+_USERNAMES_FROM_MEMORY = metrics.USERNAME_LOOKUPS.labels('memory')
+_USERNAMES_FROM_REDIS = metrics.USERNAME_LOOKUPS.labels('redis')
+_USERNAMES_FROM_API = metrics.USERNAME_LOOKUPS.labels('api')
+_ALLIANCES_CURRENT = metrics.ALLIANCE_REFRESHES.labels('current')
+_ALLIANCES_RELOADED = metrics.ALLIANCE_REFRESHES.labels('reloaded')
+_ALLIANCES_FETCHED = metrics.ALLIANCE_REFRESHES.labels('fetched')
 
 logger = logging.getLogger("warreport")
 
+# Each room worker can have a full prefetch window of history requests in flight at once. Username lookups share these
+# threads too.
+_http_executor = ThreadPoolExecutor(max_workers=PROCESSING_WORKERS * HISTORY_PREFETCH_WINDOW)
+
+
+class HistoryNotReady:
+    """
+    Returned by work_on_room_data when the next history segment it needs isn't available yet.
+    """
+
+    def __init__(self, tick):
+        self.tick = tick
+
 
 class ScreepsError(Exception):
     def __init__(self, data):
@@ -27,6 +59,66 @@ class ScreepsError(Exception):
         return self.message
 
 
+def _create_session():
+    """
+    Creates the keep-alive session shared by every call in this module, so that we aren't doing a new TCP and TLS
+    handshake for every history segment and username lookup.
+    """
+    session = requests.Session()
+    # Connection and read errors on these GET requests are retried; HTTP error statuses are passed through to the
+    # callers, as they all handle those themselves.
+    # Requests come from _http_executor's threads and the event loop's default executor (which run_event_loop gives
+    # PROCESSING_WORKERS + 4 threads). A pool any smaller would have urllib3 discard connections which don't fit back
+    # in it, so by default it's sized to all of them. A smaller configured pool makes requests wait for a connection.
+    pool_size = HTTP_POOL_SIZE or PROCESSING_WORKERS * HISTORY_PREFETCH_WINDOW + PROCESSING_WORKERS + 4
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=True,
+                          max_retries=Retry(total=HTTP_RETRIES, backoff_factor=0.2))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+_session = _create_session()
+
+
+def _http_get(url, params=None, headers=None):
+    """
+    GETs a URL using the shared session.
+    :raises ScreepsError: if the request couldn't be completed at all (after retries), or timed out.
+    :rtype: requests.Response
+    """
+    try:
+        return _session.get(url, params=params, headers=headers, timeout=HTTP_TIMEOUT)
+    except (NewConnectionError, requests.RequestException) as e:
+        logger.warning("Error getting {} with params={}: {}".format(url, params, e))
+        raise ScreepsError("{} ({}, at {})".format(e, 'error', url))
+
+
+def http_connection_stats():
+    """
+    Counts connections opened and reused by the shared session, across every host it's talked to. Hosts whose pools
+    have been evicted are no longer counted.
+    :return: A dict of {'requests': int, 'opened': int, 'reused': int}
+    """
+    total_requests = 0
+    opened = 0
+    seen_pools = set()
+    for adapter in _session.adapters.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None or id(pool) in seen_pools:
+                continue
+            seen_pools.add(id(pool))
+            total_requests += pool.num_requests
+            opened += pool.num_connections
+    return {
+        'requests': total_requests,
+        'opened': opened,
+        'reused': max(0, total_requests - opened),
+    }
+
+
 def grab_battles(since_tick=None, interval=None):
     if since_tick is not None:
         params = {'start': since_tick}
@@ -34,11 +126,9 @@ def grab_battles(since_tick=None, interval=None):
         params = {'interval': interval}
     else:
         raise ScreepsError("Invalid arguments: must provide one of since_tick, interval")
-    try:
-        result = requests.get(BATTLES_URL_FORMAT, params=params)
-    except NewConnectionError as e:
-        logger.exception("NewConnectionError getting {} with params={}".format(BATTLES_URL_FORMAT, params))
-        raise ScreepsError("{} ({}, at {})".format(e, 'error', BATTLES_URL_FORMAT))
+    started = time.perf_counter()
+    result = _http_get(BATTLES_URL_FORMAT, params=params)
+    metrics.BATTLES_FETCH_SECONDS.observe(time.perf_counter() - started)
     if not result.ok:
         raise ScreepsError("{} ({}, at {})".format(result.text, result.status_code, result.url))
 
@@ -52,6 +142,7 @@ def grab_battles(since_tick=None, interval=None):
     if not json.get('ok'):
         raise ScreepsError("Result without 'ok' property: {} ({}, at {})".format(result.text, result.status_code,
                                                                                  result.url))
+    history_timing.observe_server_tick(int(json['time']))
     return json
 
 
@@ -60,98 +151,300 @@ def grab_history(room, tick):
     Grabs history. TODO: use screeps-api for this.
     :param room: room to grab
     :param tick: tick to grab, must be interval of 20
-    :return: None if the result is an error 404, otherwise the json result output.
+    :return: None if the result is an error 404, was recently, or history_timing doesn't expect the segment to be
+             available yet. Otherwise, the compact history (see history_parser).
     :rtype: None | dict[str, Any]
     :raises ScreepsError: if a non-OK non-404 result is returned
     """
+    cached = history_cache.get(room, tick)
+    if cached is not None:
+        return cached
+
+    if not history_timing.is_probably_available(tick):
+        history_timing.record_deferred()
+        return None
+
+    missing = history_cache.get_missing(room, tick)
+    if missing == history_cache.MISSING:
+        return None
+    elif missing == history_cache.EMPTY:
+        return {'ticks': {}}
+
     url = HISTORY_URL_FORMAT.format(room=room, tick=tick)
-    try:
-        result = requests.get(url)
-    except NewConnectionError as e:
-        logger.exception("NewConnectionError getting {}".format(url))
-        raise ScreepsError("{} ({}, at {})".format(e, 'error', url))
+    started = time.perf_counter()
+    result = _http_get(url)
+    metrics.HISTORY_FETCH_SECONDS.observe(time.perf_counter() - started)
     if not result.ok:
         if result.status_code == 404:
+            history_timing.observe_fetch(room, tick, False)
+            _SEGMENTS_NOT_FOUND.inc()
+            history_cache.put_missing(room, tick, history_cache.MISSING)
             return None
+        # Any other error says nothing about whether the segment has been generated.
         raise ScreepsError("{} ({}, at {})".format(result.text, result.status_code, result.url))
+    history_timing.observe_fetch(room, tick, True)
 
     if not len(result.content):
         # Because of the buggy history recording system, sometimes this happens! It'll be an A-OK file return, with
         # just an empty document! It probably won't ever turn into a real document, this is the most we can expect.
         # Because of this, let's just return an empty dummy result, in order to allow the processing function to keep
         # looking at other records.
+        _SEGMENTS_EMPTY.inc()
+        history_cache.put_missing(room, tick, history_cache.EMPTY)
         return {'ticks': {}}
 
     try:
-        json = result.json()
+        history = history_parser.parse_history(result.content)
     except ValueError:
         logger.exception("Invalid JSON data from {} ({}). Ignoring, and returning an empty data set."
                          .format(result.url, result.text))
+        _SEGMENTS_INVALID.inc()
+        history_cache.put_missing(room, tick, history_cache.EMPTY)
         return {'ticks': {}}
 
-    if not json:
+    if not history:
         raise ScreepsError("Invalid json: {} ({}, at {})".format(result.text, result.status_code, result.url))
 
-    return json
+    _SEGMENTS_FOUND.inc()
+    # Only complete, valid segments are cached: empty documents might still be regenerated properly.
+    history_cache.put(room, tick, result.content)
 
+    return history
 
-def username_from_id(user_id):
-    cached = storage.get_username(user_id)
-    if cached is not None:
-        return cached
-    call_result = requests.get(USERNAME_URL_FORMAT, params={'id': user_id})
+
+def _grab_history_or_none(room, tick):
+    try:
+        return grab_history(room, tick)
+    except ScreepsError:
+        logger.exception("Error grabbing history")
+        return None  # None is already returned when the error is an expected 404 error.
+
+
+def _history_segments(room, first_tick, step, last_tick=None):
+    """
+    Iterates over consecutive history segments of a room, starting at first_tick and moving `step` ticks each time.
+
+    Up to HISTORY_PREFETCH_WINDOW segments ahead are fetched concurrently, but segments are always yielded in order.
+    Iteration stops at the first segment which is unavailable (or errors), or once last_tick has been passed. Closing
+    the generator cancels any prefetches which haven't started yet; ones already in flight are simply discarded.
+
+    :param room: room to grab
+    :param first_tick: first tick to grab, must be interval of 20
+    :param step: 20 to search forwards, -20 to search backwards
+    :param last_tick: if given, no segments past this tick will be requested
+    :return: a generator of (tick, history_result) tuples
+    """
+    pending = deque()
+    next_tick = first_tick
+    try:
+        while True:
+            while len(pending) < HISTORY_PREFETCH_WINDOW and next_tick >= 0 \
+                    and (last_tick is None or (next_tick - last_tick) * step <= 0):
+                pending.append((next_tick, _http_executor.submit(_grab_history_or_none, room, next_tick)))
+                next_tick += step
+            if not pending:
+                return
+            tick, future = pending.popleft()
+            result = future.result()
+            if result is None:
+                return
+            yield tick, result
+    finally:
+        for tick, future in pending:
+            future.cancel()
+
+
+class _ExpiringLRUCache:
+    """
+    A small thread-safe LRU cache where entries also expire after a fixed number of seconds.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+# Sits in front of the redis username cache, so repeat lookups never leave the process. Kept well under the redis
+# cache's expiry so that username changes still get noticed.
+_username_lru = _ExpiringLRUCache(max_size=5000, ttl=60 * 60)
+
+
+def _fetch_username(user_id):
+    call_result = _http_get(USERNAME_URL_FORMAT, params={'id': user_id})
     if call_result.ok:
         name = call_result.json().get('user', {}).get('username', None)
         if name is None:
             raise ScreepsError("{} ({}, at {})".format(call_result.text, call_result.status_code, call_result.url))
-        storage.set_username(user_id, name)
         return name
     else:
         raise ScreepsError("{} ({}, at {})".format(call_result.text, call_result.status_code,
                                                    call_result.url))
 
 
+def usernames_from_ids(user_ids):
+    """
+    Looks up a number of usernames at once: first in process memory, then with a single MGET against the redis cache,
+    and finally by asking the API for all the remaining ones concurrently.
+    :param user_ids: An iterable of user IDs
+    :return: A dict of user_id -> username, for every user ID given.
+    :rtype: dict[str, str]
+    :raises ScreepsError: if any username can't be found
+    """
+    result = {}
+    missing = []
+    for user_id in set(user_ids):
+        name = _username_lru.get(user_id)
+        if name is None:
+            missing.append(user_id)
+        else:
+            result[user_id] = name
+    _USERNAMES_FROM_MEMORY.inc(len(result))
+    if not missing:
+        return result
+
+    cached = storage.get_usernames(missing)
+    _USERNAMES_FROM_REDIS.inc(len(cached))
+    for user_id, name in cached.items():
+        _username_lru.put(user_id, name)
+    result.update(cached)
+    missing = [user_id for user_id in missing if user_id not in cached]
+    if not missing:
+        return result
+
+    futures = [(user_id, _http_executor.submit(_fetch_username, user_id)) for user_id in missing]
+    fetched = {}
+    error = None
+    for user_id, future in futures:
+        try:
+            fetched[user_id] = future.result()
+        except Exception as e:
+            # Still wait for the rest, so the ones which were found are stored and not fetched again on the retry.
+            if error is None:
+                error = e
+    _USERNAMES_FROM_API.inc(len(fetched))
+    storage.set_usernames(fetched)
+    for user_id, name in fetched.items():
+        _username_lru.put(user_id, name)
+    if error is not None:
+        raise error
+    result.update(fetched)
+    return result
+
+
 def _update_alliance_data():
+    """
+    Re-fetches alliances.js if it's changed since we last fetched it, and stores it in redis if so.
+    """
+    validators = storage.get_alliance_validators()
+    headers = {}
+    if 'etag' in validators:
+        headers['If-None-Match'] = validators['etag']
+    if 'last_modified' in validators:
+        headers['If-Modified-Since'] = validators['last_modified']
     try:
-        result = requests.get(ALLIANCES_URL)
-    except NewConnectionError:
-        logger.exception("Error getting {}.".format(ALLIANCES_URL))
-        storage.update_alliance_data([])  # try again in 4 hours.
+        result = _http_get(ALLIANCES_URL, headers=headers)
+    except ScreepsError:
+        storage.mark_alliance_data_recent()  # try again in 4 hours.
+        return
+    if result.status_code == 304:
+        logger.debug("Alliance data unchanged.")
+        storage.mark_alliance_data_recent()
         return
-    json_root = result.json()
+    try:
+        json_root = result.json() if result.ok else None
+    except ValueError:
+        json_root = None
     if json_root is None:
         logger.error("Error parsing alliance data as json. {} ({}, at {})"
                      .format(result.text, result.status_code, result.url))
-        storage.update_alliance_data([])
+        storage.mark_alliance_data_recent()
         return
 
-    user_alliance_tuple_list = []
+    user_to_alliance = {}
     for alliance_abbrev, alliance_data in json_root.items():
         for member in alliance_data['members']:
             # TODO: do we want to use the full alliance name, or the abbreviation?
-            user_alliance_tuple_list.append((member, alliance_abbrev))
-    storage.update_alliance_data(user_alliance_tuple_list)
+            user_to_alliance[member] = alliance_abbrev
+    version = storage.replace_alliance_data(user_to_alliance, etag=result.headers.get('ETag'),
+                                            last_modified=result.headers.get('Last-Modified'))
+    logger.debug("Stored alliance data version {} ({} members).".format(version, len(user_to_alliance)))
 
 
-def alliance_from_username(username):
-    # TODO: write storage methods to abstract out these database calls!
+# The alliance data this process is using, only reloaded from redis when the version there changes.
+_alliance_snapshot = {
+    'loaded': False,
+    'version': None,
+    'alliances': {},
+}
+_alliance_snapshot_lock = threading.Lock()
+
+
+def refresh_alliances():
+    """
+    Makes sure the alliance data is recent, and the in-memory snapshot of it matches what's in redis.
+
+    This is called periodically, so that finishing a battle doesn't need to touch redis for alliances at all.
+    """
     if not storage.is_alliance_data_recent():
+        _ALLIANCES_FETCHED.inc()
         _update_alliance_data()
-    return storage.get_cached_alliance(username)
+    with _alliance_snapshot_lock:
+        if _alliance_snapshot['loaded'] and storage.get_alliance_version() == _alliance_snapshot['version']:
+            _ALLIANCES_CURRENT.inc()
+            return
+        version, alliances = storage.get_alliance_snapshot()
+        _alliance_snapshot['alliances'] = alliances
+        _alliance_snapshot['version'] = version
+        _alliance_snapshot['loaded'] = True
+    _ALLIANCES_RELOADED.inc()
+    logger.debug("Loaded alliance data version {} ({} members).".format(version, len(alliances)))
 
 
-def work_on_room_data(room_name, current_tick):
+def alliance_from_username(username):
+    if not _alliance_snapshot['loaded']:
+        # Only happens before the first refresh.
+        refresh_alliances()
+    return _alliance_snapshot['alliances'].get(username)
+
+
+def work_on_room_data(room_name, current_tick, lease_token=None):
     """
     Works on room data stored in redis, returning data only when completely completed.
     :param room_name:
     :param current_tick:
-    :return:
+    :param lease_token: The lease token the room was taken from the processing schedule with. Progress is only stored
+                        while it still holds the room's lease.
+    :return: The finished battle data, {} if the room should be dropped, or HistoryNotReady if we need to wait for
+             more history.
     """
     battle_data = storage.get_ongoing_data(room_name)
     if battle_data is None:
         logger.error("No ongoing data found for room {}! Abandoning."
                      .format(room_name))
         return {}  # this will be caught by queuing, and be removed from the queue.
+    # What's stored now, so that only what changes gets written back.
+    stored_data = storage.copy_ongoing_data(battle_data)
 
     logger.debug("Started processing room {}.".format(room_name))
 
@@ -172,14 +465,14 @@ def work_on_room_data(room_name, current_tick):
                              .format(room_name, tick_to_call, KEEP_IN_QUEUE_FOR_MAX_TICKS_UNSUCCESSFUL))
                 return {}
             else:
-                return None
+                return HistoryNotReady(tick_to_call)
 
         changed = True
 
         # First tick found! Let's modify the battle data to match this.
         battle_data['max_tick_checked'] = tick_to_call
         battle_data['player_creep_counts'] = {}
-        battle_data['creeps_found'] = []
+        battle_data['creeps_found'] = set()
         battle_data['owner'] = None
         battle_data['rcl'] = 0
         # Since this tick to check is pretty much coming from the initial API, we're going to assume a hostile action
@@ -199,54 +492,45 @@ def work_on_room_data(room_name, current_tick):
         # ticks!
 
         logger.debug("Starting search-back loop.")
-        while True:
-            # TODO: earliest_hostilities_collided check here!
-            battle_data['max_tick_checked'] = tick_to_call
-            # We process the result first in here so that we can use the result from the initial tick.
-            still_a_battle = modify_data_with_history(battle_data, api_result, checking='earliest')
-            if not still_a_battle:
-                break
-            tick_to_call -= 20  # Search 20 further back in history.
-            try:
-                api_result = grab_history(room_name, tick_to_call)
-            except ScreepsError:
-                logger.exception("Error grabbing history")
-                api_result = None  # None is already returned when the error is an expected 404 error.
-            if api_result is None:
-                break
-            logger.debug("Successfully got tick {}".format(tick_to_call))
+        # TODO: earliest_hostilities_collided check here!
+        battle_data['max_tick_checked'] = tick_to_call
+        # We process the result first in here so that we can use the result from the initial tick.
+        if modify_data_with_history(battle_data, api_result, checking='earliest'):
+            # Search 20 further back in history each step.
+            with closing(_history_segments(room_name, tick_to_call - 20, -20)) as segments:
+                for tick_to_call, api_result in segments:
+                    logger.debug("Successfully got tick {}".format(tick_to_call))
+                    battle_data['max_tick_checked'] = tick_to_call
+                    still_a_battle = modify_data_with_history(battle_data, api_result, checking='earliest')
+                    if not still_a_battle:
+                        break
 
     # At this point, we know that the initial tick has been found. Now we're just continuing to check forward.
-    tick_to_call = battle_data['max_tick_checked']
     found_end = False
     logger.debug("Starting forward search loop.")
-    while True:
-        try:
-            api_result = grab_history(room_name, tick_to_call)
-        except ScreepsError:
-            logger.exception("Error grabbing history")
-            api_result = None  # None is already returned when the error is an expected 404 error.
-        if api_result is None:
-            break
-        logger.debug("Successfully got tick {}".format(tick_to_call))
-        still_a_battle = modify_data_with_history(battle_data, api_result, checking='latest')
-        battle_data['max_tick_checked'] = tick_to_call
-        changed = True
-        if not still_a_battle:
-            found_end = True
-            battle_data['battle_still_ongoing'] = False
-            break
-        elif tick_to_call > battle_data['stop_checking_at']:
-            found_end = True
-            battle_data['battle_still_ongoing'] = True
-            break
-        tick_to_call += 20
+    # We never look further than the first segment after stop_checking_at, so there's no use prefetching past it.
+    with closing(_history_segments(room_name, battle_data['max_tick_checked'], 20,
+                                   battle_data['stop_checking_at'] + 20)) as segments:
+        for tick_to_call, api_result in segments:
+            logger.debug("Successfully got tick {}".format(tick_to_call))
+            still_a_battle = modify_data_with_history(battle_data, api_result, checking='latest')
+            battle_data['max_tick_checked'] = tick_to_call
+            changed = True
+            if not still_a_battle:
+                found_end = True
+                battle_data['battle_still_ongoing'] = False
+                break
+            elif tick_to_call > battle_data['stop_checking_at']:
+                found_end = True
+                battle_data['battle_still_ongoing'] = True
+                break
 
     if found_end:
         logger.debug("Ended. Found end{}, submitting!"
                      .format(" (of ongoing battle)" if battle_data['battle_still_ongoing'] else ""))
         # Finished! Let's clean up the data, then return it!
         del battle_data['creeps_found']
+        battle_data.pop('usernames', None)
         del battle_data['stop_checking_at']
         del battle_data['max_tick_checked']
         battle_data['duration'] = battle_data['latest_hostilities_detected'] \
@@ -258,10 +542,10 @@ def work_on_room_data(room_name, current_tick):
         return battle_data
     else:
         logger.debug("Ended, but still searching!")
-        if changed:
-            storage.set_ongoing_data(room_name, battle_data)
+        if changed and not storage.set_ongoing_data(room_name, battle_data, stored_data, lease_token):
+            logger.warning("Lease on {} ran out before its progress was stored: discarding it.".format(room_name))
 
-        return None
+        return HistoryNotReady(battle_data['max_tick_checked'] + 20)
 
 
 def modify_data_with_history(battle_data, history_result, checking=None):
@@ -281,64 +565,67 @@ def modify_data_with_history(battle_data, history_result, checking=None):
 
 
     :param battle_data: The battle data to modify
-    :param history_result: The history API call result.
+    :param history_result: The history segment, either compact (as returned by grab_history) or full.
     :param checking: `earliest` or `latest`
     :return: If checking is not None and more history should be searched, this will return true.
              If checking is not None and we've reached the end (or beginning, depending on what 'checking' is) of the
                battle, this will return False
              If checking is None, this returns None.
     """
-    earliest_tick = None
-    latest_tick = None
-    earliest_hostilities_this_section = None
-    latest_hostilities_this_section = None
-    for tick, tick_data in history_result['ticks'].items():
-        tick = int(tick)
-        if earliest_tick is None or tick < earliest_tick:
-            earliest_tick = tick
-        if latest_tick is None or tick > latest_tick:
-            latest_tick = tick
-        hostilities_this_tick = False
-        bother_finding_hostilities = earliest_hostilities_this_section is None \
-                                     or latest_hostilities_this_section is None \
-                                     or tick < earliest_hostilities_this_section \
-                                     or tick > latest_hostilities_this_section
-        for creep_id, obj_data in tick_data.items():
+    if 'columns' not in history_result:
+        # A full history segment, rather than one decoded by history_parser.
+        history_result = history_parser.compact_segment(history_result['ticks'])
+
+    creeps_found = battle_data['creeps_found']
+    # (owner_id, creep_type) for each newly found creep, in the order found.
+    new_creeps = []
+    room_owner_id = None
+    room_rcl = 0
+    # Newly found invader and source keeper creeps' actions don't count as hostilities on the tick they're found.
+    new_npc_creeps = set()
+    for tick, tick_objects in history_result['ticks'].items():
+        for creep_id, obj_data in tick_objects.items():
             # type is only set for new creeps, but we don't really care about updates to old creeps yet because
             # we're just counting raw bodyparts.
-            if not obj_data:
-                continue
-            if obj_data.get('type') == 'creep' and creep_id not in battle_data['creeps_found']:
-                battle_data['creeps_found'].append(creep_id)
+            obj_type = obj_data.get('type')
+            if obj_type == 'creep' and creep_id not in creeps_found:
+                creeps_found.add(creep_id)
                 owner = obj_data['user']
                 # User ID 2 is invader, user ID 3 is source keeper.
                 if owner.isdigit() and (int(owner) == 2 or int(owner) == 3):
+                    new_npc_creeps.add((int(tick), creep_id))
                     continue
-                # TODO: maybe fetch usernames from IDs all at once later on, to ensure consistency if any user changes
-                # their username while we're still scanning history?
-                # Probably not too important anyways though, as our username cache lasts 5 hours.
-                owner_dict = battle_data['player_creep_counts'].setdefault(username_from_id(owner), {})
-                creep_type = identify_creep(obj_data)
-                owner_dict[creep_type] = owner_dict.get(creep_type, 0) + 1
-            if battle_data['owner'] is None and obj_data.get('type') == 'controller':
+                # Usernames are looked up all at once after going through the whole segment.
+                new_creeps.append((owner, identify_creep(obj_data)))
+            if room_owner_id is None and battle_data['owner'] is None and obj_type == 'controller':
                 if obj_data.get('user') is not None:
-                    battle_data['owner'] = username_from_id(obj_data.get('user'))
-                    battle_data['rcl'] = obj_data.get('level')
+                    room_owner_id = obj_data.get('user')
+                    room_rcl = obj_data.get('level')
                 elif obj_data.get('reservation') is not None:
-                    battle_data['owner'] = username_from_id(obj_data['reservation']['user'])
-                    battle_data['rcl'] = 0
-            if bother_finding_hostilities and not hostilities_this_tick:
-                action_log = obj_data.get('actionLog')
-                if action_log and (action_log.get('attack') or action_log.get('rangedAttack')
-                                   or action_log.get('rangedMassAttack')
-                                   or action_log.get('heal') or action_log.get('rangedHeal')):
-                    hostilities_this_tick = True
-
-        if hostilities_this_tick:
-            if earliest_hostilities_this_section is None or tick < earliest_hostilities_this_section:
-                earliest_hostilities_this_section = tick
-            if latest_hostilities_this_section is None or tick > latest_hostilities_this_section:
-                latest_hostilities_this_section = tick
+                    room_owner_id = obj_data['reservation']['user']
+                    room_rcl = 0
+
+    earliest_tick = history_result['first_tick']
+    latest_tick = history_result['last_tick']
+    earliest_hostilities_this_section, latest_hostilities_this_section = \
+        history_parser.hostility_window(history_result, new_npc_creeps)
+
+    if new_creeps or room_owner_id is not None:
+        # Each user is only looked up once per battle, so that a user changing their name part way through a battle
+        # doesn't split them into two players.
+        usernames = battle_data.setdefault('usernames', {})
+        unknown_ids = {owner for owner, creep_type in new_creeps if owner not in usernames}
+        if room_owner_id is not None and room_owner_id not in usernames:
+            unknown_ids.add(room_owner_id)
+        if unknown_ids:
+            usernames.update(usernames_from_ids(unknown_ids))
+        for owner, creep_type in new_creeps:
+            owner_dict = battle_data['player_creep_counts'].setdefault(usernames[owner], {})
+            owner_dict[creep_type] = owner_dict.get(creep_type, 0) + 1
+        if room_owner_id is not None:
+            battle_data['owner'] = usernames[room_owner_id]
+            battle_data['rcl'] = room_rcl
+
     if earliest_tick is None and latest_tick is None:
         return_value = True  # This was an empty history file! Let's just let more searching happen.
     elif checking == 'earliest':
@@ -368,40 +655,75 @@ def modify_data_with_history(battle_data, history_result, checking=None):
     return return_value
 
 
-def identify_creep(creep_obj):
-    body = creep_obj['body']
+# Every body part type the classification rules look at.
+_PART_TYPES = ('move', 'work', 'carry', 'attack', 'ranged_attack', 'heal', 'claim', 'tough')
+_MOVE, _WORK, _CARRY, _ATTACK, _RANGED, _HEAL, _CLAIM, _TOUGH = (1 << i for i in range(len(_PART_TYPES)))
+# Not part types: set when a body has more than 8 WORK parts, and when it has any part not in _PART_TYPES.
+_MANY_WORK = 1 << len(_PART_TYPES)
+_OTHER = _MANY_WORK << 1
+_PART_BITS = {part_type: 1 << i for i, part_type in enumerate(_PART_TYPES)}
 
-    def has(type):
-        return any(x.get('type') == type for x in body)
 
-    def count(type):
-        return sum(x.get('type') == type for x in body)
+def _classify_by_parts(parts):
+    """
+    The classification rules, given a bitmask of which _PART_TYPES a body has (plus _MANY_WORK and _OTHER).
 
-    ranged = has('ranged_attack')
-    heal = has('heal')
-    attack = has('attack')
-    work = has('work')
-    carry = has('carry')
-    claim = has('claim')
+    Only used to build _ROLE_TABLE. Returns None for bodies the rules don't describe.
+    """
+    ranged = bool(parts & _RANGED)
+    heal = bool(parts & _HEAL)
+    attack = bool(parts & _ATTACK)
+    work = bool(parts & _WORK)
+    carry = bool(parts & _CARRY)
+    claim = bool(parts & _CLAIM)
     if ranged and not attack:
         return ranged_attacker
     elif attack and not ranged:
         return melee_attacker
     elif heal and not ranged and not attack:
         return healer
-    elif work and not carry and count('work') > 8:
+    elif work and not carry and parts & _MANY_WORK:
         return dismantling_attacker
     elif (ranged or heal or attack) and not carry:
         return general_attacker
-    elif all(x.get('type') == 'move' or x.get('type') == 'tough' for x in body):
+    elif not parts & ~(_MOVE | _TOUGH):
         return tough_attacker
     elif (work or carry or claim) and not heal and not ranged and not attack:
         return civilian
     elif (work or carry or claim) and (heal or ranged or attack):
         return work_and_carry_attacker
-    elif all(x.get('type') == 'move' for x in body):
+    elif not parts & ~_MOVE:
         return scout
     else:
+        return None
+
+
+# Role for every combination of part types present.
+_ROLE_TABLE = tuple(_classify_by_parts(parts) for parts in range(_OTHER << 1))
+
+
+@functools.lru_cache(maxsize=10000)
+def _classify_body(signature):
+    """
+    Classifies a body, given as a tuple of part types in order. Creeps built from the same spawn template share a body,
+    so this is almost always a cache hit.
+    """
+    parts = 0
+    work_count = 0
+    for part_type in signature:
+        bit = _PART_BITS.get(part_type, _OTHER)
+        parts |= bit
+        if bit == _WORK:
+            work_count += 1
+    if work_count > 8:
+        parts |= _MANY_WORK
+    role = _ROLE_TABLE[parts]
+    if role is None:
         # We're just saying this as info for now since we care about adding new bodytypes to the code.
-        logger.info("Couldn't describe creep body: {}".format(body))
-        return ''.join(x['type'][0].upper() for x in body)
+        logger.info("Couldn't describe creep body: {}".format(list(signature)))
+        role = ''.join(part_type[0].upper() for part_type in signature)
+    return role
+
+
+def identify_creep(creep_obj):
+    return _classify_body(tuple(part.get('type') for part in creep_obj['body']))
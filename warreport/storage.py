@@ -33,14 +33,23 @@ One major data format used here is a map of "battle data". The following defines
         # ...
     },
 
-    # A list of creep IDs which we have already added to the creeps map
+    # A set of creep IDs which we have already added to the creeps map.
     # Included: in non-finished data
-    # Added: empty list after first history collection.
-    'creeps_found': [
+    # Added: empty set after first history collection.
+    'creeps_found': {
         '582f8e657a1fc8bf5cd28be5',
         '582f8116e8c62a5d2e464ad2',
         # ...
-    ],
+    },
+
+    # Every user ID we've needed a username for so far, so that each user is only looked up once per battle, and
+    # keeps the same name throughout it.
+    # Included: in non-finished data
+    # Added: when the first username is looked up.
+    'usernames': {
+        '57874d42d0ae911e3bd15bbc': 'name1',
+        # ...
+    },
 
     # The room's owner / reserver, or null if unowned and unreserved.
     # Included: in all data.
@@ -105,6 +114,14 @@ One major data format used here is a map of "battle data". The following defines
     'room': 'E15N53',
 }
 
+While a battle is still being processed, its data isn't stored as one value, but split over a few redis structures so
+that each processing step only needs to write what it changed (see set_ongoing_data):
+
+- BATTLE_STATE_KEY: a hash of every other field -> its JSON encoded value
+- BATTLE_CREEPS_KEY: a set holding creeps_found, with IDs packed into 12 bytes (see encoding.pack_object_id)
+- BATTLE_COUNTS_KEY: a hash of "username:role" -> count, holding player_creep_counts
+- BATTLE_USERNAMES_KEY: a hash holding usernames
+
 The following are smaller defined formats in which the battle info may appear:
 
 No data processed yet, just freshly found:
@@ -141,12 +158,12 @@ Initial starting history segment found, and past history segments searched, but
         # ...
     },
 
-    # A list of creep IDs which we have already added to the creeps map
-    'creeps_found': [
+    # A set of creep IDs which we have already added to the creeps map
+    'creeps_found': {
         '582f8e657a1fc8bf5cd28be5',
         '582f8116e8c62a5d2e464ad2',
         # ...
-    ]
+    }
 
     # The room's owner / reserver, or null if unowned and unreserved.
     owner: 'screepsuser',
@@ -223,7 +240,11 @@ Completed data in the reporting queue(s):
 """
 
 from warreport.key_constants import USERNAME_CACHE_EXPIRE, USERNAME_CACHE_KEY, BATTLE_DATA_KEY, BATTLE_DATA_EXPIRE, \
-    ALLIANCES_FETCHED_KEY, ALLIANCES_FETCHED_EXPIRE, ALLIANCE_CACHE_KEY, ALLIANCE_CACHE_EXPIRE
+    BATTLE_STATE_KEY, BATTLE_CREEPS_KEY, BATTLE_COUNTS_KEY, BATTLE_USERNAMES_KEY, ALLIANCES_FETCHED_KEY, \
+    ALLIANCES_FETCHED_EXPIRE, ALLIANCES_KEY, ALLIANCES_VERSION_KEY, ALLIANCES_VALIDATORS_KEY, ALLIANCES_TEMP_KEY, \
+    MISSING_SEGMENT_KEY, PROCESSING_LEASES
+
+import redis
 
 try:
     import rapidjson as json
@@ -231,23 +252,39 @@ except ImportError:
     import json
 
 from warreport import redis_conn as cache_connection
+from warreport.encoding import pack_object_id, unpack_object_id
 
-__all__ = ["get_username", "set_username", "set_ongoing_data", "get_ongoing_data", "is_alliance_data_recent",
-           "update_alliance_data", "get_cached_alliance"]
+__all__ = ["get_usernames", "set_usernames", "set_ongoing_data", "get_ongoing_data", "copy_ongoing_data",
+           "ongoing_data_keys",
+           "is_alliance_data_recent", "mark_alliance_data_recent", "replace_alliance_data", "get_alliance_validators",
+           "get_alliance_version", "get_alliance_snapshot", "get_missing_segment", "set_missing_segment"]
 
 
-def get_username(user_id):
-    key = USERNAME_CACHE_KEY.format(user_id)
-    raw = cache_connection.get(key)
-    if raw is None:
-        return None
-    else:
-        return raw.decode()
+def get_usernames(user_ids):
+    """
+    Gets a number of cached usernames in a single MGET.
+    :param user_ids: A list of user IDs
+    :return: A dict of user_id -> username, only including user IDs which were cached.
+    :rtype: dict[str, str]
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return {}
+    raw_list = cache_connection.mget([USERNAME_CACHE_KEY.format(user_id) for user_id in user_ids])
+    return {user_id: raw.decode() for user_id, raw in zip(user_ids, raw_list) if raw is not None}
 
 
-def set_username(user_id, username):
-    key = USERNAME_CACHE_KEY.format(user_id)
-    cache_connection.set(key, username, ex=USERNAME_CACHE_EXPIRE)
+def set_usernames(user_id_to_username):
+    """
+    Caches a number of usernames in a single pipeline.
+    :param user_id_to_username: A dict of user_id -> username
+    """
+    if not user_id_to_username:
+        return
+    pipe = cache_connection.pipeline(transaction=False)
+    for user_id, username in user_id_to_username.items():
+        pipe.set(USERNAME_CACHE_KEY.format(user_id), username, ex=USERNAME_CACHE_EXPIRE)
+    pipe.execute()
 
 
 # Just a note:
@@ -257,48 +294,270 @@ def set_username(user_id, username):
 # TODO: add more assumptions here.
 
 
-def set_ongoing_data(room_name, data_map):
+# Fields of battle data which aren't stored in BATTLE_STATE_KEY.
+_SPLIT_FIELDS = ('creeps_found', 'player_creep_counts', 'usernames')
+
+
+def ongoing_data_keys(room_name):
+    """
+    :return: Every key a room's ongoing battle data may be stored under, for deleting it.
+    :rtype: list[str]
+    """
+    return [key.format(room_name) for key in (BATTLE_STATE_KEY, BATTLE_CREEPS_KEY, BATTLE_COUNTS_KEY,
+                                              BATTLE_USERNAMES_KEY, BATTLE_DATA_KEY)]
+
+
+def copy_ongoing_data(data_map):
+    """
+    Copies battle data deeply enough that changing the original doesn't change the copy, for passing to
+    set_ongoing_data as previous_data_map later.
+    """
+    copy = dict(data_map)
+    if 'creeps_found' in copy:
+        copy['creeps_found'] = set(copy['creeps_found'])
+    if 'player_creep_counts' in copy:
+        copy['player_creep_counts'] = {player: dict(counts) for player, counts in copy['player_creep_counts'].items()}
+    if 'usernames' in copy:
+        copy['usernames'] = dict(copy['usernames'])
+    return copy
+
+
+def _ongoing_changes(data_map, previous_data_map):
+    """
+    Works out what set_ongoing_data needs to write to turn previous_data_map, as stored, into data_map.
+    :return: A tuple of ({state field: JSON value} to set, [state fields] to remove, [packed creep IDs] to add,
+             {"username:role": increase} of creep counts, {user_id: username} to set)
+    """
+    changed_fields = {field: json.dumps(value) for field, value in data_map.items()
+                      if field not in _SPLIT_FIELDS and (field not in previous_data_map
+                                                         or previous_data_map[field] != value)}
+    removed_fields = [field for field in previous_data_map if field not in _SPLIT_FIELDS and field not in data_map]
+
+    new_creeps = data_map.get('creeps_found', set()) - previous_data_map.get('creeps_found', set())
+    new_creeps = [pack_object_id(creep_id) for creep_id in new_creeps]
+
+    count_increases = {}
+    previous_counts = previous_data_map.get('player_creep_counts', {})
+    for player, counts in data_map.get('player_creep_counts', {}).items():
+        previous_player_counts = previous_counts.get(player, {})
+        for role, count in counts.items():
+            increase = count - previous_player_counts.get(role, 0)
+            if increase:
+                count_increases["{}:{}".format(player, role)] = increase
+
+    previous_usernames = previous_data_map.get('usernames', {})
+    new_usernames = {user_id: username for user_id, username in data_map.get('usernames', {}).items()
+                     if previous_usernames.get(user_id) != username}
+    return changed_fields, removed_fields, new_creeps, count_increases, new_usernames
+
+
+# Writes the changes to a room's ongoing battle data from _ongoing_changes, only if the given lease token still holds
+# the room's lease. Creep counts are written as increments, so a worker which has lost its lease writing them on top of
+# what the new lease holder writes would count every creep twice.
+# Keys should be [processing_leases, then every key of the room's ongoing battle data, from ongoing_data_keys]
+# Args should be [room_name, lease_token or '' not to check it, expire_seconds, '1' to delete the data first or '0',
+#                 then each of _ongoing_changes' results in order, as their length followed by their items (with
+#                 field, value pairs for the dicts)]
+# Returns 1 if the lease was held, 0 otherwise.
+_set_ongoing_data_script = redis.client.Script(None, """
+if ARGV[2] ~= '' and redis.call('hget', KEYS[1], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+if ARGV[4] == '1' then
+    redis.call('del', KEYS[2], KEYS[3], KEYS[4], KEYS[5], KEYS[6])
+end
+local i = 5
+local function section(step, apply)
+    local length = tonumber(ARGV[i])
+    for j = i + 1, i + length, step do
+        apply(j)
+    end
+    i = i + length + 1
+end
+section(2, function(j) redis.call('hset', KEYS[2], ARGV[j], ARGV[j + 1]) end)
+section(1, function(j) redis.call('hdel', KEYS[2], ARGV[j]) end)
+section(1, function(j) redis.call('sadd', KEYS[3], ARGV[j]) end)
+section(2, function(j) redis.call('hincrby', KEYS[4], ARGV[j], ARGV[j + 1]) end)
+section(2, function(j) redis.call('hset', KEYS[5], ARGV[j], ARGV[j + 1]) end)
+for key = 2, 5 do
+    redis.call('expire', KEYS[key], ARGV[3])
+end
+return 1
+""")
+
+
+def set_ongoing_data(room_name, data_map, previous_data_map=None, lease_token=None):
     """
     Sets the "currently process" data for a given room name.
 
-    This stores the data map into redis as JSON.
+    Given the data as it was last stored, only what changed since then is written: changed fields, new creeps and
+    usernames, and increments to creep counts. Long battles can have thousands of creeps found, and rewriting all of
+    them each step would be most of the work.
 
     :param room_name: The room
     :param data_map: The data map, in the "battle data" format described in module docs.
+    :param previous_data_map: The data map as currently stored, copied with copy_ongoing_data after getting it with
+                              get_ongoing_data. If None, the data is rewritten from scratch.
+    :param lease_token: The lease token the room is being processed under, from queuing.get_next_room_to_process_async.
+                        If given, nothing is written unless it still holds the room's lease.
+    :return: False if the lease had already run out and been taken by someone else, in which case nothing is changed.
     """
-    key = BATTLE_DATA_KEY.format(room_name)
-    cache_connection.set(key, json.dumps(data_map), ex=BATTLE_DATA_EXPIRE)
+    args = [room_name, lease_token or '', BATTLE_DATA_EXPIRE, '1' if previous_data_map is None else '0']
+    for changes in _ongoing_changes(data_map, previous_data_map or {}):
+        if isinstance(changes, dict):
+            args.append(len(changes) * 2)
+            for field, value in changes.items():
+                args.extend((field, value))
+        else:
+            args.append(len(changes))
+            args.extend(changes)
+    if not _set_ongoing_data_script.sha:
+        _set_ongoing_data_script.sha = cache_connection.script_load(_set_ongoing_data_script.script)
+    return bool(_set_ongoing_data_script(keys=[PROCESSING_LEASES] + ongoing_data_keys(room_name), args=args,
+                                         client=cache_connection))
+
+
+def _decode_legacy_ongoing_data(raw):
+    data_map = json.loads(raw.decode())
+    creeps_found = data_map.get('creeps_found')
+    if isinstance(creeps_found, str):
+        data_map['creeps_found'] = set(creeps_found.split(',')) if creeps_found else set()
+    elif creeps_found is not None:
+        data_map['creeps_found'] = set(creeps_found)
+    return data_map
 
 
 def get_ongoing_data(room_name):
     """
     Gets the "currently processing" data for a given room name, set with set_ongoing_data.
-    :return: the data
-    :rtype: dict[str, int | list[str] | dict[str, dict[str, str]]]
+    :return: the data, or None if there is no ongoing data for this room
+    :rtype: dict[str, int | set[str] | dict[str, dict[str, str]]]
+    """
+    pipe = cache_connection.pipeline(transaction=False)
+    pipe.hgetall(BATTLE_STATE_KEY.format(room_name))
+    pipe.smembers(BATTLE_CREEPS_KEY.format(room_name))
+    pipe.hgetall(BATTLE_COUNTS_KEY.format(room_name))
+    pipe.hgetall(BATTLE_USERNAMES_KEY.format(room_name))
+    raw_state, raw_creeps, raw_counts, raw_usernames = pipe.execute()
+
+    if not raw_state:
+        raw = cache_connection.get(BATTLE_DATA_KEY.format(room_name))
+        if raw is None:
+            return None
+        # Stored as a single JSON string, before it was split up: move it over.
+        data_map = _decode_legacy_ongoing_data(raw)
+        set_ongoing_data(room_name, data_map)
+        return data_map
+
+    return _decode_ongoing_data(raw_state, raw_creeps, raw_counts, raw_usernames)
+
+
+def _decode_ongoing_data(raw_state, raw_creeps, raw_counts, raw_usernames):
+    """
+    Builds battle data back up from the contents of its keys, as written by set_ongoing_data.
     """
-    key = BATTLE_DATA_KEY.format(room_name)
-    return json.loads(cache_connection.get(key).decode())
+    data_map = {field.decode(): json.loads(value.decode()) for field, value in raw_state.items()}
+    if 'max_tick_checked' in data_map:
+        # Only found after the first history collection.
+        data_map['creeps_found'] = {unpack_object_id(creep_id) for creep_id in raw_creeps}
+        player_creep_counts = {}
+        for field, count in raw_counts.items():
+            player, role = field.decode().split(':', 1)
+            player_creep_counts.setdefault(player, {})[role] = int(count)
+        data_map['player_creep_counts'] = player_creep_counts
+    if raw_usernames:
+        data_map['usernames'] = {user_id.decode(): username.decode() for user_id, username in raw_usernames.items()}
+    return data_map
 
 
 def is_alliance_data_recent():
     return cache_connection.exists(ALLIANCES_FETCHED_KEY)
 
 
-def update_alliance_data(user_alliance_tuple_list):
+def mark_alliance_data_recent():
+    """
+    Marks the alliance data as recent without changing it, either because alliances.js hasn't changed or because we
+    couldn't get it and want to wait before trying again.
+    """
+    cache_connection.set(ALLIANCES_FETCHED_KEY, 1, ex=ALLIANCES_FETCHED_EXPIRE)
+
+
+def replace_alliance_data(user_to_alliance, etag=None, last_modified=None):
+    """
+    Atomically replaces all alliance data, and bumps the alliance data version.
+
+    :param user_to_alliance: A dict of username -> alliance
+    :param etag: The ETag header of the alliances.js response this data came from, if any
+    :param last_modified: The Last-Modified header of the alliances.js response this data came from, if any
+    :return: The new version
+    :rtype: int
+    """
     pipe = cache_connection.pipeline()
+    if user_to_alliance:
+        # Build the new hash under a temporary key, then rename it over the old one, so that readers never see a
+        # half-written hash.
+        pipe.delete(ALLIANCES_TEMP_KEY)
+        pipe.hmset(ALLIANCES_TEMP_KEY, user_to_alliance)
+        pipe.rename(ALLIANCES_TEMP_KEY, ALLIANCES_KEY)
+    else:
+        pipe.delete(ALLIANCES_KEY)
+    pipe.delete(ALLIANCES_VALIDATORS_KEY)
+    validators = {name: value for name, value in (('etag', etag), ('last_modified', last_modified))
+                  if value is not None}
+    if validators:
+        pipe.hmset(ALLIANCES_VALIDATORS_KEY, validators)
+    pipe.incr(ALLIANCES_VERSION_KEY)
     pipe.set(ALLIANCES_FETCHED_KEY, 1, ex=ALLIANCES_FETCHED_EXPIRE)
-    for user, alliance in user_alliance_tuple_list:
-        pipe.set(ALLIANCE_CACHE_KEY.format(user), alliance, ex=ALLIANCE_CACHE_EXPIRE)
-    pipe.execute()
+    return pipe.execute()[-2]
 
 
-def get_cached_alliance(username):
+def get_alliance_validators():
+    """
+    :return: A dict possibly containing 'etag' and 'last_modified', as given to replace_alliance_data.
+    :rtype: dict[str, str]
     """
-    Note: be sure to check if is_alliance_data_recent() before using this, or you could get incorrect/old results.
+    return {key.decode(): value.decode() for key, value in cache_connection.hgetall(ALLIANCES_VALIDATORS_KEY).items()}
+
+
+def get_alliance_version():
     """
-    key = ALLIANCE_CACHE_KEY.format(username)
-    raw = cache_connection.get(key)
+    :return: The current alliance data version, or None if alliance data has never been stored.
+    :rtype: int | None
+    """
+    raw = cache_connection.get(ALLIANCES_VERSION_KEY)
     if raw is None:
         return None
-    else:
-        return raw.decode()
+    return int(raw)
+
+
+def get_alliance_snapshot():
+    """
+    Gets all alliance data, and the version it belongs to.
+    :return: A tuple of (version, {username: alliance})
+    :rtype: (int | None, dict[str, str])
+    """
+    pipe = cache_connection.pipeline()
+    pipe.get(ALLIANCES_VERSION_KEY)
+    pipe.hgetall(ALLIANCES_KEY)
+    raw_version, raw_alliances = pipe.execute()
+    version = int(raw_version) if raw_version is not None else None
+    return version, {user.decode(): alliance.decode() for user, alliance in raw_alliances.items()}
+
+
+def get_missing_segment(room, tick):
+    """
+    :return: "missing" or "empty" if the history segment was recently found to be so with set_missing_segment, otherwise
+             None.
+    :rtype: str | None
+    """
+    raw = cache_connection.get(MISSING_SEGMENT_KEY.format(room, tick))
+    if raw is None:
+        return None
+    return raw.decode()
+
+
+def set_missing_segment(room, tick, kind, expire):
+    """
+    Remembers that a history segment was a 404 ("missing") or an empty document ("empty"), for `expire` seconds.
+    """
+    cache_connection.set(MISSING_SEGMENT_KEY.format(room, tick), kind, ex=max(1, int(expire)))
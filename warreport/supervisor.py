@@ -0,0 +1,186 @@
+"""
+Runs the parts of warreport on event loops, either all in one process, or spread out over several supervised worker
+processes: one discovering new battles, PROCESSOR_PROCESSES each processing one partition of the rooms, and
+REPORTER_PROCESSES reporting finished battles.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import warreport
+from warreport import async_redis, battle_monitor, battle_reporting, queuing, metrics_server
+
+logger = logging.getLogger("warreport")
+
+# Seconds between checks that every worker process is still alive.
+CHECK_INTERVAL = 1
+# Seconds to wait before restarting a worker process which died.
+RESTART_DELAY = 5
+# Seconds to give worker processes to finish up after asking them to stop, before killing them.
+SHUTDOWN_TIMEOUT = 30
+
+DISCOVERY = "discovery"
+PROCESSOR = "processor"
+REPORTER = "reporter"
+
+
+def run_event_loop(coroutine_functions, executor_workers, stop_signals=(signal.SIGINT, signal.SIGTERM)):
+    """
+    Runs the given coroutine functions, each called with the loop, on a new event loop until they finish, one of them
+    fails, or one of the stop signals is received. Outstanding coroutines are then cancelled, and any calls they left
+    running in the executor are waited for, and the loop's redis connections closed.
+
+    :param coroutine_functions: Functions taking the event loop and returning a coroutine
+    :param executor_workers: The number of threads to give the loop's default executor
+    :param stop_signals: Signals to stop on
+    :return: True if stopped by a signal or finished, False if one of the coroutines failed
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    executor = ThreadPoolExecutor(max_workers=executor_workers)
+    loop.set_default_executor(executor)
+    tasks = [loop.create_task(function(loop)) for function in coroutine_functions]
+    gathered_future = asyncio.gather(*tasks, loop=loop)
+    for signal_number in stop_signals:
+        loop.add_signal_handler(signal_number, gathered_future.cancel)
+
+    success = True
+    try:
+        loop.run_until_complete(gathered_future)
+    except asyncio.CancelledError:
+        logger.info("Asked to stop: ending main loop.")
+    except Exception:
+        logger.exception("Caught exception: ending main loop.")
+        success = False
+    finally:
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, loop=loop, return_exceptions=True))
+        executor.shutdown(wait=True)
+        async_redis.close_pool(loop)
+        loop.close()
+    return success
+
+
+def _role_coroutines(role, index):
+    """
+    :return: A tuple of (coroutine_functions, executor_workers) for run_event_loop to run the given role.
+    """
+    if role == DISCOVERY:
+        coroutine_functions, executor_workers = [battle_monitor.grab_new_battles], 4
+    elif role == PROCESSOR:
+        # Every room worker can be blocked on an HTTP call in the executor at once, plus alliance refreshing.
+        coroutine_functions = [partial(battle_monitor.process_battles, partition=index)]
+        executor_workers = warreport.PROCESSING_WORKERS + 4
+    elif role == REPORTER:
+        # The tick clock is only needed to tell how old battles are when they're reported.
+        coroutine_functions = [battle_reporting.process_and_requeue_reports, battle_monitor.keep_tick_clock_fresh]
+        executor_workers = 4
+    else:
+        raise ValueError("Unknown worker role: {}".format(role))
+    if warreport.METRICS_PORT is not None:
+        coroutine_functions.append(partial(metrics_server.serve_metrics, port=_metrics_port(role, index),
+                                           include_queues=role == DISCOVERY))
+    return coroutine_functions, executor_workers
+
+
+def _metrics_port(role, index):
+    """
+    :return: The port the given worker process serves its metrics on, see metrics_server.
+    """
+    if role == DISCOVERY:
+        return warreport.METRICS_PORT
+    elif role == PROCESSOR:
+        return warreport.METRICS_PORT + 1 + index
+    else:
+        return warreport.METRICS_PORT + 1 + warreport.PROCESSOR_PROCESSES + index
+
+
+def _worker_main(role, index):
+    # Ctrl+C reaches every process in the group: leave it to the supervisor to tell us when to stop.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logger.info("Started {} {} (pid {}).".format(role, index, os.getpid()))
+    coroutine_functions, executor_workers = _role_coroutines(role, index)
+    success = run_event_loop(coroutine_functions, executor_workers, stop_signals=(signal.SIGTERM,))
+    sys.exit(0 if success else 1)
+
+
+def run_single_process():
+    """
+    Runs battle discovery, room processing and reporting all on one event loop in this process.
+    :return: True if stopped cleanly, False if something failed
+    """
+    queuing.migrate_processing_queue()
+    queuing.migrate_reporting_queue()
+    coroutine_functions = [battle_monitor.grab_new_battles, battle_monitor.process_battles,
+                           battle_reporting.process_and_requeue_reports]
+    if warreport.METRICS_PORT is not None:
+        coroutine_functions.append(partial(metrics_server.serve_metrics, port=warreport.METRICS_PORT,
+                                           include_queues=True))
+    return run_event_loop(coroutine_functions, warreport.PROCESSING_WORKERS + 4)
+
+
+def supervise():
+    """
+    Starts one battle discovery process, PROCESSOR_PROCESSES room processing processes and REPORTER_PROCESSES
+    reporting processes, and restarts any of them which die until asked to stop with SIGINT or SIGTERM. Each processor
+    only takes rooms from its own partition of the processing schedule, so every room is always handled by the same
+    process.
+    :return: True once every worker process has been stopped.
+    """
+    # Rooms have to be in the right partitions before any processor starts taking them.
+    queuing.migrate_processing_queue()
+    queuing.migrate_reporting_queue()
+
+    # Start workers fresh rather than forking: they shouldn't share our redis or HTTP connections.
+    context = multiprocessing.get_context('spawn')
+    roles = ([(DISCOVERY, 0)]
+             + [(PROCESSOR, index) for index in range(warreport.PROCESSOR_PROCESSES)]
+             + [(REPORTER, index) for index in range(warreport.REPORTER_PROCESSES)])
+    processes = {}
+    start_after = {role: 0 for role in roles}
+
+    stopping = []
+
+    def stop(signal_number, frame):
+        stopping.append(signal_number)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    logger.info("Supervising {} processors and {} reporters.".format(warreport.PROCESSOR_PROCESSES,
+                                                                     warreport.REPORTER_PROCESSES))
+    while not stopping:
+        now = time.time()
+        for role in roles:
+            process = processes.get(role)
+            if process is not None:
+                if process.is_alive():
+                    continue
+                logger.warning("{} {} exited with code {}: restarting it in {} seconds.".format(
+                    role[0], role[1], process.exitcode, RESTART_DELAY))
+                del processes[role]
+                start_after[role] = now + RESTART_DELAY
+            if now >= start_after[role]:
+                process = context.Process(target=_worker_main, args=role, name="warreport-{}-{}".format(*role))
+                process.start()
+                processes[role] = process
+        time.sleep(CHECK_INTERVAL)
+
+    logger.info("Asked to stop: stopping {} worker processes.".format(len(processes)))
+    for process in processes.values():
+        process.terminate()
+    deadline = time.time() + SHUTDOWN_TIMEOUT
+    for process in processes.values():
+        process.join(max(0, deadline - time.time()))
+        if process.is_alive():
+            logger.warning("{} didn't stop in time: killing it.".format(process.name))
+            os.kill(process.pid, signal.SIGKILL)
+            process.join()
+    return True